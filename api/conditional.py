@@ -0,0 +1,99 @@
+# api, conditional.py:
+# conditional GET (ETag / Last-Modified -> 304 Not Modified) for list and retrieve of a viewset.
+# list:     validators come from one aggregate over the filtered queryset, MAX(updated_at) + COUNT(*),
+#           so an unchanged page is answered without fetching or serializing a single row.
+# retrieve: validators come from the object's updated_at.
+import hashlib
+
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework.response import Response
+
+VALIDATOR_HEADERS = ('ETag', 'Last-Modified')
+
+
+def make_etag(*parts):
+    return quote_etag(hashlib.md5('|'.join(str(part) for part in parts).encode()).hexdigest())
+
+
+def to_timestamp(value):
+    return int(value.timestamp()) if value is not None else None
+
+
+def set_validators(response, etag=None, last_modified=None):
+    if etag:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def not_modified(request, etag=None, last_modified=None):
+    """304 response if the client's copy is current, else None"""
+    return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+
+def not_modified_from_headers(request, headers):
+    """same as not_modified(), for validators saved from an earlier response (eg. a cached one)"""
+    last_modified = headers.get('Last-Modified')
+    return not_modified(request, headers.get('ETag'), last_modified and parse_http_date_safe(last_modified))
+
+
+class ConditionalGetMixin:
+    """
+    Sends ETag and Last-Modified on list and retrieve, and answers If-None-Match / If-Modified-Since with 304.
+     - last_modified_fields: timestamp fields that change whenever the serialized data does,
+       a related one (eg. 'category__updated_at') covers nested data
+     - conditional_vary_on_user: set when the queryset/data depends on request.user, the user goes into the ETag
+    """
+    last_modified_fields = ['updated_at']
+    conditional_vary_on_user = False
+
+    def get_last_modified_fields(self):
+        return self.last_modified_fields
+
+    def get_etag_parts(self, request):
+        # every param is part of the etag, ?page=2 and ?page=3 of an unchanged catalog are different documents
+        parts = [sorted(request.query_params.lists())]
+        if self.conditional_vary_on_user:
+            parts.append(request.user.pk)
+        return parts
+
+    def get_list_validators(self, queryset):
+        fields = self.get_last_modified_fields()
+        stats = queryset.order_by().aggregate(
+            count=Count('pk'),
+            **{f'last_modified_{i}': Max(field) for i, field in enumerate(fields)},
+        )
+        timestamps = [stats[f'last_modified_{i}'] for i in range(len(fields)) if stats[f'last_modified_{i}']]
+        last_modified = max(timestamps) if timestamps else None
+        etag = make_etag(stats['count'], last_modified and last_modified.isoformat(), *self.get_etag_parts(self.request))
+        return etag, to_timestamp(last_modified)
+
+    def get_object_validators(self, instance):
+        timestamps = []
+        for field in self.get_last_modified_fields():
+            value = instance
+            for name in field.split('__'):
+                value = getattr(value, name, None)
+            if value is not None:
+                timestamps.append(value)
+        last_modified = max(timestamps) if timestamps else None
+        etag = make_etag(instance.pk, last_modified and last_modified.isoformat(), *self.get_etag_parts(self.request))
+        return etag, to_timestamp(last_modified)
+
+    def list(self, request, *args, **kwargs):
+        etag, last_modified = self.get_list_validators(self.filter_queryset(self.get_queryset()))
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = super().list(request, *args, **kwargs)
+        return set_validators(response, etag, last_modified)
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        etag, last_modified = self.get_object_validators(instance)
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            response = Response(self.get_serializer(instance).data)  # RetrieveModelMixin.retrieve, without a second get_object()
+        return set_validators(response, etag, last_modified)
@@ -0,0 +1,81 @@
+# api, db_router.py:
+# read replica routing.
+# GET/HEAD/OPTIONS requests of the viewsets with ReplicaReadMixin read from settings.REPLICA_DATABASE,
+# everything else stays on 'default': writes, reads inside a write request, other views, management commands.
+# Read your own writes: a successful write through one of those viewsets pins the user to the primary for
+# settings.REPLICA_PIN_SECONDS (a cache key, holds across workers when the cache is shared).
+# Without a replica alias in DATABASES every read goes to 'default'.
+# Actions whose responses are cached under a version bumped on commit (products/cache.py) stay off replica_actions:
+# the first miss after a bump would otherwise cache what a lagging replica still has, for the whole cache timeout.
+import contextvars
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+PIN_KEY = 'db:pin:{pk}'
+
+_read_alias = contextvars.ContextVar('read_alias', default=None)  # set for the duration of a replica request
+
+
+def replica_alias():
+    alias = getattr(settings, 'REPLICA_DATABASE', None)
+    return alias if alias in connections.settings else None
+
+
+def pin_to_primary(user):
+    cache.set(PIN_KEY.format(pk=user.pk), 1, timeout=getattr(settings, 'REPLICA_PIN_SECONDS', 10))
+
+
+def is_pinned(user):
+    return user.is_authenticated and cache.get(PIN_KEY.format(pk=user.pk)) is not None
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()  # None: Django's default, 'default'
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows, a product read there can be assigned to an order item written to the primary
+        aliases = {DEFAULT_DB_ALIAS, replica_alias()}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+
+class ReplicaReadMixin:
+    """
+    Viewset mixin, safe method requests read from the replica unless the user wrote recently.
+     - replica_actions: actions allowed on the replica, None for every safe method action
+    """
+    replica_actions = None
+
+    def dispatch(self, request, *args, **kwargs):
+        token = _read_alias.set(None)
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            _read_alias.reset(token)  # a streamed body is read after this, on the primary
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)  # authentication first, the pin is per user
+        if self.reads_from_replica(request):
+            _read_alias.set(replica_alias())
+
+    def reads_from_replica(self, request):
+        if request.method not in SAFE_METHODS or replica_alias() is None:
+            return False
+        if self.replica_actions is not None and self.action not in self.replica_actions:
+            return False
+        return not is_pinned(request.user)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if request.method not in SAFE_METHODS and response.status_code < 400 and replica_alias() is not None:
+            user = getattr(request, 'user', None)
+            if user is not None and user.is_authenticated:
+                pin_to_primary(user)
+        return super().finalize_response(request, response, *args, **kwargs)
@@ -0,0 +1,16 @@
+# api, routers.py:
+# nested router whose list routes also take PATCH, mapped to the viewset's bulk_update action:
+# PATCH /api/carts/{cart_id}/items/ changes many items in one request. A viewset without bulk_update
+# doesn't get the method (the router only maps actions the viewset has).
+from rest_framework_nested import routers
+
+
+def with_bulk_update(routes):
+    return [
+        route._replace(mapping={**route.mapping, 'patch': 'bulk_update'}) if route.name == '{basename}-list' else route
+        for route in routes
+    ]
+
+
+class BulkNestedDefaultRouter(routers.NestedDefaultRouter):
+    routes = with_bulk_update(routers.NestedDefaultRouter.routes)
@@ -0,0 +1,141 @@
+# api, streaming.py:
+# helpers to write big listings incrementally with StreamingHttpResponse instead of building one huge Response
+import csv
+import json
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from drf_yasg import openapi
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.encoders import JSONEncoder  # same Decimal/datetime handling as the JSON renderer
+
+STREAM_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class _JSONEncoder(JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):  # exact, like the string decimals serializers return
+            return str(obj)
+        return super().default(obj)
+
+
+def _dumps(item):
+    return json.dumps(item, cls=_JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+
+
+def iter_json_array(items):
+    """[item,item,...] written one item at a time"""
+    yield '['
+    first = True
+    for item in items:
+        yield _dumps(item) if first else ',' + _dumps(item)
+        first = False
+    yield ']'
+
+
+def iter_ndjson(items):
+    for item in items:
+        yield _dumps(item) + '\n'
+
+
+def streaming_json_response(items, stream_format='json', filename=None):
+    chunks = iter_ndjson(items) if stream_format == 'ndjson' else iter_json_array(items)
+    response = StreamingHttpResponse(chunks, content_type=STREAM_FORMATS[stream_format])
+    if filename:
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+class _Echo:
+    """file-like object for csv.writer, writerow() returns the line instead of buffering it"""
+    def write(self, value):
+        return value
+
+
+def format_datetime(value):
+    """ISO 8601 with 'Z' for UTC, what the JSON encoder writes, so csv and ndjson exports agree"""
+    representation = value.isoformat()
+    if representation.endswith('+00:00'):
+        representation = representation[:-6] + 'Z'
+    return representation
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return format_datetime(value)
+    return '' if value is None else value
+
+
+def iter_csv(header, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow([_csv_value(value) for value in row])
+
+
+def streaming_csv_response(header, rows, filename=None):
+    response = StreamingHttpResponse(iter_csv(header, rows), content_type='text/csv')
+    if filename:
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+
+def parse_export_params(request, date_fields=('created_at', 'updated_at')):
+    """
+    ?output=csv|ndjson  (not ?format=, DRF uses that one to pick a renderer)
+    ?since=2025-01-01&until=2025-01-31&date_field=updated_at  (a date only until includes that whole day)
+    returns (output, filter kwargs for the date range)
+    """
+    params = request.query_params
+    output = params.get('output', 'csv')
+    if output not in EXPORT_FORMATS:
+        raise ValidationError({'output': f"Must be one of {', '.join(EXPORT_FORMATS)}"})
+    date_field = params.get('date_field', date_fields[0])
+    if date_field not in date_fields:
+        raise ValidationError({'date_field': f"Must be one of {', '.join(date_fields)}"})
+
+    filters = {}
+    for param, lookup in (('since', 'gte'), ('until', 'lt')):
+        value = params.get(param)
+        if not value:
+            continue
+        try:
+            day = parse_date(value)  # first, parse_datetime() also reads a bare date as midnight
+            moment = None if day else parse_datetime(value)
+        except ValueError:  # well formed but out of range, eg. 2025-02-30
+            moment = day = None
+        if moment is None and day is None:
+            raise ValidationError({param: 'Expected a date (2025-01-31) or a datetime (2025-01-31T12:00:00Z)'})
+        if moment is None:
+            moment = datetime.combine(day + timedelta(days=1) if param == 'until' else day, time.min)
+        elif param == 'until':
+            lookup = 'lte'
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        filters[f'{date_field}__{lookup}'] = moment
+    return output, filters
+
+
+def export_response(output, header, rows, name):
+    """rows are value tuples in header order, csv as is, ndjson as {header: value} objects"""
+    filename = f'{name}.{output}'
+    if output == 'csv':
+        return streaming_csv_response(header, rows, filename)
+    return streaming_json_response((dict(zip(header, row)) for row in rows), 'ndjson', filename)
+
+
+EXPORT_PARAMETERS = [  # swagger docs of parse_export_params()
+    openapi.Parameter('output', openapi.IN_QUERY, type=openapi.TYPE_STRING, enum=list(EXPORT_FORMATS), default='csv'),
+    openapi.Parameter('since', openapi.IN_QUERY, description="From this date/datetime (inclusive)", type=openapi.TYPE_STRING),
+    openapi.Parameter('until', openapi.IN_QUERY, description="Up to this date/datetime (inclusive)", type=openapi.TYPE_STRING),
+    openapi.Parameter('date_field', openapi.IN_QUERY, type=openapi.TYPE_STRING, enum=['created_at', 'updated_at'], default='created_at'),
+]
@@ -1,3 +1,98 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connections
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from orders.models import Order
+from products.models import Category, Product, RelatedProduct, Review
+from users.models import User
 
-# Create your tests here.
+
+class ReplicaRoutingTest(TestCase):
+    """
+    a second sqlite database as the replica, rows that differ between the two show which one answered.
+    The alias is added after TestCase's class setup, the runner doesn't know it (no test database, no checks).
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmpdir = tempfile.mkdtemp()
+        connections.settings['replica'] = dict(connections['default'].settings_dict, NAME=os.path.join(cls.tmpdir, 'replica.sqlite3'))
+        cls.databases = cls.databases | {'replica'}
+        call_command('migrate', database='replica', verbosity=0)
+        # what the replica has, no signals (they would write to the primary)
+        Category.objects.using('replica').bulk_create([Category(pk=cls.category.pk, name='Replica')])
+        Product.objects.using('replica').bulk_create([
+            Product(pk=cls.product.pk, name='on replica', description='', price=10, stock=1, category_id=cls.category.pk)
+        ])
+        User.objects.using('replica').bulk_create([User(pk=cls.user.pk, email=cls.user.email, first_name='Reader')])
+        Order.objects.using('replica').bulk_create([Order(user_id=cls.user.pk, total_price=Decimal(5))])
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        shutil.rmtree(cls.tmpdir)
+        cls.databases = cls.databases - {'replica'}
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(email='reader@example.com', first_name='Reader')
+        cls.category = Category.objects.create(name='Primary')
+        cls.product = Product.objects.create(name='on primary', description='', price=10, stock=1, category=cls.category)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def names(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [row['name'] for row in response.data['results']]
+
+    def test_catalog_reads_go_to_the_replica(self):
+        self.assertEqual(self.names('/api/categories/'), ['Replica'])
+        RelatedProduct.objects.using('replica').bulk_create([
+            RelatedProduct(product_id=self.product.pk, related_id=self.product.pk, score=1, rank=1)
+        ])
+        self.assertEqual(len(self.client.get(f'/api/products/{self.product.pk}/related/').data), 1)  # only the replica has it
+
+    def test_cached_catalog_reads_stay_on_the_primary(self):
+        # a write, the version bump on commit, then a miss: it must not cache what a lagging replica still has
+        self.assertEqual(self.names('/api/products/'), ['on primary'])
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=self.product.pk).update(name='renamed')
+            Product.objects.get(pk=self.product.pk).save()  # signals bump the catalog version on commit
+        for _ in range(2):  # the miss, then the entry it stored
+            self.assertEqual(self.names('/api/products/'), ['renamed'])
+            self.assertEqual(self.client.get(f'/api/products/{self.product.pk}/').data['name'], 'renamed')
+        self.assertEqual(self.client.get('/api/products/')['X-Cache'], 'HIT')
+        self.assertEqual(self.client.get('/api/products/facets/').data['total'], 1)
+
+    def test_order_history_list_reads_the_replica(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/api/orders/').data['count'], 1)  # only the replica has an order
+        self.assertEqual(Order.objects.count(), 0)  # outside a request: primary
+
+    def test_writer_reads_the_primary_for_a_while(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.post(f'/api/products/{self.product.pk}/reviews/', {'ratings': 5, 'comment': 'good'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Review.objects.count(), 1)  # written to the primary
+        self.assertEqual(self.client.get(f'/api/products/{self.product.pk}/reviews/').data['count'], 1)
+        self.assertEqual(self.names('/api/categories/'), ['Primary'])
+
+        self.client.force_authenticate(None)  # another (anonymous) reader isn't pinned
+        self.assertEqual(self.client.get(f'/api/products/{self.product.pk}/reviews/').data['count'], 0)
+        self.assertEqual(self.names('/api/categories/'), ['Replica'])
+
+    @override_settings(REPLICA_DATABASE='not-configured')
+    def test_without_a_replica_everything_reads_the_primary(self):
+        self.assertEqual(self.names('/api/categories/'), ['Primary'])
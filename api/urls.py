@@ -5,6 +5,7 @@ from orders.views import CartViewSet, CartItemViewSet, OrderViewset, initiate_pa
 #from rest_framework.routers import DefaultRouter  # now using nested
 from rest_framework_nested import routers  # simplifies the creation of nested API routes and views. 
 from api.auth_views import CustomTokenObtainPairView
+from api.routers import BulkNestedDefaultRouter
 
 router = routers.DefaultRouter()
 router.register('products', ProductViewSet, basename='products')
@@ -16,7 +17,7 @@ product_router = routers.NestedDefaultRouter(router, 'products', lookup='product
 product_router.register('reviews', ReviewViewSet, basename='product-review')
 product_router.register('images', ProductImageViewSet, basename='product-images') # http://127.0.0.1:8000/api/products/1/images
 
-cart_router = routers.NestedDefaultRouter(router, 'carts', lookup='cart')
+cart_router = BulkNestedDefaultRouter(router, 'carts', lookup='cart')  # PATCH on items/ changes many items, api/routers.py
 cart_router.register('items', CartItemViewSet, basename='cart-item')  # 
 
 # urlpatterns = router.urls
@@ -0,0 +1,279 @@
+# orders, cart_store.py:
+# cache-backed carts, on with settings.CART_STORE_ENABLED. The active cart is read from Django's cache,
+# every change is written through to Cart/CartItem before its response: one upsert, UPDATE or DELETE under the
+# cart's lock, then the entry is stored. The cache only ever holds what the database has, an entry evicted under
+# memory pressure or lost with a cache restart is read back from the rows, no acknowledged change is lost.
+# Viewing a cart makes no database writes, the only query is the Product read (prices and names stay current).
+# An entry expires after settings.CART_STORE_TIMEOUT.
+# Needs a cache shared by the workers (redis, memcached), locmem is per process, fine for tests and a single worker.
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, transaction
+from rest_framework.exceptions import APIException, NotFound, ValidationError
+
+from orders.models import Cart, CartItem
+from products.models import Product
+
+CART_KEY = 'cart:{pk}'
+USER_KEY = 'cart:user:{pk}'
+LOCK_KEY = 'cart:lock:{pk}'
+
+LOCK_TIMEOUT = 10  # seconds, a crashed worker's lock expires
+LOCK_WAIT = 5
+
+
+class CartBusy(APIException):
+    status_code = 503
+    default_detail = 'The cart is being updated, try again.'
+    default_code = 'cart_busy'
+
+
+def enabled():
+    return getattr(settings, 'CART_STORE_ENABLED', False)
+
+
+def _timeout():
+    return getattr(settings, 'CART_STORE_TIMEOUT', 3 * 24 * 60 * 60)
+
+
+def _cart_id(cart_id):
+    try:
+        return Cart._meta.pk.to_python(cart_id)
+    except DjangoValidationError:
+        return None
+
+
+@contextmanager
+def _locked(cart_id):
+    """changes of one cart are serialized, cache.add is atomic on the shared backends"""
+    key = LOCK_KEY.format(pk=cart_id)
+    deadline = time.monotonic() + LOCK_WAIT
+    while not cache.add(key, 1, timeout=LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            raise CartBusy()
+        time.sleep(0.005)
+    try:
+        yield
+    finally:
+        cache.delete(key)
+
+
+def _from_db(cart_id):
+    entry = Cart.objects.filter(pk=cart_id).values('id', 'user_id', 'created_at').first()
+    if entry is None:
+        return None
+    items = CartItem.objects.filter(cart_id=cart_id).order_by('id').values_list('id', 'product_id', 'quantity')
+    entry['lines'] = {product_id: [item_id, quantity] for item_id, product_id, quantity in items}  # product -> [item, quantity]
+    return entry
+
+
+def _load(cart_id):
+    """the entry of a cart, read from the database on a miss, None for a cart that doesn't exist"""
+    key = CART_KEY.format(pk=cart_id)
+    entry = cache.get(key)
+    if entry is None:
+        entry = _from_db(cart_id)
+        if entry is not None:
+            cache.add(key, entry, timeout=_timeout())  # add: an entry stored meanwhile by a change wins
+    return entry
+
+
+def _store(entry):
+    """save an entry whose change is already written, called under the cart's lock"""
+    cache.set(CART_KEY.format(pk=entry['id']), entry, timeout=_timeout())
+
+
+def _gone(cart_id, message):
+    """the rows changed under the entry (cart expired or deleted meanwhile), drop it, the next read reloads"""
+    cache.delete(CART_KEY.format(pk=cart_id))
+    return NotFound(message)
+
+
+def _render(entry):
+    """a Cart with the annotations and prefetched items Cart.objects.with_totals().with_items() would give"""
+    products = Product.objects.in_bulk(entry['lines'].keys())
+    items = []
+    for product_id, (item_id, quantity) in sorted(entry['lines'].items(), key=lambda line: line[1][0]):
+        product = products.get(product_id)
+        if product is None:  # deleted, its row went with it (cascade)
+            continue
+        item = CartItem(pk=item_id, cart_id=entry['id'], product=product, quantity=quantity)
+        item.total_price = product.price * quantity
+        items.append(item)
+    cart = Cart(pk=entry['id'], user_id=entry['user_id'], created_at=entry['created_at'])
+    cart.total_price = sum((item.total_price for item in items), Decimal('0'))
+    cart.item_count = sum(item.quantity for item in items)
+    cart.line_count = len(items)
+    cart._prefetched_objects_cache = {'items': items}
+    return cart
+
+
+def get_cart(cart_id):
+    cart_id = _cart_id(cart_id)
+    entry = _load(cart_id) if cart_id else None
+    return _render(entry) if entry is not None else None
+
+
+def get_user_cart(user):
+    key = USER_KEY.format(pk=user.pk)
+    cart_id = cache.get(key)
+    if cart_id is None:
+        cart_id = Cart.objects.filter(user=user).values_list('pk', flat=True).first()
+        if cart_id is None:
+            return None
+        cache.set(key, cart_id, timeout=_timeout())
+    cart = get_cart(cart_id)
+    if cart is None or cart.user_id != user.pk:  # deleted since
+        cache.delete(key)
+        return None
+    return cart
+
+
+def create_cart(user):
+    """(cart, created), the cart of a user who already has one is served from the cache"""
+    cart = get_user_cart(user)
+    if cart is not None:
+        return cart, False
+    try:
+        with transaction.atomic():
+            cart, created = Cart.objects.get_or_create(user=user)
+    except IntegrityError:
+        # rare race: another request created it simultaneously
+        cart, created = Cart.objects.get(user=user), False
+    cache.set(USER_KEY.format(pk=user.pk), cart.pk, timeout=_timeout())
+    return get_cart(cart.pk), created
+
+
+def delete_cart(cart_id):
+    with _locked(cart_id):
+        Cart.objects.filter(pk=cart_id).delete()
+        cache.delete(CART_KEY.format(pk=cart_id))
+
+
+def evict(cart_ids):
+    """
+    drop the entries of carts deleted in the database (expire_carts). Each under its cart's lock:
+    a change that loaded the entry before the DELETE stores it before it's dropped, not after,
+    and the next change finds no row and answers 404.
+    """
+    keys = [CART_KEY.format(pk=cart_id) for cart_id in cart_ids]
+    if not enabled():  # nothing takes the locks
+        cache.delete_many(keys)
+        return
+    for cart_id, key in zip(cart_ids, keys):
+        try:
+            with _locked(cart_id):
+                cache.delete(key)
+        except CartBusy:  # held past LOCK_WAIT, a stuck worker, its entry has to go anyway
+            cache.delete(key)
+
+
+def get_items(cart_id):
+    cart = get_cart(cart_id)
+    return list(cart.items.all()) if cart is not None else []
+
+
+def get_item(cart_id, item_id):
+    for item in get_items(cart_id):
+        if str(item.pk) == str(item_id):
+            return item
+    return None
+
+
+def add_items(cart_id, items):
+    """CartService.add_items (one upsert) under the cart's lock, the entry takes the quantities it returns"""
+    from orders.services import CartService  # services imports this module
+
+    cart_id = _cart_id(cart_id)
+    if cart_id is None:
+        raise NotFound('Cart not found')
+    with _locked(cart_id):
+        entry = _load(cart_id)
+        if entry is None:
+            raise NotFound('Cart not found')
+        try:
+            saved = CartService.add_items(cart_id, items)  # validates the products, nothing is changed if one is missing
+        except NotFound:
+            raise _gone(cart_id, 'Cart not found')
+        for item in saved:
+            entry['lines'][item.product_id] = [item.pk, item.quantity]
+        _store(entry)
+        return saved
+
+
+def _find_line(entry, item_id):
+    for product_id, (line_item_id, _) in entry['lines'].items():
+        if str(line_item_id) == str(item_id):
+            return product_id
+    raise NotFound('Cart item not found')
+
+
+def set_quantity(cart_id, item_id, quantity):
+    cart_id = _cart_id(cart_id)
+    with _locked(cart_id):
+        entry = _load(cart_id) if cart_id else None
+        if entry is None:
+            raise NotFound('Cart not found')
+        product_id = _find_line(entry, item_id)
+        if not CartItem.objects.filter(pk=entry['lines'][product_id][0], cart_id=cart_id).update(quantity=quantity):
+            raise _gone(cart_id, 'Cart item not found')
+        entry['lines'][product_id][1] = quantity
+        _store(entry)
+        return CartItem(pk=entry['lines'][product_id][0], cart_id=cart_id, product_id=product_id, quantity=quantity)
+
+
+def remove_item(cart_id, item_id):
+    cart_id = _cart_id(cart_id)
+    with _locked(cart_id):
+        entry = _load(cart_id) if cart_id else None
+        if entry is None:
+            raise NotFound('Cart not found')
+        product_id = _find_line(entry, item_id)
+        CartItem.objects.filter(pk=entry['lines'].pop(product_id)[0], cart_id=cart_id).delete()
+        _store(entry)
+
+
+def update_items(cart_id, changes):
+    """CartService.update_items under the cart's lock, then the same changes on the entry"""
+    from orders.services import CartService  # services imports this module
+
+    cart_id = _cart_id(cart_id)
+    quantities = dict(changes)
+    with _locked(cart_id):
+        entry = _load(cart_id) if cart_id else None
+        if entry is None:
+            raise NotFound('Cart not found')
+        missing = [product_id for product_id in quantities if product_id not in entry['lines']]
+        if missing:
+            raise ValidationError({'product_id': [f"Product with id {product_id} is not in the cart" for product_id in missing]})
+        try:
+            CartService.update_items(cart_id, changes)
+        except (NotFound, ValidationError):  # the rows don't match the entry any more
+            cache.delete(CART_KEY.format(pk=cart_id))
+            raise
+        for product_id, quantity in quantities.items():
+            if quantity:
+                entry['lines'][product_id][1] = quantity
+            else:
+                entry['lines'].pop(product_id)
+        _store(entry)
+
+
+@contextmanager
+def checkout(cart_id):
+    """
+    held around the order transaction: the cart can't change until the order is saved,
+    so the order reads exactly the cart the user saw. Its entry is dropped afterwards, the rows are gone.
+    """
+    cart_id = _cart_id(cart_id)
+    if not enabled() or cart_id is None:
+        yield
+        return
+    with _locked(cart_id):
+        yield
+        cache.delete(CART_KEY.format(pk=cart_id))
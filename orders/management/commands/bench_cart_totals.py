@@ -0,0 +1,74 @@
+# python manage.py bench_cart_totals --lines 1 50 500
+# times a cart read with the totals summed in python (the old CartSerializer: quantity * price per prefetched item)
+# against Cart.objects.with_totals() (orders/models.py), where the database does the multiplication and the SUM.
+# everything runs inside a transaction that is rolled back at the end.
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from orders.models import Cart, CartItem
+from products.models import Category, Product
+from users.models import User
+
+
+class Rollback(Exception):
+    pass
+
+
+def python_totals(cart_id):
+    cart = Cart.objects.prefetch_related('items__product').get(pk=cart_id)
+    items = [(item.product.price * item.quantity, item.quantity) for item in cart.items.all()]
+    return sum(total for total, _ in items), sum(quantity for _, quantity in items), len(items)
+
+
+def database_totals(cart_id):
+    cart = Cart.objects.with_totals().get(pk=cart_id)
+    return cart.total_price, cart.item_count, cart.line_count
+
+
+class Command(BaseCommand):
+    help = 'Benchmark cart totals summed in python vs in the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, nargs='+', default=[1, 50, 500], help='Cart sizes to time')
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                category = Category.objects.create(name='bench')
+                Product.objects.bulk_create(
+                    (Product(name=f'bench {i}', description='', price=f'{i % 97 + 1}.99', stock=100, category=category)
+                     for i in range(max(options['lines']))),
+                    batch_size=2000,
+                )
+                products = list(Product.objects.filter(category=category).values_list('id', flat=True))
+                self.stdout.write(f'{connection.vendor}, {options["repeat"]} reads per size')
+                for size, lines in enumerate(options['lines']):
+                    user = User.objects.create(email=f'bench-cart-{size}@example.com', first_name='Bench')
+                    cart = Cart.objects.create(user=user)
+                    CartItem.objects.bulk_create(
+                        (CartItem(cart=cart, product_id=product_id, quantity=i % 5 + 1) for i, product_id in enumerate(products[:lines])),
+                        batch_size=2000,
+                    )
+                    if python_totals(cart.pk) != database_totals(cart.pk):
+                        raise AssertionError(f'totals differ for {lines} lines')
+                    python_ms = self.time(python_totals, cart.pk, options['repeat'])
+                    database_ms = self.time(database_totals, cart.pk, options['repeat'])
+                    self.stdout.write(
+                        f'{lines:>5} lines   python {python_ms:8.3f}ms   database {database_ms:8.3f}ms   '
+                        f'({python_ms / database_ms:.1f}x)'
+                    )
+                raise Rollback
+        except Rollback:
+            pass
+
+    def time(self, totals, cart_id, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            totals(cart_id)
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
@@ -0,0 +1,96 @@
+# python manage.py bench_copurchase --items 1000000 --products 20000
+# times CoPurchaseService.build (orders/recommendations.py) on synthetic orders: a full build, then an
+# incremental run after a few more orders, then the /related/ lookup.
+# everything runs inside a transaction that is rolled back at the end.
+import random
+import statistics
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from orders.models import Order, OrderItem
+from orders.recommendations import COUNTED_STATUSES, CoPurchaseService
+from products.models import Category, Product, ProductPairCount, RelatedProduct
+from users.models import User
+
+STATUSES = COUNTED_STATUSES * 3 + [Order.NOT_PAID, Order.CANCELED]  # most orders count
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the co-purchase build on synthetic orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=1000000, help='Order items to generate')
+        parser.add_argument('--products', type=int, default=20000)
+        parser.add_argument('--max-order-size', type=int, default=8)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        try:
+            with transaction.atomic():
+                products = self.seed_products(options['products'])
+                # most of the catalog sells rarely, a few products are in many baskets
+                weights = [1 / (rank + 1) for rank in range(len(products))]
+                user = User.objects.create(email='bench-copurchase@example.com', first_name='Bench')
+
+                items = self.seed_orders(rng, user, products, weights, options['items'], options['max_order_size'])
+                self.run('full build', items, full=True)
+                extra = self.seed_orders(rng, user, products, weights, max(1, options['items'] // 100), options['max_order_size'])
+                self.run('incremental', extra)
+                self.lookup(rng, products)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed_products(self, count):
+        category = Category.objects.create(name='bench')
+        Product.objects.bulk_create(
+            (Product(name=f'bench {i}', description='', price=10, stock=100, category=category) for i in range(count)),
+            batch_size=2000,
+        )
+        return list(Product.objects.filter(category=category).values_list('id', flat=True))
+
+    def seed_orders(self, rng, user, products, weights, item_count, max_size):
+        started = time.perf_counter()
+        created = 0
+        while created < item_count:
+            orders, items = [], []
+            while len(items) < 20000 and created + len(items) < item_count:
+                order = Order(user=user, status=rng.choice(STATUSES), total_price=0)
+                orders.append(order)
+                size = min(rng.randint(1, max_size), item_count - created - len(items))
+                for product_id in set(rng.choices(products, weights, k=size)):
+                    items.append(OrderItem(order=order, product_id=product_id, quantity=1, price=Decimal(10), total_price=Decimal(10)))
+            Order.objects.bulk_create(orders, batch_size=5000)
+            OrderItem.objects.bulk_create(items, batch_size=5000)
+            created += len(items)
+        self.stdout.write(f'seeded {created} order items in {time.perf_counter() - started:.1f}s ({connection.vendor})')
+        return created
+
+    def run(self, label, items, full=False):
+        started = time.perf_counter()
+        stats = CoPurchaseService.build(full=full)
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{label:<12} {elapsed:8.1f}s   {stats['added']} orders ({items / elapsed:,.0f} items/s), "
+            f"{stats['products']} products re-ranked, {ProductPairCount.objects.count()} pair rows, "
+            f"{RelatedProduct.objects.count()} related rows"
+        )
+
+    def lookup(self, rng, products):
+        timings = []
+        for product_id in rng.sample(products, min(200, len(products))):
+            started = time.perf_counter()
+            list(RelatedProduct.objects.filter(product_id=product_id).select_related('related'))
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        self.stdout.write(
+            f'related lookup mean {statistics.mean(timings):.2f}ms   p95 {timings[int(len(timings) * 0.95) - 1]:.2f}ms'
+        )
@@ -0,0 +1,28 @@
+# python manage.py build_copurchase [--full] [--top-k 10]
+# updates the co-purchase counts with the orders that reached READY_TO_SHIP (or were canceled) since the
+# last run and rebuilds the top-K related products of everything they touched, see orders/recommendations.py
+# meant for cron, eg. every 15 minutes, --full recounts every order from scratch.
+import time
+
+from django.core.management.base import BaseCommand
+
+from orders.recommendations import TOP_K, CoPurchaseService
+
+
+class Command(BaseCommand):
+    help = 'Build "frequently bought together" (ProductPairCount / RelatedProduct) from orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Recount every order, not only the new/canceled ones')
+        parser.add_argument('--top-k', type=int, default=TOP_K, help='Related products kept per product')
+        parser.add_argument('--batch-size', type=int, default=CoPurchaseService.order_batch_size, help='Orders per transaction')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        stats = CoPurchaseService.build(
+            full=options['full'], top_k=max(1, options['top_k']), order_batch_size=max(1, options['batch_size'])
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Added {stats['added']} orders, subtracted {stats['removed']}, "
+            f"rebuilt related products of {stats['products']} products in {time.perf_counter() - started:.1f}s"
+        ))
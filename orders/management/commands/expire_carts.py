@@ -0,0 +1,43 @@
+# python manage.py expire_carts [--days 30] [--batch-size 1000] [--max-batches N] [--before 2026-01-01T00:00:00Z]
+# deletes abandoned carts (and their items), the ones created more than settings.CART_TTL_DAYS ago,
+# see CartService.expire_carts in orders/services.py. meant for cron, eg. nightly.
+# every batch commits on its own, an interrupted or --max-batches run continues where it stopped when run again,
+# pass the printed --before to resume with the same cutoff.
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from orders.services import CartService
+
+
+class Command(BaseCommand):
+    help = 'Delete carts older than the cart TTL, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'CART_TTL_DAYS', 30), help='Cart TTL in days')
+        parser.add_argument('--before', help='Cutoff (ISO datetime) instead of now - days')
+        parser.add_argument('--batch-size', type=int, default=CartService.expire_batch_size, help='Carts per transaction')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches')
+
+    def handle(self, *args, **options):
+        if options['before']:
+            created_before = parse_datetime(options['before'])
+            if created_before is None:
+                raise CommandError(f"--before {options['before']!r} isn't an ISO datetime")
+            if timezone.is_naive(created_before):
+                created_before = timezone.make_aware(created_before)
+        else:
+            created_before = timezone.now() - datetime.timedelta(days=options['days'])
+
+        started = time.perf_counter()
+        stats = CartService.expire_carts(
+            created_before, batch_size=max(1, options['batch_size']), max_batches=options['max_batches']
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {stats['carts']} carts and {stats['items']} cart items created before "
+            f"{created_before.isoformat()} in {stats['batches']} batches, {time.perf_counter() - started:.1f}s"
+        ))
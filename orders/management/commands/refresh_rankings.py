@@ -0,0 +1,23 @@
+# python manage.py refresh_rankings [--full]
+# adds the orders that reached READY_TO_SHIP (or were canceled) since the last run to ProductRanking,
+# see orders/rankings.py. meant for cron, eg. every 10 minutes, --full recounts every order.
+import time
+
+from django.core.management.base import BaseCommand
+
+from orders.rankings import RankingService
+
+
+class Command(BaseCommand):
+    help = 'Refresh the bestselling / trending product rankings from orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Recount every order, not only the new/canceled ones')
+        parser.add_argument('--batch-size', type=int, default=RankingService.order_batch_size, help='Orders per transaction')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        stats = RankingService.refresh(full=options['full'], order_batch_size=max(1, options['batch_size']))
+        self.stdout.write(self.style.SUCCESS(
+            f"Added {stats['added']} orders, subtracted {stats['removed']} in {time.perf_counter() - started:.1f}s"
+        ))
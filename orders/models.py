@@ -1,15 +1,52 @@
+from decimal import Decimal
 from django.db import models
+from django.db.models import Count, ExpressionWrapper, F, Prefetch, Sum, Value
+from django.db.models.functions import Coalesce
 from django.core.validators import MinValueValidator
 from users.models import User
 from products.models import Product
 from uuid import uuid4  # Universally Unique Identifiers, uuid4 is a common choice as it generates random UUIDs
 
 
+def line_total_field():
+    return models.DecimalField(max_digits=12, decimal_places=2)  # same as OrderItem.total_price
+
+
+class CartQuerySet(models.QuerySet):
+    def with_totals(self):
+        """total_price, item_count (units) and line_count (products) summed by the database, one GROUP BY"""
+        return self.annotate(
+            total_price=Coalesce(
+                Sum(F('items__quantity') * F('items__product__price'), output_field=line_total_field()),
+                Value(Decimal('0')), output_field=line_total_field(),
+            ),
+            item_count=Coalesce(Sum('items__quantity'), 0),
+            line_count=Count('items'),
+        )
+
+    def with_items(self):
+        """items (with their product and line totals) in one more query"""
+        return self.prefetch_related(Prefetch('items', queryset=CartItem.objects.select_related('product').with_totals()))
+
+
+class CartItemQuerySet(models.QuerySet):
+    def with_totals(self):
+        """total_price = quantity * current product price, computed in the SELECT"""
+        return self.annotate(total_price=ExpressionWrapper(F('quantity') * F('product__price'), output_field=line_total_field()))
+
+
 class Cart(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid4, editable=False) # ---
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="cart")
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = CartQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='cart_created_idx'),  # expire_carts walks it oldest first
+        ]
+
     def __str__(self):
         return f"Cart of {self.user.first_name}"
 
@@ -19,6 +56,8 @@ class CartItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(validators=[MinValueValidator(1)])
 
+    objects = CartItemQuerySet.as_manager()
+
     class Meta:
         unique_together = [['cart', 'product']]
 
@@ -45,6 +84,26 @@ class Order(models.Model):
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # items are in ProductPairCount, see orders/recommendations.py
+    copurchase_counted = models.BooleanField(default=False, editable=False)
+    # items are in ProductRanking, see orders/rankings.py
+    ranking_counted = models.BooleanField(default=False, editable=False)
+    BUILD_FLAGS = {'copurchase_counted', 'ranking_counted'}
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['copurchase_counted', 'status'], name='order_copurchase_idx'),
+            models.Index(fields=['ranking_counted', 'status'], name='order_ranking_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # the flags belong to the batch builds, an instance loaded before a build must not reset them
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.BUILD_FLAGS
+            ]
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"Order {self.id} by {self.user.first_name} - {self.status}"
@@ -0,0 +1,141 @@
+# orders, rankings.py:
+# ProductRanking (bestselling / trending orderings of ProductViewSet), materialized from OrderItem + Order.created_at,
+# so a popularity ordering never has to SUM() over the order items per request.
+#  - units_sold:     SUM(quantity) over orders that reached READY_TO_SHIP or later
+#  - trending_score: SUM(quantity * 2 ** ((order.created_at - TRENDING_EPOCH) / half life)), "forward decay":
+#    the weight of an order is fixed when it is counted, older orders are worth less relative to newer ones,
+#    so new orders are only added. Changing the half life needs a --full refresh.
+#    The epoch (TrendingEpoch, one row) is moved to now by a --full refresh, and by any refresh once it is
+#    REBASE_HALF_LIVES behind: every stored score is divided by 2 ** (moved half lives), the order stays the same.
+# Incremental like orders/recommendations.py: Order.ranking_counted marks the orders already added,
+# a refresh adds the ones that reached a counted status since and subtracts the counted ones that were canceled.
+# python manage.py refresh_rankings [--full]
+import datetime
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from orders.models import Order, OrderItem
+from orders.recommendations import COUNTED_STATUSES
+from products.cache import invalidate_autocomplete, invalidate_catalog
+from products.models import Product, ProductRanking, TrendingEpoch
+
+# the epoch until the first rebase, the scores of earlier releases were weighted from it
+TRENDING_EPOCH = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+# 2 ** (elapsed half lives) overflows a float after ~1000 half lives, rebase long before that (~1.2 years at 7 days)
+REBASE_HALF_LIVES = 64
+
+
+def half_life():
+    return datetime.timedelta(days=getattr(settings, 'PRODUCT_TRENDING_HALF_LIFE_DAYS', 7))
+
+
+def trending_weight(created_at, epoch, half_life_seconds):
+    return 2 ** ((created_at - epoch).total_seconds() / half_life_seconds)
+
+
+def locked_epoch():
+    """the TrendingEpoch row, locked until the end of the transaction: a rebase and a batch never interleave"""
+    epoch = TrendingEpoch.objects.select_for_update().first()
+    if epoch is None:
+        epoch, _ = TrendingEpoch.objects.get_or_create(pk=1, defaults={'started_at': TRENDING_EPOCH})
+    return epoch
+
+
+class RankingService:
+    order_batch_size = 5000  # orders per transaction
+
+    @staticmethod
+    def refresh(full=False, order_batch_size=None):
+        """returns {'added', 'removed'}: orders added to / subtracted from the rankings"""
+        batch_size = order_batch_size or RankingService.order_batch_size
+        with transaction.atomic():
+            epoch = locked_epoch()
+            if full:
+                ProductRanking.objects.update(units_sold=0, trending_score=0)
+                Order.objects.filter(ranking_counted=True).update(ranking_counted=False)
+                epoch.started_at = timezone.now()
+                epoch.save(update_fields=['started_at'])
+            elif timezone.now() - epoch.started_at > half_life() * REBASE_HALF_LIVES:
+                RankingService.rebase(epoch, timezone.now())
+            RankingService.create_missing()
+
+        added = RankingService._count_orders(
+            Order.objects.filter(ranking_counted=False, status__in=COUNTED_STATUSES), 1, batch_size
+        )
+        removed = RankingService._count_orders(
+            Order.objects.filter(ranking_counted=True).exclude(status__in=COUNTED_STATUSES), -1, batch_size
+        )
+        if full or added or removed:
+            invalidate_catalog()  # cached bestselling/trending pages
+            invalidate_autocomplete()  # suggestions are ordered by units sold
+        return {'added': added, 'removed': removed}
+
+    @staticmethod
+    def rebase(epoch, started_at):
+        """moves the (locked) epoch forward, the stored scores are divided by the weight gained since the old one"""
+        factor = trending_weight(epoch.started_at, started_at, half_life().total_seconds())
+        ProductRanking.objects.exclude(trending_score=0).update(trending_score=F('trending_score') * factor)
+        epoch.started_at = started_at
+        epoch.save(update_fields=['started_at'])
+
+    @staticmethod
+    def create_missing():
+        """products/signals.py creates the row of a new product, this catches bulk inserts"""
+        missing = Product.objects.filter(ranking__isnull=True).values_list('pk', flat=True)
+        ProductRanking.objects.bulk_create(
+            (ProductRanking(product_id=pk) for pk in missing.iterator()), batch_size=2000, ignore_conflicts=True
+        )
+
+    @staticmethod
+    def _count_orders(orders, sign, batch_size):
+        half_life_seconds = half_life().total_seconds()
+        counted = 0
+        while True:
+            with transaction.atomic():
+                # locked until the flag is flipped, a concurrent refresh skips them, a status change waits
+                order_ids = list(
+                    orders.select_for_update(skip_locked=True).order_by().values_list('pk', flat=True)[:batch_size]
+                )
+                if not order_ids:
+                    return counted
+                epoch = locked_epoch().started_at
+                units, scores = defaultdict(int), defaultdict(float)
+                items = OrderItem.objects.filter(order_id__in=order_ids).values_list('product_id', 'quantity', 'order__created_at')
+                for product_id, quantity, created_at in items.iterator(chunk_size=5000):
+                    units[product_id] += sign * quantity
+                    scores[product_id] += sign * quantity * trending_weight(created_at, epoch, half_life_seconds)
+                RankingService._add(units, scores)
+                Order.objects.filter(pk__in=order_ids).update(ranking_counted=sign > 0)
+            counted += len(order_ids)
+
+    @staticmethod
+    def _add(units, scores):
+        rows = [(product_id, units[product_id], scores[product_id]) for product_id in units]
+        if not rows:
+            return
+        if connection.vendor not in ('postgresql', 'sqlite'):  # no UPDATE ... FROM, one statement per product
+            for product_id, units_sold, score in rows:
+                ProductRanking.objects.filter(product_id=product_id).update(
+                    units_sold=F('units_sold') + units_sold, trending_score=F('trending_score') + score
+                )
+            return
+
+        qn = connection.ops.quote_name
+        table = qn(ProductRanking._meta.db_table)
+        row_sql = '(CAST(%s AS bigint), CAST(%s AS integer), CAST(%s AS double precision))'
+        batch_size = connection.ops.bulk_batch_size(['product_id', 'units_sold', 'trending_score'], rows)
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                # same UPDATE ... FROM (VALUES ...) as ProductBulkUpdateService, the sums are added in the database
+                cursor.execute(
+                    f"WITH v (product_id, units, score) AS (VALUES {', '.join([row_sql] * len(batch))}) "
+                    f"UPDATE {table} SET {qn('units_sold')} = {table}.{qn('units_sold')} + v.units, "
+                    f"{qn('trending_score')} = {table}.{qn('trending_score')} + v.score "
+                    f"FROM v WHERE {table}.{qn('product_id')} = v.product_id",
+                    [value for row in batch for value in row],
+                )
@@ -0,0 +1,132 @@
+# orders, recommendations.py:
+# "frequently bought together", precomputed from OrderItem.
+#  - ProductPairCount: sparse product x product matrix, in how many counted orders two products were bought together
+#  - RelatedProduct: the top-K of each product, what /api/products/{id}/related/ reads
+# An order is counted once it reaches READY_TO_SHIP (or later), Order.copurchase_counted remembers that,
+# so a run only reads the orders that changed since the last one. A counted order that gets canceled is
+# subtracted again. Only the products touched by a run get their top-K recomputed.
+# python manage.py build_copurchase           (incremental)
+# python manage.py build_copurchase --full    (recount every order)
+import itertools
+from collections import Counter
+from operator import itemgetter
+
+from django.db import connection, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from orders.models import Order, OrderItem
+from products.models import ProductPairCount, RelatedProduct
+
+COUNTED_STATUSES = [Order.READY_TO_SHIP, Order.SHIPPED, Order.DELIVERED]
+TOP_K = 10
+MAX_ORDER_PRODUCTS = 100  # n products -> n*(n-1) pairs, a bulk order says little about "bought together"
+
+
+class CoPurchaseService:
+    order_batch_size = 2000  # orders per transaction
+    product_batch_size = 500  # products per top-K recompute
+
+    @staticmethod
+    def build(full=False, top_k=TOP_K, order_batch_size=None):
+        """returns {'added', 'removed', 'products'}: orders added/subtracted, products whose top-K was rebuilt"""
+        batch_size = order_batch_size or CoPurchaseService.order_batch_size
+        touched = set()
+        if full:
+            with transaction.atomic():
+                touched.update(RelatedProduct.objects.values_list('product_id', flat=True).distinct())
+                ProductPairCount.objects.all().delete()
+                Order.objects.filter(copurchase_counted=True).update(copurchase_counted=False)
+
+        added = CoPurchaseService._count_orders(
+            Order.objects.filter(copurchase_counted=False, status__in=COUNTED_STATUSES), 1, batch_size, touched
+        )
+        removed = CoPurchaseService._count_orders(
+            Order.objects.filter(copurchase_counted=True).exclude(status__in=COUNTED_STATUSES), -1, batch_size, touched
+        )
+        CoPurchaseService.rebuild_related(touched, top_k)
+        return {'added': added, 'removed': removed, 'products': len(touched)}
+
+    @staticmethod
+    def _count_orders(orders, sign, batch_size, touched):
+        counted = 0
+        while True:
+            with transaction.atomic():
+                # locked until the flag is flipped, a concurrent build skips them, a status change waits
+                order_ids = list(
+                    orders.select_for_update(skip_locked=True).order_by().values_list('pk', flat=True)[:batch_size]
+                )
+                if not order_ids:
+                    return counted
+                pairs = CoPurchaseService.count_pairs(order_ids, sign, touched)
+                CoPurchaseService._upsert_pairs(pairs)
+                Order.objects.filter(pk__in=order_ids).update(copurchase_counted=sign > 0)
+            counted += len(order_ids)
+
+    @staticmethod
+    def count_pairs(order_ids, sign, touched):
+        """(product, other) -> sign * number of these orders that had both, both directions"""
+        items = (
+            OrderItem.objects.filter(order_id__in=order_ids)
+            .order_by('order_id').values_list('order_id', 'product_id')
+        )
+        pairs = Counter()
+        for _, rows in itertools.groupby(items.iterator(chunk_size=5000), key=itemgetter(0)):
+            products = sorted({product_id for _, product_id in rows})
+            if len(products) < 2 or len(products) > MAX_ORDER_PRODUCTS:
+                continue
+            for pair in itertools.permutations(products, 2):
+                pairs[pair] += sign
+            touched.update(products)
+        return pairs
+
+    @staticmethod
+    def _upsert_pairs(pairs):
+        rows = [(product_id, other_id, count) for (product_id, other_id), count in pairs.items()]
+        if not rows:
+            return
+        if connection.vendor not in ('postgresql', 'sqlite'):  # no INSERT ... ON CONFLICT, one statement per pair
+            for product_id, other_id, count in rows:
+                updated = ProductPairCount.objects.filter(product_id=product_id, other_id=other_id).update(count=F('count') + count)
+                if not updated:
+                    ProductPairCount.objects.create(product_id=product_id, other_id=other_id, count=count)
+            return
+
+        qn = connection.ops.quote_name
+        table = qn(ProductPairCount._meta.db_table)
+        columns = ['product_id', 'other_id', 'count']
+        batch_size = connection.ops.bulk_batch_size(columns, rows)
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                # the increment happens in the database, no read-modify-write of the counts in python
+                cursor.execute(
+                    f"INSERT INTO {table} ({', '.join(qn(column) for column in columns)}) "
+                    f"VALUES {', '.join(['(%s, %s, %s)'] * len(batch))} "
+                    f"ON CONFLICT ({qn('product_id')}, {qn('other_id')}) "
+                    f"DO UPDATE SET {qn('count')} = {table}.{qn('count')} + EXCLUDED.{qn('count')}",
+                    [value for row in batch for value in row],
+                )
+
+    @staticmethod
+    def rebuild_related(product_ids, top_k=TOP_K):
+        """replace the RelatedProduct rows of these products with the top_k of their pair counts"""
+        product_ids = sorted(product_ids)
+        for start in range(0, len(product_ids), CoPurchaseService.product_batch_size):
+            batch = product_ids[start:start + CoPurchaseService.product_batch_size]
+            with transaction.atomic():
+                ProductPairCount.objects.filter(product_id__in=batch, count__lte=0).delete()  # left by canceled orders
+                ranked = (
+                    ProductPairCount.objects.filter(product_id__in=batch)
+                    .annotate(position=Window(
+                        RowNumber(), partition_by=[F('product_id')], order_by=[F('count').desc(), F('other_id').asc()]
+                    ))
+                    .filter(position__lte=top_k)
+                    .values_list('product_id', 'other_id', 'count', 'position')
+                )
+                related = [
+                    RelatedProduct(product_id=product_id, related_id=other_id, score=count, rank=position)
+                    for product_id, other_id, count, position in ranked
+                ]
+                RelatedProduct.objects.filter(product_id__in=batch).delete()
+                RelatedProduct.objects.bulk_create(related, batch_size=1000)
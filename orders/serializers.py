@@ -3,7 +3,8 @@ from rest_framework import serializers
 from orders.models import Cart, CartItem, Order, OrderItem
 from products.models import Product
 from products.serializers import ProductSerializer
-from orders.services import OrderService
+from orders import cart_store
+from orders.services import CartService, OrderService
 from users.models import User
 
 
@@ -25,27 +26,12 @@ class AddCartItemSerializer(serializers.ModelSerializer):
         fields = ['id', 'product_id', 'quantity']
 
     def save(self, **kwargs):
+        # one upsert statement, it also reports a product that doesn't exist, see orders/services.py CartService
         cart_id = self.context['cart_id']
-        product_id = self.validated_data['product_id']
-        quantity = self.validated_data['quantity']
-
-        try:
-            cart_item = CartItem.objects.get(cart_id=cart_id, product_id=product_id)                
-            cart_item.quantity += quantity
-            #self.instance = cart_item.save() # ---- .save() returns None
-            cart_item.save()
-            self.instance = cart_item
-        except CartItem.DoesNotExist:
-            self.instance = CartItem.objects.create(
-                cart_id=cart_id, **self.validated_data)
-
+        add_items = cart_store.add_items if cart_store.enabled() else CartService.add_items
+        self.instance = add_items(cart_id, [(self.validated_data['product_id'], self.validated_data['quantity'])])[0]
         return self.instance
 
-    def validate_product_id(self, value):
-        if not Product.objects.filter(pk=value).exists():
-            raise serializers.ValidationError(f"Product with id {value} does not exists")                
-        return value
-
 
 class UpdateCartItemSerializer(serializers.ModelSerializer):
     class Meta:
@@ -53,31 +39,33 @@ class UpdateCartItemSerializer(serializers.ModelSerializer):
         fields = ['quantity']
 
 
+class CartItemChangeSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=0, help_text="0 removes the product from the cart")
+
+
 class CartItemSerializer(serializers.ModelSerializer):
     product = SimpleProductSerializer()
-    total_price = serializers.SerializerMethodField(
-        method_name='get_total_price')
+    # annotated by CartItem.objects.with_totals(), quantity * price computed in the query
+    total_price = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
 
     class Meta:
         model = CartItem
         fields = ['id', 'product', 'quantity', 'product', 'total_price']
 
-    def get_total_price(self, cart_item: CartItem):
-        return cart_item.quantity * cart_item.product.price
-
 
 class CartSerializer(serializers.ModelSerializer):
     items = CartItemSerializer(many=True, read_only=True) # read_only, wont ask for items while creating Cart
-    total_price = serializers.SerializerMethodField(method_name='get_total_price')       
+    # annotated by Cart.objects.with_totals(), summed by the database
+    total_price = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
+    item_count = serializers.IntegerField(read_only=True, help_text="Units in the cart")
+    line_count = serializers.IntegerField(read_only=True, help_text="Distinct products in the cart")
 
     class Meta:
         model = Cart
-        fields = ['id', 'user', 'items', 'total_price']
+        fields = ['id', 'user', 'items', 'total_price', 'item_count', 'line_count']
         read_only_fields = ['user']
 
-    def get_total_price(self, cart: Cart):  # type mention
-        return sum([item.product.price * item.quantity for item in cart.items.all()])            
-
 
 class CreateOrderSerializer(serializers.Serializer): # not ModelSerializer
     cart_id = serializers.UUIDField()
@@ -1,27 +1,39 @@
+from decimal import Decimal
 from orders.models import Cart, CartItem, OrderItem, Order
-from django.db import transaction
-from rest_framework.exceptions import PermissionDenied, ValidationError
+from products.models import Product
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Sum, Window
+from rest_framework.exceptions import NotFound, PermissionDenied, ValidationError
 
 
 class OrderService:
     @staticmethod  # can use the function without creating class object
     def create_order(user_id, cart_id):
         # do whole task without error or retract, DRF’s default exception handler return 500 for failure, don't need a try...except, it handles the rollback for you automatically.
-        with transaction.atomic():            
+        from orders import cart_store  # it imports CartService
+
+        # with the cart store on, the cart is locked until the order is saved and its cache entry dropped after
+        with cart_store.checkout(cart_id), transaction.atomic():
             cart = Cart.objects.get(pk=cart_id)
-            cart_items = cart.items.select_related('product').all()
+            # line totals and the cart total computed by the database, in one query over one snapshot of the cart
+            lines = list(
+                cart.items.with_totals()
+                .annotate(cart_total=Window(Sum('total_price'), partition_by=[F('cart_id')]))
+                .values_list('product_id', 'product__price', 'quantity', 'total_price', 'cart_total')
+            )
 
-            total_price = sum([item.product.price * item.quantity for item in cart_items])
+            total_price = lines[0][4] if lines else Decimal('0')
             order = Order.objects.create(user_id=user_id, total_price=total_price)
             order_items = [
                 OrderItem(
                     order=order,
-                    product=item.product,
-                    price=item.product.price,
-                    quantity=item.quantity,
-                    total_price=item.product.price * item.quantity
+                    product_id=product_id,
+                    price=price,
+                    quantity=quantity,
+                    total_price=line_total
                 )
-                for item in cart_items
+                for product_id, price, quantity, line_total, _ in lines
             ]
             # [<OrderItem(1)>, <OrderItem(2)>]
             OrderItem.objects.bulk_create(order_items) # --- bulk_create , less db request
@@ -47,6 +59,143 @@ class OrderService:
         return order
 
 
+class CartService:
+    max_batch_items = 100
+    expire_batch_size = 1000  # carts per transaction
+
+    @staticmethod
+    def add_items(cart_id, items):
+        """
+        items: [(product_id, quantity)], adds the quantities to the cart (a product already there is incremented).
+        One INSERT ... ON CONFLICT (cart, product) DO UPDATE SET quantity = quantity + excluded.quantity
+        ... RETURNING, the increment happens in the database, so concurrent adds never lose one and never hit the
+        unique_together error. Rows are selected from the product and cart tables, a missing product is
+        reported as a ValidationError (nothing is added then), a missing cart as NotFound.
+        Returns the CartItems as saved, in the order the products were first given.
+        """
+        try:
+            cart_id = Cart._meta.pk.to_python(cart_id)
+        except DjangoValidationError:
+            raise NotFound('Cart not found')
+        quantities = {}
+        for product_id, quantity in items:  # one row per product, a statement can't update a row twice
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        if not quantities:
+            return []
+        with transaction.atomic():
+            if connection.vendor in ('postgresql', 'sqlite'):
+                rows = CartService._upsert(cart_id, quantities)
+            else:
+                rows = CartService._increment(cart_id, quantities)
+            missing = [product_id for product_id in quantities if product_id not in rows]
+            if missing and not Cart.objects.filter(pk=cart_id).exists():
+                raise NotFound('Cart not found')
+            if missing:  # rolls back what was added
+                raise ValidationError({'product_id': [f"Product with id {product_id} does not exists" for product_id in missing]})
+        return [
+            CartItem(id=rows[product_id][0], cart_id=cart_id, product_id=product_id, quantity=rows[product_id][1])
+            for product_id in quantities
+        ]
+
+    @staticmethod
+    def _upsert(cart_id, quantities):
+        qn = connection.ops.quote_name
+        table = qn(CartItem._meta.db_table)
+        product_table = qn(Product._meta.db_table)
+        cart_table = qn(Cart._meta.db_table)
+        cart_value = Cart._meta.pk.get_db_prep_value(cart_id, connection)
+        params = [value for row in quantities.items() for value in row]
+        # sqlite needs the WHERE in INSERT ... SELECT ... ON CONFLICT, a JOIN ... ON would be ambiguous
+        sql = (
+            f"WITH v (product_id, quantity) AS (VALUES {', '.join(['(CAST(%s AS bigint), CAST(%s AS integer))'] * len(quantities))}) "
+            f"INSERT INTO {table} ({qn('cart_id')}, {qn('product_id')}, {qn('quantity')}) "
+            f"SELECT c.{qn('id')}, p.{qn('id')}, v.quantity FROM v, {product_table} p, {cart_table} c "
+            f"WHERE p.{qn('id')} = v.product_id AND c.{qn('id')} = %s "
+            f"ON CONFLICT ({qn('cart_id')}, {qn('product_id')}) "
+            f"DO UPDATE SET {qn('quantity')} = {table}.{qn('quantity')} + EXCLUDED.{qn('quantity')} "
+            f"RETURNING {qn('id')}, {qn('product_id')}, {qn('quantity')}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + [cart_value])
+            return {product_id: (pk, quantity) for pk, product_id, quantity in cursor.fetchall()}
+
+    @staticmethod
+    def _increment(cart_id, quantities):
+        """backends without upsert: UPDATE ... quantity = quantity + n, INSERT when there was no row"""
+        if not Cart.objects.filter(pk=cart_id).exists():
+            return {}
+        existing = set(Product.objects.filter(pk__in=quantities).values_list('pk', flat=True))
+        rows = {}
+        for product_id in existing:
+            items = CartItem.objects.filter(cart_id=cart_id, product_id=product_id)
+            if not items.update(quantity=F('quantity') + quantities[product_id]):
+                try:
+                    with transaction.atomic():
+                        CartItem.objects.create(cart_id=cart_id, product_id=product_id, quantity=quantities[product_id])
+                except IntegrityError:  # added concurrently, increment that row
+                    items.update(quantity=F('quantity') + quantities[product_id])
+            rows[product_id] = items.values_list('id', 'quantity').get()
+        return rows
+
+    @staticmethod
+    def update_items(cart_id, changes):
+        """
+        changes: [(product_id, quantity)], sets the quantities, 0 removes the line (the last change of a product wins).
+        One transaction: the lines are locked, one bulk_update for the new quantities and one
+        DELETE ... WHERE product_id IN (...) for the removed lines. A product that isn't in the cart is reported as
+        a ValidationError (nothing is changed then), a missing cart as NotFound.
+        """
+        try:
+            cart_id = Cart._meta.pk.to_python(cart_id)
+        except DjangoValidationError:
+            raise NotFound('Cart not found')
+        quantities = dict(changes)
+        with transaction.atomic():
+            items = {
+                item.product_id: item
+                for item in CartItem.objects.select_for_update().filter(cart_id=cart_id, product_id__in=quantities).only('id', 'product_id')
+            }
+            missing = [product_id for product_id in quantities if product_id not in items]
+            if missing and not Cart.objects.filter(pk=cart_id).exists():
+                raise NotFound('Cart not found')
+            if missing:
+                raise ValidationError({'product_id': [f"Product with id {product_id} is not in the cart" for product_id in missing]})
+            updated = []
+            for product_id, quantity in quantities.items():
+                if quantity:
+                    items[product_id].quantity = quantity
+                    updated.append(items[product_id])
+            CartItem.objects.bulk_update(updated, ['quantity'])
+            removed = [product_id for product_id, quantity in quantities.items() if not quantity]
+            if removed:
+                CartItem.objects.filter(cart_id=cart_id, product_id__in=removed).delete()
+
+    @staticmethod
+    def expire_carts(created_before, batch_size=None, max_batches=None):
+        """
+        Deletes the carts created before created_before with their items, oldest first (Cart cart_created_idx),
+        batch_size carts per transaction so no lock is held for long. Every batch commits on its own,
+        an interrupted run is resumed by running it again. Returns {'carts', 'items', 'batches'}: rows deleted.
+        """
+        from orders import cart_store  # it imports CartService
+
+        batch_size = batch_size or CartService.expire_batch_size
+        stats = {'carts': 0, 'items': 0, 'batches': 0}
+        expired = Cart.objects.filter(created_at__lt=created_before).order_by('created_at', 'id')
+        while max_batches is None or stats['batches'] < max_batches:
+            with transaction.atomic():
+                # a cart being checked out is locked, it's skipped and its order deletes it anyway
+                cart_ids = list(expired.select_for_update(skip_locked=True).values_list('pk', flat=True)[:batch_size])
+                if not cart_ids:
+                    break
+                _, deleted = Cart.objects.filter(pk__in=cart_ids).delete()  # items go with them, one DELETE each
+            cart_store.evict(cart_ids)
+            stats['carts'] += deleted.get(Cart._meta.label, 0)
+            stats['items'] += deleted.get(CartItem._meta.label, 0)
+            stats['batches'] += 1
+        return stats
+
+
 """
 Transaction
 A       B
@@ -1,3 +1,559 @@
-from django.test import TestCase
+import json
+import threading
+from io import StringIO
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from orders import cart_store
+from orders.models import Cart, CartItem, Order, OrderItem
+from orders.rankings import REBASE_HALF_LIVES, RankingService, half_life
+from orders.recommendations import CoPurchaseService
+from orders.services import CartService
+from products.models import Category, Product, ProductPairCount, ProductRanking, RelatedProduct, TrendingEpoch
+from products.paginations import ProductKeysetPagination
+from users.models import User
 
-# Create your tests here.
+
+class CoPurchaseTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Kitchen')
+        cls.user = User.objects.create(email='buyer@example.com', first_name='Buyer')
+        cls.pan, cls.lid, cls.spatula, cls.oven = [
+            Product.objects.create(name=name, description=name, price=10, stock=100, category=category)
+            for name in ['pan', 'lid', 'spatula', 'oven']
+        ]
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def order(self, status, *products):
+        order = Order.objects.create(user=self.user, status=status, total_price=0)
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, product=product, quantity=1, price=Decimal(10), total_price=Decimal(10))
+            for product in products
+        )
+        return order
+
+    def related(self, product):
+        return [(row.related_id, row.score) for row in RelatedProduct.objects.filter(product=product)]
+
+    def test_build_counts_only_orders_ready_to_ship_or_later(self):
+        self.order(Order.READY_TO_SHIP, self.pan, self.lid, self.spatula)
+        self.order(Order.DELIVERED, self.pan, self.lid)
+        self.order(Order.NOT_PAID, self.pan, self.oven)
+        self.order(Order.CANCELED, self.pan, self.oven)
+
+        self.assertEqual(CoPurchaseService.build()['added'], 2)
+        self.assertEqual(self.related(self.pan), [(self.lid.pk, 2), (self.spatula.pk, 1)])
+        self.assertEqual(self.related(self.spatula), [(self.pan.pk, 1), (self.lid.pk, 1)])  # ties by id
+        self.assertEqual(self.related(self.oven), [])
+
+    def test_incremental_build_adds_new_orders_and_subtracts_canceled_ones(self):
+        first = self.order(Order.SHIPPED, self.pan, self.lid)
+        CoPurchaseService.build()
+        self.assertEqual(CoPurchaseService.build(), {'added': 0, 'removed': 0, 'products': 0})  # nothing new
+
+        paid = self.order(Order.NOT_PAID, self.pan, self.spatula)
+        paid.status = Order.READY_TO_SHIP
+        paid.save()
+        first.status = Order.CANCELED
+        first.save()
+        self.assertEqual(CoPurchaseService.build(), {'added': 1, 'removed': 1, 'products': 3})
+        self.assertEqual(self.related(self.pan), [(self.spatula.pk, 1)])
+        self.assertEqual(self.related(self.lid), [])
+        self.assertFalse(ProductPairCount.objects.filter(product=self.lid).exists())  # zero counts are dropped
+
+    def test_full_build_matches_incremental_and_keeps_top_k(self):
+        self.order(Order.DELIVERED, self.pan, self.lid, self.spatula, self.oven)
+        self.order(Order.DELIVERED, self.pan, self.lid, self.spatula)
+        self.order(Order.DELIVERED, self.pan, self.lid)
+        CoPurchaseService.build(top_k=2)
+        incremental = self.related(self.pan)
+        CoPurchaseService.build(full=True, top_k=2)
+        self.assertEqual(self.related(self.pan), incremental)
+        self.assertEqual(incremental, [(self.lid.pk, 3), (self.spatula.pk, 2)])
+
+    def test_related_endpoint_is_one_query(self):
+        self.order(Order.DELIVERED, self.pan, self.lid, self.spatula)
+        self.order(Order.DELIVERED, self.pan, self.lid)
+        CoPurchaseService.build()
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/products/{self.pan.pk}/related/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(row['id'], row['score'], row['rank']) for row in response.data], [(self.lid.pk, 2, 1), (self.spatula.pk, 1, 2)])
+        self.assertEqual(response.data[0]['name'], 'lid')
+        self.assertEqual(self.client.get('/api/products/abc/related/').status_code, 404)
+
+
+class RankingTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Garden')
+        cls.user = User.objects.create(email='gardener@example.com', first_name='Gardener')
+        cls.hose, cls.rake, cls.shovel = [
+            Product.objects.create(name=name, description=name, price=10, stock=100, category=category)
+            for name in ['hose', 'rake', 'shovel']
+        ]
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def order(self, status, days_ago, **quantities):
+        order = Order.objects.create(user=self.user, status=status, total_price=0)
+        Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(days=days_ago))
+        OrderItem.objects.bulk_create(
+            OrderItem(order=order, product=getattr(self, name), quantity=quantity, price=Decimal(10), total_price=Decimal(10) * quantity)
+            for name, quantity in quantities.items()
+        )
+        return order
+
+    def ordered(self, ordering):
+        response = self.client.get('/api/products/', {'ordering': ordering})
+        self.assertEqual(response.status_code, 200)
+        return [row['name'] for row in response.data['results']]
+
+    def test_bestselling_counts_units_and_trending_favours_recent_orders(self):
+        self.order(Order.DELIVERED, 60, rake=10)  # many, two months ago
+        self.order(Order.SHIPPED, 1, hose=3, rake=1)
+        self.order(Order.NOT_PAID, 0, shovel=50)
+
+        self.assertEqual(RankingService.refresh(), {'added': 2, 'removed': 0})
+        self.assertEqual(ProductRanking.objects.get(product=self.rake).units_sold, 11)
+        self.assertEqual(ProductRanking.objects.get(product=self.shovel).units_sold, 0)
+        self.assertEqual(self.ordered('bestselling'), ['rake', 'hose', 'shovel'])
+        self.assertEqual(self.ordered('trending'), ['hose', 'rake', 'shovel'])
+        self.assertEqual(self.ordered('-bestselling'), ['shovel', 'hose', 'rake'])
+
+    def test_incremental_refresh_only_reads_new_and_canceled_orders(self):
+        first = self.order(Order.READY_TO_SHIP, 2, hose=2)
+        RankingService.refresh()
+        self.assertEqual(RankingService.refresh(), {'added': 0, 'removed': 0})
+
+        self.order(Order.DELIVERED, 0, shovel=1)
+        first.refresh_from_db()
+        first.status = Order.CANCELED
+        first.save()
+        self.assertEqual(RankingService.refresh(), {'added': 1, 'removed': 1})
+        rankings = dict(ProductRanking.objects.values_list('product__name', 'units_sold'))
+        self.assertEqual(rankings, {'hose': 0, 'rake': 0, 'shovel': 1})
+        self.assertAlmostEqual(ProductRanking.objects.get(product=self.hose).trending_score, 0)
+
+        RankingService.refresh(full=True)
+        self.assertEqual(dict(ProductRanking.objects.values_list('product__name', 'units_sold')), rankings)
+
+    def test_refresh_changes_the_etag_of_ranked_lists(self):
+        RankingService.refresh()
+        etag = self.client.get('/api/products/', {'ordering': 'bestselling'})['ETag']
+        self.assertEqual(self.client.get('/api/products/', {'ordering': 'bestselling'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.order(Order.DELIVERED, 0, shovel=5)
+        with self.captureOnCommitCallbacks(execute=True):
+            RankingService.refresh()
+        response = self.client.get('/api/products/', {'ordering': 'bestselling'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['name'], 'shovel')
+
+    def test_keyset_pagination_walks_the_ranking(self):
+        self.order(Order.DELIVERED, 0, hose=3, rake=2, shovel=1)
+        RankingService.refresh()
+        names, url = [], '/api/products/?ordering=trending&pagination=cursor'
+        with mock.patch.object(ProductKeysetPagination, 'page_size', 2):
+            while url:
+                response = self.client.get(url)
+                names += [row['name'] for row in response.data['results']]
+                url = response.data['next']
+        self.assertEqual(names, ['hose', 'rake', 'shovel'])
+
+    def test_an_old_epoch_is_rebased_without_changing_the_ranking(self):
+        self.order(Order.DELIVERED, 20, rake=8)
+        self.order(Order.DELIVERED, 0, hose=3)
+        TrendingEpoch.objects.create(started_at=timezone.now() - half_life() * (REBASE_HALF_LIVES + 10))
+        with mock.patch('orders.rankings.REBASE_HALF_LIVES', 10 ** 6):
+            RankingService.refresh()  # counted from the old epoch, as before an upgrade
+        old_scores = dict(ProductRanking.objects.values_list('product__name', 'trending_score'))
+        self.assertGreater(old_scores['hose'], 2 ** REBASE_HALF_LIVES)
+
+        RankingService.refresh()
+        scores = dict(ProductRanking.objects.values_list('product__name', 'trending_score'))
+        self.assertLess(timezone.now() - TrendingEpoch.objects.get().started_at, timedelta(minutes=1))
+        self.assertAlmostEqual(scores['hose'], 3, places=3)  # an order of now weighs 1
+        self.assertAlmostEqual(scores['rake'] / scores['hose'], old_scores['rake'] / old_scores['hose'])
+        self.assertEqual(self.ordered('trending'), ['hose', 'rake', 'shovel'])
+
+        self.order(Order.DELIVERED, 0, shovel=4)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(RankingService.refresh(), {'added': 1, 'removed': 0})  # added with the new epoch
+        self.assertEqual(self.ordered('trending'), ['shovel', 'hose', 'rake'])
+
+    def test_full_refresh_moves_the_epoch_to_now(self):
+        started_at = timezone.now() - timedelta(days=30)
+        TrendingEpoch.objects.create(started_at=started_at)
+        self.order(Order.DELIVERED, 3, hose=1)
+        RankingService.refresh()
+        self.assertEqual(TrendingEpoch.objects.get().started_at, started_at)  # not far enough behind to rebase
+        RankingService.refresh(full=True)
+        self.assertLess(timezone.now() - TrendingEpoch.objects.get().started_at, timedelta(minutes=1))
+        self.assertAlmostEqual(ProductRanking.objects.get(product=self.hose).trending_score, 2 ** (-3 / 7), places=3)
+
+
+class CartUpsertTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Snacks')
+        cls.user = User.objects.create(email='shopper@example.com', first_name='Shopper')
+        cls.cart = Cart.objects.create(user=cls.user)
+        cls.chips, cls.nuts = [
+            Product.objects.create(name=name, description=name, price=3, stock=100, category=category)
+            for name in ['chips', 'nuts']
+        ]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = f'/api/carts/{self.cart.pk}/items/'
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity'))
+
+    def test_add_is_one_statement_and_increments(self):
+        with self.assertNumQueries(3):  # the upsert, inside SAVEPOINT / RELEASE (the test transaction)
+            response = self.client.post(self.url, {'product_id': self.chips.pk, 'quantity': 2})
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post(self.url, {'product_id': self.chips.pk, 'quantity': 3})
+        self.assertEqual(response.data['quantity'], 5)
+        self.assertEqual(self.quantities(), {self.chips.pk: 5})
+
+    def test_unknown_product_or_cart(self):
+        response = self.client.post(self.url, {'product_id': 999999, 'quantity': 1})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['product_id'], ['Product with id 999999 does not exists'])
+        response = self.client.post('/api/carts/00000000-0000-0000-0000-000000000000/items/', {'product_id': self.chips.pk, 'quantity': 1})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.post('/api/carts/nope/items/batch/', [], format='json').status_code, 404)
+
+    def test_batch_merges_rows_and_is_all_or_nothing(self):
+        rows = [{'product_id': self.chips.pk, 'quantity': 1}, {'product_id': self.nuts.pk, 'quantity': 2}, {'product_id': self.chips.pk, 'quantity': 4}]
+        response = self.client.post(self.url + 'batch/', rows, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(row['product_id'], row['quantity']) for row in response.data], [(self.chips.pk, 5), (self.nuts.pk, 2)])
+
+        rows = [{'product_id': self.nuts.pk, 'quantity': 1}, {'product_id': 999999, 'quantity': 1}]
+        self.assertEqual(self.client.post(self.url + 'batch/', rows, format='json').status_code, 400)
+        self.assertEqual(self.quantities(), {self.chips.pk: 5, self.nuts.pk: 2})
+        self.assertEqual(self.client.post(self.url + 'batch/', [{'product_id': self.nuts.pk, 'quantity': 0}], format='json').status_code, 400)
+
+    def test_batch_needs_the_owner(self):
+        other = APIClient()
+        other.force_authenticate(User.objects.create(email='other@example.com', first_name='Other'))
+        rows = [{'product_id': self.chips.pk, 'quantity': 1}]
+        for enabled in [False, True]:
+            cache.clear()
+            with self.settings(CART_STORE_ENABLED=enabled):
+                self.assertEqual(other.post(self.url + 'batch/', rows, format='json').status_code, 404)
+                self.assertEqual(APIClient().post(self.url + 'batch/', rows, format='json').status_code, 404)
+        self.assertEqual(self.quantities(), {})
+
+    def test_bulk_patch_updates_and_removes_in_one_transaction(self):
+        self.client.post(self.url + 'batch/', [{'product_id': self.chips.pk, 'quantity': 1}, {'product_id': self.nuts.pk, 'quantity': 1}], format='json')
+        changes = [{'product_id': self.chips.pk, 'quantity': 4}, {'product_id': self.nuts.pk, 'quantity': 0}]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(self.url, changes, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['total_price'], response.data['line_count']), (Decimal('12.00'), 1))
+        writes = [query['sql'].split()[0] for query in queries if query['sql'].startswith(('UPDATE', 'DELETE'))]
+        self.assertEqual(writes, ['UPDATE', 'DELETE'])
+        self.assertEqual(self.quantities(), {self.chips.pk: 4})
+
+        response = self.client.patch(self.url, [{'product_id': self.chips.pk, 'quantity': 0}, {'product_id': self.nuts.pk, 'quantity': 2}], format='json')
+        self.assertEqual(response.status_code, 400)  # nuts isn't in the cart any more, nothing is changed
+        self.assertEqual(self.quantities(), {self.chips.pk: 4})
+        self.assertEqual(self.client.patch('/api/carts/00000000-0000-0000-0000-000000000000/items/', [], format='json').status_code, 404)
+
+    def test_bulk_patch_needs_the_owner(self):
+        self.client.post(self.url + 'batch/', [{'product_id': self.chips.pk, 'quantity': 2}], format='json')
+        other = APIClient()
+        other.force_authenticate(User.objects.create(email='other@example.com', first_name='Other'))
+        for changes in [[{'product_id': self.chips.pk, 'quantity': 0}], []]:
+            for enabled in [False, True]:
+                cache.clear()
+                with self.settings(CART_STORE_ENABLED=enabled):
+                    self.assertEqual(other.patch(self.url, changes, format='json').status_code, 404)
+                    self.assertEqual(APIClient().patch(self.url, changes, format='json').status_code, 404)
+        self.assertEqual(self.quantities(), {self.chips.pk: 2})
+
+
+class CartTotalsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Snacks')
+        cls.user = User.objects.create(email='totals@example.com', first_name='Totals')
+        cls.cart = Cart.objects.create(user=cls.user)
+        cls.chips, cls.nuts = [
+            Product.objects.create(name=name, description=name, price=price, stock=100, category=category)
+            for name, price in [('chips', Decimal('2.50')), ('nuts', Decimal('4.25'))]
+        ]
+        CartItem.objects.create(cart=cls.cart, product=cls.chips, quantity=3)
+        CartItem.objects.create(cart=cls.cart, product=cls.nuts, quantity=2)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_cart_totals_come_from_the_query(self):
+        with self.assertNumQueries(2):  # the cart with its sums, the items with their line totals
+            response = self.client.get('/api/carts/my_cart/')
+        self.assertEqual(response.data['total_price'], Decimal('16.00'))
+        self.assertEqual((response.data['item_count'], response.data['line_count']), (5, 2))
+        self.assertEqual(sorted(item['total_price'] for item in response.data['items']), [Decimal('7.50'), Decimal('8.50')])
+
+        empty = Cart.objects.with_totals().get(pk=Cart.objects.create(user=User.objects.create(email='empty@example.com')).pk)
+        self.assertEqual((empty.total_price, empty.item_count, empty.line_count), (Decimal('0'), 0, 0))
+
+    def test_order_uses_database_totals(self):
+        response = self.client.post('/api/orders/', {'cart_id': str(self.cart.pk)})
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get(pk=response.data['id'])
+        self.assertEqual(order.total_price, Decimal('16.00'))
+        self.assertEqual(
+            sorted(order.items.values_list('product_id', 'price', 'quantity', 'total_price')),
+            sorted([(self.chips.pk, Decimal('2.50'), 3, Decimal('7.50')), (self.nuts.pk, Decimal('4.25'), 2, Decimal('8.50'))]),
+        )
+        self.assertFalse(Cart.objects.filter(pk=self.cart.pk).exists())
+
+
+@override_settings(CART_STORE_ENABLED=True)
+class CartStoreTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Snacks')
+        cls.user = User.objects.create(email='store@example.com', first_name='Store')
+        cls.chips, cls.nuts = [
+            Product.objects.create(name=name, description=name, price=price, stock=100, category=category)
+            for name, price in [('chips', Decimal('2.50')), ('nuts', Decimal('4.25'))]
+        ]
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cart_id = self.client.post('/api/carts/').data['id']
+        self.url = f'/api/carts/{self.cart_id}/items/'
+        self.chips_item = self.client.post(self.url, {'product_id': self.chips.pk, 'quantity': 1}).data['id']
+
+    def quantities(self):
+        return dict(CartItem.objects.filter(cart_id=self.cart_id).values_list('product_id', 'quantity'))
+
+    def test_browsing_makes_no_writes_and_changes_are_written_through(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.post('/api/carts/').status_code, 200)
+            response = self.client.get('/api/carts/my_cart/')
+        self.assertFalse([query['sql'] for query in queries if not query['sql'].startswith('SELECT')])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, {'product_id': self.chips.pk, 'quantity': 2})
+            self.client.patch(f'{self.url}{self.chips_item}/', {'quantity': 4})
+        writes = [query['sql'] for query in queries if not query['sql'].startswith(('SELECT', 'SAVEPOINT', 'RELEASE'))]
+        self.assertEqual(len(writes), 2)  # the upsert, the UPDATE, one statement per change
+        self.assertEqual(self.quantities(), {self.chips.pk: 4})  # before the responses, nothing is held back
+
+        response = self.client.get('/api/carts/my_cart/')
+        self.assertEqual((response.data['total_price'], response.data['item_count']), (Decimal('10.00'), 4))
+        cache.clear()  # evicted, or the cache restarted: read back from the rows, nothing lost
+        self.assertEqual(self.client.get('/api/carts/my_cart/').data, response.data)
+
+    def test_responses_match_the_database_path(self):
+        nuts_item = self.client.post(self.url, {'product_id': self.nuts.pk, 'quantity': 2}).data['id']
+        self.client.delete(f'{self.url}{self.chips_item}/')
+        cached = [self.client.get(url).data for url in ['/api/carts/my_cart/', self.url, f'{self.url}{nuts_item}/']]
+        self.assertEqual(self.client.get(f'{self.url}{self.chips_item}/').status_code, 404)
+        with self.settings(CART_STORE_ENABLED=False):
+            stored = [self.client.get(url).data for url in ['/api/carts/my_cart/', self.url, f'{self.url}{nuts_item}/']]
+        self.assertEqual(cached, stored)
+        self.assertEqual(cached[0]['line_count'], 1)
+
+        response = self.client.patch(self.url, [{'product_id': self.nuts.pk, 'quantity': 5}], format='json')
+        self.assertEqual((response.data['item_count'], self.quantities()[self.nuts.pk]), (5, 5))
+        self.client.post(self.url, {'product_id': self.chips.pk, 'quantity': 3})
+        self.assertEqual(self.quantities(), {self.nuts.pk: 5, self.chips.pk: 3})
+
+    def test_rows_changed_under_the_entry_are_reloaded(self):
+        CartItem.objects.filter(pk=self.chips_item).delete()  # eg. the database path, or an admin
+        self.assertEqual(self.client.patch(f'{self.url}{self.chips_item}/', {'quantity': 2}).status_code, 404)
+        self.assertEqual(self.client.get('/api/carts/my_cart/').data['line_count'], 0)
+
+    def test_checkout_sees_cached_changes(self):
+        self.client.post(self.url, {'product_id': self.nuts.pk, 'quantity': 2})
+        self.client.patch(f'{self.url}{self.chips_item}/', {'quantity': 3})
+        response = self.client.post('/api/orders/', {'cart_id': self.cart_id})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Order.objects.get(pk=response.data['id']).total_price, Decimal('16.00'))
+        self.assertEqual(self.client.get('/api/carts/my_cart/').status_code, 404)
+
+        cart_id = self.client.post('/api/carts/').data['id']
+        item = self.client.post(f'/api/carts/{cart_id}/items/', {'product_id': self.nuts.pk, 'quantity': 1}).data['id']
+        self.client.delete(f'/api/carts/{cart_id}/items/{item}/')
+        response = self.client.post('/api/orders/', {'cart_id': cart_id})  # emptied in the cache only
+        self.assertEqual(response.status_code, 400)
+
+    def test_expiry_evicts_after_a_change_in_progress(self):
+        Cart.objects.filter(pk=self.cart_id).update(created_at=timezone.now() - timedelta(days=40))
+        stale = cache.get(cart_store.CART_KEY.format(pk=self.cart_id))
+        loaded, stored = threading.Event(), threading.Event()
+
+        def change():  # loaded the entry before the DELETE, stores it while expire_carts waits for the lock
+            with cart_store._locked(self.cart_id):
+                loaded.set()
+                stored.wait(1)
+                cache.set(cart_store.CART_KEY.format(pk=self.cart_id), stale)
+
+        worker = threading.Thread(target=change)
+        worker.start()
+        loaded.wait(1)
+        with mock.patch.object(cart_store, '_locked', wraps=cart_store._locked) as locked:
+            stored.set()
+            self.assertEqual(CartService.expire_carts(timezone.now() - timedelta(days=30))['carts'], 1)
+        worker.join()
+        self.assertEqual([str(args[0]) for args, _ in locked.call_args_list], [self.cart_id])
+        self.assertIsNone(cache.get(cart_store.CART_KEY.format(pk=self.cart_id)))
+        self.assertEqual(self.client.post(self.url, {'product_id': self.nuts.pk, 'quantity': 1}).status_code, 404)
+
+
+
+class CartExpiryTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Snacks')
+        products = [Product.objects.create(name=name, description=name, price=3, stock=100, category=category) for name in ['chips', 'nuts']]
+        users = User.objects.bulk_create(User(email=f'cart{i}@example.com') for i in range(255))
+        carts = Cart.objects.bulk_create(Cart(user=user) for user in users)
+        CartItem.objects.bulk_create(CartItem(cart=cart, product=product, quantity=1) for cart in carts for product in products)
+        # created_at is auto_now_add, 250 abandoned carts a few weeks old, 5 recent ones
+        for days, cart in enumerate(carts[:250]):
+            Cart.objects.filter(pk=cart.pk).update(created_at=timezone.now() - timedelta(days=40 + days))
+        cls.fresh = {cart.pk for cart in carts[250:]}
+
+    def expire(self, *args):
+        out = StringIO()
+        call_command('expire_carts', '--days', '30', '--batch-size', '100', *args, stdout=out)
+        return out.getvalue()
+
+    def test_batched_and_resumable(self):
+        before = (timezone.now() - timedelta(days=30)).isoformat()
+        with CaptureQueriesContext(connection) as queries:
+            output = self.expire('--max-batches', '2', '--before', before)
+        self.assertIn('Deleted 200 carts and 400 cart items', output)
+        self.assertIn('in 2 batches', output)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('DELETE') and 'orders_cart"' in query['sql']]), 2)
+        self.assertEqual(Cart.objects.count(), 55)
+        # the oldest went first
+        self.assertEqual(Cart.objects.order_by('created_at').first().created_at.date(), (timezone.now() - timedelta(days=89)).date())
+
+        self.assertIn('Deleted 50 carts and 100 cart items', self.expire('--before', before))  # resumed
+        self.assertEqual(set(Cart.objects.values_list('pk', flat=True)), self.fresh)
+        self.assertEqual(CartItem.objects.count(), 10)
+        self.assertIn('Deleted 0 carts and 0 cart items', self.expire())
+
+
+class OrderExportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Snacks')
+        cls.chips = Product.objects.create(name='Chips, "salted"', description='c', price=2, stock=9, category=category)
+        cls.admin = User.objects.create(email='admin@example.com', is_staff=True)
+        cls.user = User.objects.create(email='buyer@example.com')
+        cls.orders = [Order.objects.create(user=cls.user, total_price=quantity * 2) for quantity in (1, 0, 3)]
+        for order, quantity in zip(cls.orders, (1, 0, 3)):
+            if quantity:
+                OrderItem.objects.create(order=order, product=cls.chips, quantity=quantity, price=2, total_price=quantity * 2)
+        OrderItem.objects.create(order=cls.orders[2], product=cls.chips, quantity=1, price=2, total_price=2)
+        moments = [timezone.make_aware(timezone.datetime(2025, 1, day, 12)) for day in (5, 10, 20)]
+        for order, moment in zip(cls.orders, moments):
+            Order.objects.filter(pk=order.pk).update(created_at=moment)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def export(self, **params):
+        response = self.client.get('/api/orders/export/', params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_rows_are_quoted_and_one_per_item(self):
+        with self.assertNumQueries(1):  # one values_list() iterator, no per-row queries
+            lines = self.export().splitlines()
+        self.assertEqual(lines[0].split(',')[:4], ['order_id', 'user_id', 'user_email', 'status'])
+        self.assertEqual(len(lines), 1 + 4)  # 1 + 0 (one empty row) + 2 items
+        self.assertIn('"Chips, ""salted"""', lines[1])
+        self.assertIn('2025-01-05T12:00:00Z', lines[1])
+        self.assertTrue(lines[2].endswith(',,,,,'))  # order without items
+
+    def test_ndjson_groups_items_per_order(self):
+        with self.assertNumQueries(1):
+            orders = [json.loads(line) for line in self.export(output='ndjson').splitlines()]
+        self.assertEqual([order['order_id'] for order in orders], [str(order.pk) for order in self.orders])
+        self.assertEqual([len(order['items']) for order in orders], [1, 0, 2])
+        self.assertEqual(orders[0]['created_at'], '2025-01-05T12:00:00Z')  # same format as the csv
+        self.assertEqual(orders[2]['items'][0]['product_name'], 'Chips, "salted"')
+
+    def test_date_range_and_validation(self):
+        orders = [json.loads(line) for line in self.export(output='ndjson', since='2025-01-06', until='2025-01-10').splitlines()]
+        self.assertEqual([order['order_id'] for order in orders], [str(self.orders[1].pk)])  # a date only until includes the day
+        self.assertEqual(self.export(output='ndjson', date_field='updated_at', until='2025-01-10'), '')
+        self.assertEqual(len(self.export(output='ndjson', since='2025-01-10T12:00:00Z', until='2025-01-20T12:00:00Z').splitlines()), 2)
+        for params in [{'since': 'yesterday'}, {'until': '2025-02-30'}, {'date_field': 'total_price'}, {'output': 'xml'}]:
+            self.assertEqual(self.client.get('/api/orders/export/', params).status_code, 400, params)
+
+    def test_admin_only(self):
+        client = APIClient()
+        self.assertEqual(client.get('/api/orders/export/').status_code, 403)
+        client.force_authenticate(self.user)
+        self.assertEqual(client.get('/api/orders/export/').status_code, 403)
+
+
+class CartUpsertConcurrencyTest(TransactionTestCase):
+    threads = 8
+    adds_per_thread = 25
+
+    def add_with_retry(self, cart_id, product_id):
+        # the in-memory sqlite test database (shared cache) has no busy timeout, a write that finds the table
+        # locked fails whole and is rolled back, retry it. postgres waits on the row lock instead.
+        while True:
+            try:
+                return CartService.add_items(cart_id, [(product_id, 1)])
+            except OperationalError as exc:
+                if connection.vendor != 'sqlite' or 'locked' not in str(exc):
+                    raise
+
+    def test_concurrent_adds_lose_no_increment(self):
+        category = Category.objects.create(name='Snacks')
+        cart = Cart.objects.create(user=User.objects.create(email='race@example.com', first_name='Race'))
+        product = Product.objects.create(name='chips', description='', price=3, stock=100, category=category)
+        start = threading.Barrier(self.threads)
+        errors = []
+
+        def add():
+            try:
+                start.wait()  # every thread's first add hits the missing row at the same time
+                for _ in range(self.adds_per_thread):
+                    self.add_with_retry(cart.pk, product.pk)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=add) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(CartItem.objects.get(cart=cart, product=product).quantity, self.threads * self.adds_per_thread)
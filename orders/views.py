@@ -4,16 +4,23 @@ from rest_framework.mixins import CreateModelMixin, RetrieveModelMixin, DestroyM
 from rest_framework.viewsets import GenericViewSet, ModelViewSet
 from rest_framework.views import APIView
 from orders import serializers as orderSz
-from orders.serializers import CartSerializer, CartItemSerializer, AddCartItemSerializer, UpdateCartItemSerializer
+from orders.serializers import CartSerializer, CartItemSerializer, CartItemChangeSerializer, AddCartItemSerializer, UpdateCartItemSerializer
 from orders.models import Cart, CartItem, Order, OrderItem
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.decorators import action
-from orders.services import OrderService
+from orders import cart_store
+from orders.services import CartService, OrderService
+from api.conditional import ConditionalGetMixin
+from api.db_router import ReplicaReadMixin
+from api.streaming import EXPORT_PARAMETERS, parse_export_params, streaming_csv_response, streaming_json_response
+from drf_yasg.utils import swagger_auto_schema
+from itertools import groupby
 from rest_framework.response import Response
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.db import IntegrityError, transaction
 from rest_framework import status
 from rest_framework.decorators import api_view
-from django.http import JsonResponse, HttpResponseRedirect
+from django.http import Http404, JsonResponse, HttpResponseRedirect
 
 from django.conf import settings as main_settings  # Aliasing for clarity
 from sslcommerz_lib import SSLCOMMERZ 
@@ -23,6 +30,16 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+EXPORT_CHUNK_SIZE = 2000
+ORDER_EXPORT_COLUMNS = [  # (header, values_list field), one row per order item, order columns repeated
+    ('order_id', 'id'), ('user_id', 'user_id'), ('user_email', 'user__email'), ('status', 'status'),
+    ('order_total', 'total_price'), ('created_at', 'created_at'), ('updated_at', 'updated_at'),
+]
+ORDER_ITEM_EXPORT_COLUMNS = [
+    ('item_id', 'items__id'), ('product_id', 'items__product_id'), ('product_name', 'items__product__name'),
+    ('quantity', 'items__quantity'), ('price', 'items__price'), ('total_price', 'items__total_price'),
+]
+
 
 
 class CartViewSet(CreateModelMixin, ListModelMixin, RetrieveModelMixin, DestroyModelMixin, GenericViewSet): # not ModelViewSet, not showing all carts list
@@ -35,14 +52,36 @@ class CartViewSet(CreateModelMixin, ListModelMixin, RetrieveModelMixin, DestroyM
     def get_queryset(self):
         if getattr(self, 'swagger_fake_view', False):  # if AnonymousUser
             return Cart.objects.none()
-        return Cart.objects.prefetch_related('items__product').filter(user=self.request.user)  # prefetch_related used
-    
-    def get_queryset(self):
-        if getattr(self, 'swagger_fake_view', False):
-            return Cart.objects.none()
-        return Cart.objects.prefetch_related('items__product').filter(user=self.request.user)
+        # totals summed by the database, items with their line totals prefetched
+        return Cart.objects.with_totals().with_items().filter(user=self.request.user)
+
+    def list(self, request, *args, **kwargs):
+        if not cart_store.enabled():
+            return super().list(request, *args, **kwargs)
+        cart = cart_store.get_user_cart(request.user)
+        page = self.paginate_queryset([cart] if cart is not None else [])
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+    def get_object(self):
+        if not cart_store.enabled():
+            return super().get_object()
+        cart = cart_store.get_cart(self.kwargs['pk'])
+        if cart is None or cart.user_id != self.request.user.pk:
+            raise Http404('No Cart matches the given query.')
+        self.check_object_permissions(self.request, cart)
+        return cart
+
+    def perform_destroy(self, instance):
+        if cart_store.enabled():
+            cart_store.delete_cart(instance.pk)
+        else:
+            instance.delete()
 
     def create(self, request, *args, **kwargs):
+        if cart_store.enabled():  # an existing cart is answered from the cache, see orders/cart_store.py
+            cart, created = cart_store.create_cart(request.user)
+            serializer = self.get_serializer(cart)
+            return Response(serializer.data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
         # Use transaction + handle IntegrityError for safety against race conditions
         try:
             with transaction.atomic():
@@ -52,15 +91,18 @@ class CartViewSet(CreateModelMixin, ListModelMixin, RetrieveModelMixin, DestroyM
             cart = Cart.objects.get(user=request.user)
             created = False
 
-        serializer = self.get_serializer(cart)
+        serializer = self.get_serializer(self.get_queryset().get(pk=cart.pk))  # with the totals
         if created:
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.data, status=status.HTTP_200_OK)
     
     @action(detail=False, methods=['get'])  # creates a GET /carts/my_cart/ endpoint that returns the current user's cart.
     def my_cart(self, request):
+        if cart_store.enabled():
+            cart = cart_store.get_user_cart(request.user)
+            return Response(self.get_serializer(cart).data) if cart is not None else Response(status=404)
         try:
-            cart = Cart.objects.get(user=request.user)
+            cart = self.get_queryset().get()
             serializer = self.get_serializer(cart)
             return Response(serializer.data)
         except Cart.DoesNotExist:
@@ -87,11 +129,98 @@ class CartItemViewSet(ModelViewSet):
         return {'cart_id': self.kwargs.get('cart_pk')}
 
     def get_queryset(self):
-        return CartItem.objects.select_related('product').filter(cart_id=self.kwargs.get('cart_pk'))  # select_related for forward ForeignKey or OneToOneField
+        return CartItem.objects.select_related('product').with_totals().filter(cart_id=self.kwargs.get('cart_pk'))  # select_related for forward ForeignKey or OneToOneField
+
+    def list(self, request, *args, **kwargs):
+        if not cart_store.enabled():
+            return super().list(request, *args, **kwargs)
+        page = self.paginate_queryset(cart_store.get_items(self.kwargs.get('cart_pk')))
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+    def get_object(self):
+        if not cart_store.enabled():
+            return super().get_object()
+        item = cart_store.get_item(self.kwargs.get('cart_pk'), self.kwargs['pk'])
+        if item is None:
+            raise Http404('No CartItem matches the given query.')
+        self.check_object_permissions(self.request, item)
+        return item
+
+    def perform_update(self, serializer):
+        if not cart_store.enabled():
+            return serializer.save()
+        quantity = serializer.validated_data.get('quantity', serializer.instance.quantity)
+        serializer.instance = cart_store.set_quantity(self.kwargs.get('cart_pk'), serializer.instance.pk, quantity)
+
+    def check_cart_owner(self, cart_pk):
+        """the bulk routes change the whole cart, a cart of someone else is a 404 as in CartViewSet"""
+        user = self.request.user
+        if cart_store.enabled():
+            cart = cart_store.get_cart(cart_pk)
+            owned = cart is not None and cart.user_id == user.pk
+        else:
+            try:
+                owned = user.is_authenticated and Cart.objects.filter(pk=cart_pk, user=user).exists()
+            except DjangoValidationError:  # not a UUID
+                owned = False
+        if not owned:
+            raise Http404('No Cart matches the given query.')
+
+    def perform_destroy(self, instance):
+        if cart_store.enabled():
+            cart_store.remove_item(self.kwargs.get('cart_pk'), instance.pk)
+        else:
+            instance.delete()
+
+    @swagger_auto_schema(
+        operation_summary='Change many cart items at once',
+        operation_description="Body: [{\"product_id\": 1, \"quantity\": 3}, ...], quantity 0 removes the product, all are applied or none. Returns the cart",
+        request_body=CartItemChangeSerializer(many=True),
+        responses={200: CartSerializer},
+    )
+    def bulk_update(self, request, cart_pk=None):  # PATCH http://127.0.0.1:8000/api/carts/<cart_id>/items/, routed by api/routers.py
+        if not isinstance(request.data, list):
+            return Response({'detail': 'Expected a list of {product_id, quantity} rows'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(request.data) > CartService.max_batch_items:
+            return Response({'detail': f'At most {CartService.max_batch_items} rows per request'}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = CartItemChangeSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        self.check_cart_owner(cart_pk)
+        changes = [(row['product_id'], row['quantity']) for row in serializer.validated_data]
+        if cart_store.enabled():
+            cart_store.update_items(cart_pk, changes)
+            cart = cart_store.get_cart(cart_pk)
+        else:
+            CartService.update_items(cart_pk, changes)
+            cart = Cart.objects.with_totals().with_items().filter(pk=cart_pk).first()
+        if cart is None:  # deleted since the owner check
+            raise Http404('No Cart matches the given query.')
+        return Response(CartSerializer(cart).data)
+
+    @swagger_auto_schema(
+        operation_summary='Add many products to the cart at once',
+        operation_description="Body: [{\"product_id\": 1, \"quantity\": 2}, ...], one upsert for all rows, all are added or none",
+        request_body=AddCartItemSerializer(many=True),
+        responses={200: AddCartItemSerializer(many=True)},
+    )
+    @action(detail=False, methods=['post'])
+    def batch(self, request, cart_pk=None):  # http://127.0.0.1:8000/api/carts/<cart_id>/items/batch/
+        if not isinstance(request.data, list):
+            return Response({'detail': 'Expected a list of {product_id, quantity} rows'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(request.data) > CartService.max_batch_items:
+            return Response({'detail': f'At most {CartService.max_batch_items} rows per request'}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = AddCartItemSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        self.check_cart_owner(cart_pk)
+        add_items = cart_store.add_items if cart_store.enabled() else CartService.add_items
+        items = add_items(cart_pk, [(row['product_id'], row['quantity']) for row in serializer.validated_data])
+        return Response(AddCartItemSerializer(items, many=True).data)
 
 
-class OrderViewset(ModelViewSet):
+class OrderViewset(ReplicaReadMixin, ConditionalGetMixin, ModelViewSet):
     http_method_names = ['get', 'post', 'delete', 'patch', 'head', 'options']
+    conditional_vary_on_user = True  # ETag/Last-Modified, api/conditional.py
+    replica_actions = ['list']  # order history from the replica, api/db_router.py, placing/cancelling pins the user to the primary
 
     @action(detail=True, methods=['post'])  # actions: https://www.django-rest-framework.org/api-guide/viewsets/#viewset-actions     
     def cancel(self, request, pk=None): # http://127.0.0.1:8000/api/orders/cfefff26-a539-4e91-918b-9caf5895d498/cancel
@@ -107,8 +236,38 @@ class OrderViewset(ModelViewSet):
         serializer.save()  # commits changes to the database
         return Response({'status': f"Order status updated to {request.data['status']}"})
 
+    @swagger_auto_schema(operation_summary='Export orders with their items as CSV or NDJSON (admin)', manual_parameters=EXPORT_PARAMETERS)
+    @action(detail=False, methods=['get'])
+    def export(self, request): # http://127.0.0.1:8000/api/orders/export/?output=ndjson&since=2025-01-01
+        """
+        One values_list() query, orders LEFT JOIN items, read with .iterator(), no model instances.
+        csv: one row per item (an order without items is one row with empty item columns)
+        ndjson: one object per order with an "items" list
+        """
+        output, date_range = parse_export_params(request)
+        order_header = [header for header, _ in ORDER_EXPORT_COLUMNS]
+        item_header = [header for header, _ in ORDER_ITEM_EXPORT_COLUMNS]
+        rows = (
+            Order.objects.filter(**date_range).order_by('created_at', 'id', 'items__id')
+            .values_list(*[field for _, field in ORDER_EXPORT_COLUMNS + ORDER_ITEM_EXPORT_COLUMNS])
+            .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        )
+        if output == 'csv':
+            return streaming_csv_response(order_header + item_header, rows, 'orders.csv')
+
+        def orders():  # rows of one order are adjacent, ordered by order
+            width = len(order_header)
+            for _, order_rows in groupby(rows, key=lambda row: row[0]):
+                first = next(order_rows)
+                items = [first, *order_rows] if first[width] is not None else []
+                order = dict(zip(order_header, first[:width]))
+                order['items'] = [dict(zip(item_header, row[width:])) for row in items]
+                yield order
+
+        return streaming_json_response(orders(), 'ndjson', 'orders.ndjson')
+
     def get_permissions(self):
-        if self.action in ['update_status', 'destroy']:
+        if self.action in ['update_status', 'destroy', 'export']:
             return [IsAdminUser()]
         return [IsAuthenticated()]
 
@@ -142,6 +142,51 @@ DATABASES = {
     }
 }
 
+# read replica (optional), safe catalog/order-history reads go there, see api/db_router.py.
+# set replica_host to enable it, replica_dbname/replica_user/replica_password/replica_port default to the primary's
+if config('replica_host', default=''):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': config('replica_dbname', default=DATABASES['default']['NAME']),
+        'USER': config('replica_user', default=DATABASES['default']['USER']),
+        'PASSWORD': config('replica_password', default=DATABASES['default']['PASSWORD']),
+        'HOST': config('replica_host'),
+        'PORT': config('replica_port', default=DATABASES['default']['PORT']),
+        'TEST': {'MIRROR': 'default'},  # tests read the primary's test database through this alias
+    }
+
+"""
+# local try out with two sqlite files (migrate, then copy db.sqlite3 to db_replica.sqlite3 to "replicate"):
+DATABASES = {
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db.sqlite3'},
+    'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': BASE_DIR / 'db_replica.sqlite3', 'TEST': {'MIRROR': 'default'}},
+}
+"""
+
+DATABASE_ROUTERS = ['api.db_router.ReplicaRouter']
+REPLICA_DATABASE = 'replica'  # alias of the replica, routing is off while it isn't in DATABASES
+REPLICA_PIN_SECONDS = config('REPLICA_PIN_SECONDS', default=10, cast=int)  # reads stay on the primary this long after a user's write
+
+
+# cache, locmem by default (per process), set CACHE_BACKEND/CACHE_LOCATION to a shared backend in production
+# eg. CACHE_BACKEND=django.core.cache.backends.redis.RedisCache, CACHE_LOCATION=redis://127.0.0.1:6379
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='phimart'),
+    }
+}
+
+CATALOG_CACHE_TIMEOUT = config('CATALOG_CACHE_TIMEOUT', default=300, cast=int)  # seconds, products/cache.py
+PRODUCT_PRICE_FACET_EDGES = [0, 25, 50, 100, 250, 500, 1000]  # price buckets of /api/products/facets/, ?price_edges= overrides
+PRODUCT_TRENDING_HALF_LIFE_DAYS = 7  # ?ordering=trending, an order counts half as much after this, see orders/rankings.py
+PRODUCT_AUTOCOMPLETE_MAX_PRODUCTS = 50000  # most popular products kept in the per worker autocomplete index, products/autocomplete.py
+
+# carts read from the cache, changes written through to Cart/CartItem, orders/cart_store.py. Needs a cache shared by the workers
+CART_STORE_ENABLED = config('CART_STORE_ENABLED', default=False, cast=bool)
+CART_STORE_TIMEOUT = 3 * 24 * 60 * 60  # seconds an idle cart stays in the cache
+CART_TTL_DAYS = 30  # python manage.py expire_carts deletes carts created longer ago than this
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -335,6 +380,10 @@ cloudinary.config(
     secure=True
 )
 DEFAULT_FILE_STORAGE = 'cloudinary_storage.storage.MediaCloudinaryStorage'
+# where ProductImage uploads and their thumbnail/card/zoom derivatives go, products/image_backends.py
+# products.image_backends.LocalImageBackend keeps them under MEDIA_ROOT (development, offline tests)
+PRODUCT_IMAGE_BACKEND = config('PRODUCT_IMAGE_BACKEND', default='products.image_backends.CloudinaryImageBackend')
+PRODUCT_IMAGE_UPLOAD_TICKET_MAX_AGE = 600  # seconds a direct upload ticket is valid
 
 # CLOUDINARY_URL=cloudinary://<API_KEY>:<API_SECRET>@<CLOUD_NAME> # use this in .env replacing by values
 
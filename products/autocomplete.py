@@ -0,0 +1,152 @@
+# products, autocomplete.py:
+# search-as-you-type for /api/products/autocomplete/?q=, answered from memory instead of an ILIKE scan per keystroke.
+# Product and category names are indexed under every word they contain ("smart phone case" -> "smart phone case",
+# "phone case", "case"), the keys live in a sorted list and a prefix is a bisect range of it.
+# Entries are numbered by popularity (ProductRanking.units_sold, Category.product_count), so the best
+# matches of a range are its smallest numbers. Rebuilt when the autocomplete version (products/cache.py) changes:
+# a product or category name, or the ranking refresh, not stock/price/review writes. A cold worker builds it in the
+# request, after that one background thread rebuilds it while keystrokes keep getting the previous index.
+# Memory per worker is bounded by settings.PRODUCT_AUTOCOMPLETE_MAX_PRODUCTS and MAX_KEYS_PER_NAME.
+import heapq
+import threading
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+
+from products.cache import get_autocomplete_version
+from products.search import tokenize
+
+MAX_KEYS_PER_NAME = 4   # words of a name that start a key, "the" in word 5 of a long name isn't worth a key
+MAX_KEY_LENGTH = 48
+MAX_LIMIT = 20
+PRECOMPUTED_PREFIX_LENGTH = 2  # 1 and 2 character prefixes span most of the index, their top entries are kept
+LARGE_RANGE = 1000  # longer prefixes whose range is bigger than this are memoized
+
+
+def normalize(text):
+    return ' '.join(tokenize(text))
+
+
+def name_keys(name):
+    words = tokenize(name)
+    return {' '.join(words[start:])[:MAX_KEY_LENGTH] for start in range(min(len(words), MAX_KEYS_PER_NAME))}
+
+
+class PrefixIndex:
+    """names must come most popular first, search() returns their positions in that order"""
+
+    max_cached_prefixes = 256
+
+    def __init__(self, names):
+        pairs = sorted((key, position) for position, name in enumerate(names) for key in name_keys(name))
+        self.keys = [key for key, _ in pairs]
+        self.positions = array('i', (position for _, position in pairs))
+        self.results = {}
+        self.top = {}
+        for prefix in {key[:length] for key in self.keys for length in range(1, PRECOMPUTED_PREFIX_LENGTH + 1)}:
+            self.top[prefix] = self.scan(*self.range(prefix), MAX_LIMIT)
+
+    def range(self, prefix):
+        lo = bisect_left(self.keys, prefix)
+        return lo, bisect_left(self.keys, prefix + '\U0010ffff', lo)
+
+    def scan(self, lo, hi, limit):
+        # a name has at most MAX_KEYS_PER_NAME keys in one range, so that many more always holds `limit` distinct ones
+        best = heapq.nsmallest(limit * MAX_KEYS_PER_NAME, self.positions[lo:hi])
+        return list(dict.fromkeys(best))[:limit]
+
+    def search(self, prefix, limit):
+        if prefix in self.top:
+            return self.top[prefix][:limit]
+        lo, hi = self.range(prefix)
+        if hi - lo <= LARGE_RANGE:
+            return self.scan(lo, hi, limit)
+        if prefix not in self.results:
+            if len(self.results) >= self.max_cached_prefixes:
+                self.results.clear()
+            self.results[prefix] = self.scan(lo, hi, MAX_LIMIT)
+        return self.results[prefix][:limit]
+
+
+class Autocomplete:
+    def __init__(self, products, categories):
+        """products, categories: (id, name) rows, most popular first"""
+        self.product_ids = array('q', (pk for pk, _ in products))  # BigAutoField ids, 'i' overflows past 2 ** 31
+        self.product_names = [name for _, name in products]
+        self.products = PrefixIndex(self.product_names)
+        self.category_ids = array('q', (pk for pk, _ in categories))
+        self.category_names = [name for _, name in categories]
+        self.categories = PrefixIndex(self.category_names)
+
+    def suggest(self, text, limit=8, category_limit=3):
+        prefix = normalize(text)
+        if not prefix:
+            return {'products': [], 'categories': []}
+        return {
+            'products': [
+                {'id': self.product_ids[position], 'name': self.product_names[position]}
+                for position in self.products.search(prefix, limit)
+            ],
+            'categories': [
+                {'id': self.category_ids[position], 'name': self.category_names[position]}
+                for position in self.categories.search(prefix, category_limit)
+            ],
+        }
+
+
+def max_products():
+    return getattr(settings, 'PRODUCT_AUTOCOMPLETE_MAX_PRODUCTS', 50000)
+
+
+_index_lock = threading.Lock()
+_index = {'version': None, 'index': None, 'rebuilding': False}
+
+
+def build_index():
+    from products.models import Category, Product
+
+    products = list(
+        Product.objects.order_by(F('ranking__units_sold').desc(nulls_last=True), '-rating_count', 'id')
+        .values_list('id', 'name')[:max_products()]
+    )
+    categories = list(Category.objects.order_by('-product_count', 'id').values_list('id', 'name'))
+    return Autocomplete(products, categories)
+
+
+def _rebuild(version):
+    try:
+        index = build_index()
+        with _index_lock:
+            _index['index'], _index['version'] = index, version
+    finally:
+        _index['rebuilding'] = False
+
+
+def _start_rebuild(version):
+    def run():
+        try:
+            _rebuild(version)
+        finally:
+            connection.close()  # the thread's own connection
+
+    threading.Thread(target=run, name='autocomplete-rebuild', daemon=True).start()
+
+
+def get_autocomplete():
+    version = get_autocomplete_version()
+    if _index['index'] is None:  # nothing to serve yet
+        with _index_lock:
+            if _index['index'] is None:
+                _index['index'], _index['version'] = build_index(), version
+        return _index['index']
+    if _index['version'] != version and not _index['rebuilding']:
+        with _index_lock:
+            start = _index['version'] != version and not _index['rebuilding']
+            if start:
+                _index['rebuilding'] = True
+        if start:
+            _start_rebuild(version)
+    return _index['index']
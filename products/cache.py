@@ -0,0 +1,158 @@
+# products, cache.py:
+# response cache for the product catalog (ProductViewSet list/retrieve).
+# Keys carry a "catalog version" stamp, products/signals.py bumps the version on
+# post_save/post_delete of Product, ProductImage and Category so stale pages are never served.
+import hashlib
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework.response import Response
+
+from api.conditional import VALIDATOR_HEADERS, not_modified_from_headers
+
+CATALOG_VERSION_KEY = 'catalog:version'
+AUTOCOMPLETE_VERSION_KEY = 'catalog:autocomplete:version'  # names and ranking only, products/autocomplete.py
+PRODUCT_VERSION_KEY = 'catalog:product:{pk}:version'
+HITS_KEY = 'catalog:stats:hits'
+MISSES_KEY = 'catalog:stats:misses'
+
+
+def _timeout():
+    return getattr(settings, 'CATALOG_CACHE_TIMEOUT', 300)
+
+
+def _incr(key):
+    try:
+        return cache.incr(key)
+    except ValueError:  # key missing (first use, or evicted)
+        cache.add(key, 0, timeout=None)
+        return cache.incr(key)
+
+
+def get_catalog_version():
+    return cache.get_or_set(CATALOG_VERSION_KEY, 1, timeout=None)
+
+
+def get_product_version(pk):
+    return cache.get_or_set(PRODUCT_VERSION_KEY.format(pk=pk), 1, timeout=None)
+
+
+def bump_catalog_version(product_id=None):
+    """Invalidate every cached list page, and the detail page of product_id if given."""
+    _incr(CATALOG_VERSION_KEY)
+    if product_id is not None:
+        _incr(PRODUCT_VERSION_KEY.format(pk=product_id))
+
+
+def invalidate_catalog(product_id=None):
+    # bump after commit, otherwise a concurrent request could re-cache the old rows under the new version
+    transaction.on_commit(lambda: bump_catalog_version(product_id))
+
+
+def get_autocomplete_version():
+    return cache.get_or_set(AUTOCOMPLETE_VERSION_KEY, 1, timeout=None)
+
+
+def invalidate_autocomplete():
+    # a product or category name, or the popularity order, changed; stock, prices and reviews don't touch the index
+    transaction.on_commit(lambda: _incr(AUTOCOMPLETE_VERSION_KEY))
+
+
+def record_hit():
+    _incr(HITS_KEY)
+
+
+def record_miss():
+    _incr(MISSES_KEY)
+
+
+def cache_stats():
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    total = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / total, 4) if total else 0,
+        'catalog_version': get_catalog_version(),
+    }
+
+
+def reset_cache_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY])
+
+
+class CatalogCacheMixin:
+    """
+    Caches response.data of list and retrieve for GET requests.
+    Only the query params that change the result are part of the key (filters, search, ordering, page),
+    so ?page=2&search=x and ?search=x&page=2&utm=y share one entry.
+    Data is cached (not rendered bytes), so json and the browsable api share the entry.
+    ETag/Last-Modified are cached along with it, a hit can be a 304 without touching the database.
+    """
+    cache_extra_params = []  # extra query params that change the response
+    cache_header = 'X-Cache'
+
+    def get_cache_params(self):
+        params = set(self.cache_extra_params)
+        filterset_class = getattr(self, 'filterset_class', None)
+        if filterset_class is not None:
+            params.update(filterset_class.base_filters.keys())
+        for backend in self.filter_backends:
+            for attr in ('search_param', 'ordering_param'):
+                if hasattr(backend, attr):
+                    params.add(getattr(backend, attr))
+        paginator = self.paginator
+        if paginator is not None:
+            for attr in ('page_query_param', 'page_size_query_param', 'cursor_query_param', 'count_query_param'):
+                if getattr(paginator, attr, None):
+                    params.add(getattr(paginator, attr))
+        return params
+
+    def get_cache_key(self, request, **kwargs):
+        allowed = self.get_cache_params()
+        query = sorted(
+            (key, value)
+            for key, values in request.query_params.lists() if key in allowed
+            for value in values if value != ''
+        )
+        if self.action == 'retrieve':
+            pk = kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+            version = f"{get_catalog_version()}.{get_product_version(pk)}"
+            scope = f"detail:{pk}"
+        else:
+            version = get_catalog_version()
+            scope = self.action  # list, or a list-like action eg. facets
+        # host is part of the key because pagination links are absolute urls
+        raw = f"{request.get_host()}?{urlencode(query)}"
+        digest = hashlib.md5(raw.encode()).hexdigest()
+        return f"catalog:{self.basename}:{scope}:v{version}:{digest}"
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        key = self.get_cache_key(request, **kwargs)
+        cached = cache.get(key)
+        if cached is not None:
+            record_hit()
+            data, headers = cached
+            # validators of the cached response (ConditionalGetMixin) are replayed, and still answer 304s
+            response = not_modified_from_headers(request, headers) or Response(data)
+            for header, value in headers.items():
+                response[header] = value
+            response[self.cache_header] = 'HIT'
+            return response
+
+        record_miss()
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            headers = {header: response[header] for header in VALIDATOR_HEADERS if header in response}
+            cache.set(key, (response.data, headers), _timeout())
+        response[self.cache_header] = 'MISS'
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
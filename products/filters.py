@@ -1,4 +1,6 @@
+from django.db.models import F
 from django_filters.rest_framework import FilterSet  # --- 'django_filters'
+from rest_framework.filters import OrderingFilter
 from products.models import Product
 
 
@@ -10,5 +12,33 @@ class ProductFilter(FilterSet):
             'price': ['gt', 'lt']
         }
         
+
+
+class ProductOrderingFilter(OrderingFilter):
+    """
+    OrderingFilter plus popularity orderings read from ProductRanking (python manage.py refresh_rankings):
+    ?ordering=bestselling / trending, most popular first, '-bestselling' / '-trending' reverses them.
+    The ranking value is annotated under its own name, so keyset pagination can use it as the cursor key,
+    and ordered with the product id as tiebreaker, the (units_sold, product) / (trending_score, product) indexes.
+    """
+    ranking_orderings = {'bestselling': 'units_sold', 'trending': 'trending_score'}
+
+    def get_ranking_ordering(self, request):
+        value = request.query_params.get(self.ordering_param, '').strip()
+        field = self.ranking_orderings.get(value.lstrip('-'))
+        return (field, value.startswith('-')) if field else (None, False)
+
+    def filter_queryset(self, request, queryset, view):
+        field, reverse = self.get_ranking_ordering(request)
+        if field is None:
+            return super().filter_queryset(request, queryset, view)
+        prefix = '' if reverse else '-'
+        return (
+            queryset.filter(ranking__isnull=False)  # every product has a row, inner join
+            .annotate(**{field: F(f'ranking__{field}')})
+            .order_by(f'{prefix}{field}', f'{prefix}id')
+        )
+
+
 # eg. http://127.0.0.1:8000/api/products/?category_id=1
 # http://127.0.0.1:8000/api/products/?price__gt=200&price__lt=300 
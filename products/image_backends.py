@@ -0,0 +1,210 @@
+# products, image_backends.py:
+# derivative images of ProductImage (thumbnail, card, zoom, each also as webp).
+# The derivative urls are built once when the image is uploaded and stored in ProductImage.variants,
+# serializers just return that dict.
+#  - CloudinaryImageBackend (default): uploads the original, derivatives are cloudinary transformation urls,
+#    cloudinary renders them on first request and serves them from its cdn.
+#  - LocalImageBackend: resizes with Pillow and writes the files to MEDIA_ROOT, for development and offline tests.
+# settings.PRODUCT_IMAGE_BACKEND picks one, backfill: python manage.py generate_image_variants
+#
+# direct uploads (the file doesn't go through a django worker):
+#  1. POST .../images/upload-ticket/  -> signed, short lived ticket + where/how to upload
+#  2. client POSTs the file straight to storage (cloudinary, or the local stand-in endpoint)
+#  3. POST .../images/finalize/ {ticket, ...}  -> checks the upload (size, format) and records the ProductImage,
+#     ProductImage.upload_key is unique, a ticket can't record two images even when finalized twice at once
+import io
+import time
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.utils.module_loading import import_string
+
+VARIANTS = {  # name -> (width, height, crop), 'fill' crops to exactly that size, 'limit' only scales down
+    'thumbnail': (150, 150, 'fill'),
+    'card': (480, 480, 'fill'),
+    'zoom': (1600, 1600, 'limit'),
+}
+WEBP_SUFFIX = '_webp'
+UPLOAD_FOLDER = 'phimart_ecom'  # same folder as ProductImage.image
+ALLOWED_FORMATS = ['jpg', 'jpeg', 'png', 'gif']  # same as ProductImageSerializer.validate_image
+MAX_UPLOAD_SIZE = 1 * 1024 * 1024
+UPLOAD_TICKET_SALT = 'products.image_backends.upload'
+
+
+class UploadError(Exception):
+    pass
+
+
+def variant_names():
+    return [name for base in VARIANTS for name in (base, base + WEBP_SUFFIX)]
+
+
+def get_image_backend():
+    return import_string(settings.PRODUCT_IMAGE_BACKEND)()
+
+
+def upload_ticket_max_age():
+    return getattr(settings, 'PRODUCT_IMAGE_UPLOAD_TICKET_MAX_AGE', 600)
+
+
+def make_upload_ticket(product_id):
+    """returns (key, ticket), the key names the upload in storage, the ticket is signed and expires"""
+    key = uuid.uuid4().hex
+    return key, signing.dumps({'product': str(product_id), 'key': key}, salt=UPLOAD_TICKET_SALT)
+
+
+def read_upload_ticket(ticket, product_id):
+    """key of a valid, unexpired ticket issued for product_id, else UploadError"""
+    try:
+        data = signing.loads(ticket or '', salt=UPLOAD_TICKET_SALT, max_age=upload_ticket_max_age())
+    except signing.SignatureExpired:
+        raise UploadError('Upload ticket expired')
+    except signing.BadSignature:
+        raise UploadError('Invalid upload ticket')
+    if data['product'] != str(product_id):
+        raise UploadError('Upload ticket is for another product')
+    return data['key']
+
+
+class CloudinaryImageBackend:
+    def store(self, upload):
+        """upload the original, returns (value for ProductImage.image, variants)"""
+        import cloudinary.uploader
+
+        resource = cloudinary.uploader.upload_resource(upload, folder=UPLOAD_FOLDER)
+        return resource, self.build_variants(resource)
+
+    def upload_ticket(self, key, ticket, request, product_id):
+        """signed upload parameters, the client posts them with the file to cloudinary"""
+        import cloudinary
+        from cloudinary.utils import api_sign_request, cloudinary_api_url
+
+        config = cloudinary.config()
+        params = {
+            'public_id': f'{UPLOAD_FOLDER}/{key}',  # fixed by the signature, finalize only accepts this one
+            'timestamp': int(time.time()),
+            'allowed_formats': ','.join(ALLOWED_FORMATS),
+        }
+        fields = dict(params, api_key=config.api_key, signature=api_sign_request(params, config.api_secret))
+        return {'upload_url': cloudinary_api_url('upload', resource_type='image'), 'fields': fields}
+
+    def finalize_upload(self, key, data):
+        """
+        data: version and signature from cloudinary's upload response.
+        Signed upload parameters can't cap the file size, so the stored resource is read back (one admin api call)
+        and one over MAX_UPLOAD_SIZE is deleted, the limit ProductImageSerializer.validate_image puts on uploads
+        through the api. Size and format come from cloudinary, not from the client.
+        """
+        import cloudinary.api
+        import cloudinary.uploader
+        from cloudinary import CloudinaryResource
+        from cloudinary.exceptions import NotFound
+        from cloudinary.utils import verify_api_response_signature
+
+        public_id = f'{UPLOAD_FOLDER}/{key}'
+        version, signature = data.get('version'), data.get('signature')
+        if not (version and signature and verify_api_response_signature(public_id, version, signature)):
+            raise UploadError('Upload could not be verified')
+        try:
+            stored = cloudinary.api.resource(public_id, resource_type='image', type='upload')
+        except NotFound:
+            raise UploadError('Nothing was uploaded with this ticket')
+        if stored['bytes'] > MAX_UPLOAD_SIZE or stored['format'] not in ALLOWED_FORMATS:
+            cloudinary.uploader.destroy(public_id, resource_type='image', invalidate=True)
+            raise UploadError('Image size cannot exceed 1MB.' if stored['bytes'] > MAX_UPLOAD_SIZE else 'Unsupported file type.')
+        resource = CloudinaryResource(public_id, version=str(stored['version']), format=stored['format'], type='upload', resource_type='image')
+        return resource, self.build_variants(resource)
+
+    def build_variants(self, image):
+        """image: the CloudinaryResource of ProductImage.image, no api call, urls only"""
+        variants = {}
+        for name, (width, height, crop) in VARIANTS.items():
+            options = {'width': width, 'height': height, 'crop': crop, 'quality': 'auto', 'secure': True}
+            variants[name] = image.build_url(**options)
+            variants[name + WEBP_SUFFIX] = image.build_url(format='webp', **options)
+        return variants
+
+
+class LocalImageBackend:
+    """Pillow + FileSystemStorage, files go to MEDIA_ROOT/product_images/<uuid>/"""
+    folder = 'product_images'
+
+    def __init__(self):
+        self.storage = FileSystemStorage(location=settings.MEDIA_ROOT, base_url=settings.MEDIA_URL)
+
+    def store(self, upload):
+        extension = upload.name.rsplit('.', 1)[-1].lower() if '.' in upload.name else 'jpg'
+        name = self.storage.save(f'{self.folder}/{uuid.uuid4().hex}/original.{extension}', upload)
+        return name, self.build_variants(name)
+
+    def upload_ticket(self, key, ticket, request, product_id):
+        from django.urls import reverse
+
+        url = reverse('product-images-local-upload', kwargs={'product_pk': product_id})
+        return {'upload_url': request.build_absolute_uri(url), 'fields': {'ticket': ticket}}
+
+    def save_upload(self, key, upload):
+        """the storage side of the local stand-in, what cloudinary checks on its side is checked here"""
+        if upload is None:
+            raise UploadError('No file was submitted.')
+        extension = upload.name.rsplit('.', 1)[-1].lower() if '.' in upload.name else ''
+        if extension not in ALLOWED_FORMATS:
+            raise UploadError('Unsupported file type.')
+        if upload.size > MAX_UPLOAD_SIZE:
+            raise UploadError('Image size cannot exceed 1MB.')
+        prefix = f'{self.folder}/{key}'
+        if self.find_original(prefix):
+            raise UploadError('This ticket was already used')
+        return self.storage.save(f'{prefix}/original.{extension}', upload)
+
+    def finalize_upload(self, key, data):
+        name = self.find_original(f'{self.folder}/{key}')
+        if name is None:
+            raise UploadError('Nothing was uploaded with this ticket')
+        return name, self.build_variants(name)
+
+    def find_original(self, prefix):
+        if not self.storage.exists(prefix):
+            return None
+        _, files = self.storage.listdir(prefix)
+        return next((f'{prefix}/{file}' for file in files if file.startswith('original.')), None)
+
+    def build_variants(self, image):
+        """image: storage name of the original (or the ProductImage.image value holding it)"""
+        from PIL import Image, ImageOps
+
+        name = self.original_name(image)
+        prefix = name.rsplit('/', 1)[0]
+        with self.storage.open(name) as file:
+            original = ImageOps.exif_transpose(Image.open(file))
+            original.load()
+
+        keep_alpha = original.mode in ('RGBA', 'LA', 'P') and name.lower().endswith('.png')
+        variants = {'original': self.storage.url(name)}
+        for variant, (width, height, crop) in VARIANTS.items():
+            if crop == 'fill':
+                resized = ImageOps.fit(original, (width, height), Image.Resampling.LANCZOS)
+            else:
+                resized = original.copy()
+                resized.thumbnail((width, height), Image.Resampling.LANCZOS)
+            if keep_alpha:
+                variants[variant] = self.save(resized.convert('RGBA'), f'{prefix}/{variant}.png', 'PNG')
+            else:
+                variants[variant] = self.save(resized.convert('RGB'), f'{prefix}/{variant}.jpg', 'JPEG', quality=85)
+            variants[variant + WEBP_SUFFIX] = self.save(resized, f'{prefix}/{variant}.webp', 'WEBP', quality=80)
+        return variants
+
+    def save(self, image, name, image_format, **options):
+        buffer = io.BytesIO()
+        image.save(buffer, image_format, **options)
+        self.storage.delete(name)  # regenerating overwrites
+        return self.storage.url(self.storage.save(name, ContentFile(buffer.getvalue())))
+
+    def original_name(self, image):
+        public_id = getattr(image, 'public_id', None)  # the value read back through CloudinaryField
+        if public_id is None:
+            return str(image)
+        return f'{public_id}.{image.format}' if image.format else public_id
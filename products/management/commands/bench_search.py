@@ -0,0 +1,87 @@
+# python manage.py bench_search --products 50000 --queries 100
+# compares the old SearchFilter (ILIKE '%term%' on name/description) with ProductSearchFilter
+# on a synthetic catalog, everything runs inside a transaction that is rolled back at the end.
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.filters import SearchFilter
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from products.models import Category, Product
+from products.search import ProductSearchFilter, get_inverted_index, update_search_document
+
+WORDS = (
+    'wireless smart phone laptop tablet cotton shirt jacket leather shoes running kitchen blender '
+    'mixer oven novel history science cookbook camera lens headphones speaker watch fitness yoga '
+    'mat lamp desk chair sofa pillow blanket garden tool drill hammer bicycle helmet backpack'
+).split()
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Benchmark ProductSearchFilter against the plain SearchFilter on a synthetic catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=20000)
+        parser.add_argument('--queries', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        try:
+            with transaction.atomic():
+                self.seed(rng, options['products'])
+                queries = [' '.join(rng.sample(WORDS, rng.choice([1, 2]))) for _ in range(options['queries'])]
+                self.run(queries)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, rng, count):
+        category = Category.objects.create(name='bench')
+        started = time.perf_counter()
+        Product.objects.bulk_create(
+            (
+                Product(
+                    name=' '.join(rng.sample(WORDS, 3)),
+                    description=' '.join(rng.choices(WORDS, k=25)),
+                    price=rng.randint(1, 1000),
+                    stock=rng.randint(0, 100),
+                    category=category,
+                )
+                for _ in range(count)
+            ),
+            batch_size=2000,
+        )
+        update_search_document(Product.objects.filter(category=category))
+        self.stdout.write(f'seeded {count} products in {time.perf_counter() - started:.1f}s ({connection.vendor})')
+
+    def run(self, queries):
+        factory = APIRequestFactory()
+        view = type('BenchView', (), {'search_fields': ['name', 'description']})()
+        if connection.vendor != 'postgresql':
+            started = time.perf_counter()
+            get_inverted_index()
+            self.stdout.write(f'python inverted index built in {(time.perf_counter() - started) * 1000:.0f}ms')
+
+        for label, backend in (('SearchFilter (ILIKE)', SearchFilter()), ('ProductSearchFilter', ProductSearchFilter())):
+            timings = []
+            for query in queries:
+                request = Request(factory.get('/', {'search': query}))
+                started = time.perf_counter()
+                queryset = backend.filter_queryset(request, Product.objects.all(), view)
+                queryset.count()  # the list endpoint paginates with a COUNT(*) too
+                page = list(queryset[:10])
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            self.stdout.write(
+                f'{label:<22} mean {statistics.mean(timings):8.2f}ms   '
+                f'p95 {timings[int(len(timings) * 0.95) - 1]:8.2f}ms   last page size {len(page)}'
+            )
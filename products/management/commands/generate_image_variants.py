@@ -0,0 +1,38 @@
+# python manage.py generate_image_variants [--all]
+# fills ProductImage.variants for images uploaded before derivatives existed (or all with --all),
+# with the backend of settings.PRODUCT_IMAGE_BACKEND, see products/image_backends.py
+from django.core.management.base import BaseCommand
+from products.image_backends import get_image_backend
+from products.models import ProductImage
+
+
+class Command(BaseCommand):
+    help = 'Build thumbnail/card/zoom (+ webp) urls of product images that have none yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Rebuild every image, not only the missing ones')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        backend = get_image_backend()
+        images = ProductImage.objects.exclude(image__isnull=True).exclude(image='').order_by('id')
+        if not options['all']:
+            images = images.filter(variants={})
+        done = failed = 0
+        batch = []
+        for image in images.only('id', 'image').iterator(chunk_size=options['batch_size']):
+            try:
+                image.variants = backend.build_variants(image.image)
+            except Exception as exc:  # a missing/broken original shouldn't stop the backfill
+                failed += 1
+                self.stderr.write(f'image {image.pk}: {exc}')
+                continue
+            batch.append(image)
+            if len(batch) >= options['batch_size']:
+                ProductImage.objects.bulk_update(batch, ['variants'])
+                done += len(batch)
+                batch = []
+        if batch:
+            ProductImage.objects.bulk_update(batch, ['variants'])
+            done += len(batch)
+        self.stdout.write(self.style.SUCCESS(f'Generated variants for {done} images, {failed} failed'))
@@ -0,0 +1,211 @@
+# python manage.py import_catalog fixtures/products_data_cleaned.json
+# python manage.py import_catalog feed.ndjson --batch-size 5000
+# python manage.py import_catalog feed.csv     (columns: id,name,description,price,stock,category)
+# bulk upsert of products, instead of loaddata (one INSERT per row, whole document in memory).
+# The input is read incrementally, rows are written with bulk_create(update_conflicts=True) in batches,
+# one transaction per batch, so memory and lock time stay bounded however big the feed is.
+# Rows are either fixture records ({"model": ..., "pk": ..., "fields": {...}}) or flat product objects,
+# category is a pk or a category name (missing names are created).
+import csv
+import json
+import sys
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from products.cache import invalidate_catalog
+from products.models import Category, Product, ProductRanking
+from products.search import update_search_document
+from products.services import CategoryService
+
+PRODUCT_FIELDS = ['name', 'description', 'price', 'stock']
+UPDATE_FIELDS = PRODUCT_FIELDS + ['category', 'updated_at']
+FORMATS = {'.json': 'json', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.csv': 'csv'}
+
+
+def _read_more(stream, buffer, pos, read_size):
+    chunk = stream.read(read_size)
+    return buffer[pos:] + chunk, 0, not chunk
+
+
+def iter_json_array(stream, read_size=1 << 16):
+    """Items of a top level JSON array, decoded one at a time with raw_decode, the document is never loaded whole."""
+    decoder = json.JSONDecoder()
+    buffer, pos, eof, started = '', 0, False, False
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                raise CommandError('Unexpected end of JSON input')
+            buffer, pos, eof = _read_more(stream, buffer, pos, read_size)
+            continue
+        if not started:
+            if buffer[pos] != '[':
+                raise CommandError('JSON input must be an array')
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as exc:
+            if eof:
+                raise CommandError(f'Invalid JSON: {exc}')
+            buffer, pos, eof = _read_more(stream, buffer, pos, read_size)  # item continues past the buffer
+            continue
+        if end == len(buffer) and not eof:
+            # a bare number at the end of the buffer may be cut short, decode it again with more input
+            buffer, pos, eof = _read_more(stream, buffer, pos, read_size)
+            continue
+        yield item
+        pos = end
+
+
+def iter_ndjson(stream):
+    for number, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as exc:
+                raise CommandError(f'Invalid JSON on line {number}: {exc}')
+
+
+class Command(BaseCommand):
+    help = 'Stream products (JSON fixture/array, NDJSON or CSV) into the catalog with batched bulk upserts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, '-' for stdin")
+        parser.add_argument('--format', choices=sorted(set(FORMATS.values())), help='Default: from the file extension')
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        input_format = options['format'] or next((fmt for ext, fmt in FORMATS.items() if path.endswith(ext)), None)
+        if input_format is None:
+            raise CommandError('Unknown input format, use --format')
+        self.batch_size = max(1, options['batch_size'])
+        self.verbosity = options['verbosity']
+        self.categories = dict(Category.objects.values_list('name', 'id'))
+        self.category_ids = set(self.categories.values())
+        self.imported = self.skipped = 0
+        self.explicit_ids = False
+
+        stream = sys.stdin if path == '-' else open(path, encoding='utf-8', newline='')
+        started = time.perf_counter()
+        try:
+            if input_format == 'csv':
+                records = csv.DictReader(stream)
+            elif input_format == 'ndjson':
+                records = iter_ndjson(stream)
+            else:
+                records = iter_json_array(stream)
+            self.import_records(records, started)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+            self.finish()  # batches already committed stay, bring counts/sequences/cache in line with them
+        elapsed = time.perf_counter() - started
+        rate = self.imported / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {self.imported} products in {elapsed:.1f}s ({rate:,.0f} rows/s), skipped {self.skipped}'
+        ))
+
+    def import_records(self, records, started):
+        batch = {}  # keyed by id, a repeated id in one batch would hit the same row twice in one upsert
+        for number, record in enumerate(records, 1):
+            if not isinstance(record, dict) or not isinstance(record.get('fields', {}), dict):
+                self.skip(number, ['expected an object (a fixture record or a product)'])
+                continue
+            model = record.get('model')
+            try:
+                if model == 'products.category':
+                    self.save_category(record)
+                    continue
+                if model is not None and model != 'products.product':
+                    continue
+                # a fixture record without pk is a new product, as with loaddata
+                row = dict(record.get('fields', {}), id=record.get('pk')) if model else record
+                product = self.build_product(row)
+            except (ValidationError, ValueError, TypeError) as exc:
+                self.skip(number, exc.messages if isinstance(exc, ValidationError) else [str(exc)])
+                continue
+            batch[product.pk if product.pk is not None else f'new-{number}'] = product
+            if len(batch) >= self.batch_size:
+                self.flush(list(batch.values()))
+                batch = {}
+                if self.verbosity > 1:
+                    elapsed = time.perf_counter() - started
+                    self.stdout.write(f'{self.imported} rows, {self.imported / elapsed:,.0f} rows/s')
+        if batch:
+            self.flush(list(batch.values()))
+
+    def skip(self, number, messages):
+        self.skipped += 1
+        self.stderr.write(f'row {number}: {"; ".join(messages)}')
+
+    def save_category(self, record):
+        fields = record.get('fields', {})
+        if not fields.get('name'):
+            raise ValidationError('Category name is required')
+        defaults = {'name': fields['name'], 'description': fields.get('description')}
+        if record.get('pk') is None:
+            category, _ = Category.objects.update_or_create(name=fields['name'], defaults=defaults)
+        else:
+            category, _ = Category.objects.update_or_create(pk=int(record['pk']), defaults=defaults)
+            self.explicit_ids = True
+        self.categories[category.name] = category.pk
+        self.category_ids.add(category.pk)
+
+    def resolve_category(self, value):
+        if isinstance(value, int) or (isinstance(value, str) and value.isdigit()):
+            category_id = int(value)
+            if category_id not in self.category_ids:
+                raise ValidationError(f'Category {category_id} does not exist')
+            return category_id
+        if not value:
+            raise ValidationError('Category is required')
+        if value not in self.categories:
+            self.categories[value] = Category.objects.get_or_create(name=value)[0].pk
+            self.category_ids.add(self.categories[value])
+        return self.categories[value]
+
+    def build_product(self, row):
+        values = {name: Product._meta.get_field(name).clean(row.get(name), None) for name in PRODUCT_FIELDS}
+        product_id = row.get('id')
+        product = Product(
+            id=int(product_id) if product_id not in (None, '') else None,
+            category_id=self.resolve_category(row.get('category')),
+            **values,
+        )
+        return product
+
+    def flush(self, products):
+        existing = [product for product in products if product.pk is not None]
+        new = [product for product in products if product.pk is None]
+        with transaction.atomic():
+            if existing:
+                Product.objects.bulk_create(
+                    existing, update_conflicts=True, unique_fields=['id'], update_fields=UPDATE_FIELDS
+                )
+                self.explicit_ids = True
+            if new:
+                Product.objects.bulk_create(new)
+            # bulk_create sends no post_save, do what products/signals.py would have done for this batch
+            ids = [product.pk for product in products if product.pk]
+            update_search_document(Product.objects.filter(pk__in=ids))
+            ProductRanking.objects.bulk_create([ProductRanking(product_id=pk) for pk in ids], ignore_conflicts=True)
+        self.imported += len(products)
+
+    def finish(self):
+        if self.explicit_ids:
+            # explicit ids don't advance the postgres sequences, the next normal INSERT would collide
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), [Category, Product]):
+                    cursor.execute(sql)
+        CategoryService.reconcile_product_counts()
+        invalidate_catalog()
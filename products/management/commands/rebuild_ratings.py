@@ -0,0 +1,14 @@
+# python manage.py rebuild_ratings
+from django.core.management.base import BaseCommand
+from products.services import ProductRatingService
+
+
+class Command(BaseCommand):
+    help = 'Recompute Product.rating_avg, rating_count and the star histogram from all reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        rated = ProductRatingService.rebuild_ratings(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt ratings, {rated} products have reviews'))
@@ -0,0 +1,17 @@
+# python manage.py reconcile_category_counts [--dry-run]
+from django.core.management.base import BaseCommand
+from products.services import CategoryService
+
+
+class Command(BaseCommand):
+    help = 'Fix Category.product_count where it drifted from the real number of products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the drift')
+
+    def handle(self, *args, **options):
+        drifted = CategoryService.reconcile_product_counts(dry_run=options['dry_run'])
+        for category, stored, actual in drifted:
+            self.stdout.write(f'{category}: stored {stored}, actual {actual}')
+        verb = 'Found' if options['dry_run'] else 'Fixed'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {len(drifted)} drifted categories'))
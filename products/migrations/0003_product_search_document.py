@@ -0,0 +1,42 @@
+# Generated by Django 5.2.4 on 2026-10-18 09:12
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+GIN_INDEX = 'product_search_document_gin'
+
+
+def create_search_index(apps, schema_editor):
+    # tsvector + GIN only exist on postgres, other backends use the python index in products/search.py
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        f"CREATE INDEX IF NOT EXISTS {GIN_INDEX} ON products_product USING gin (search_document)"
+    )
+    schema_editor.execute(
+        "UPDATE products_product SET search_document = "
+        "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f"DROP INDEX IF EXISTS {GIN_INDEX}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_alter_productimage_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_document',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
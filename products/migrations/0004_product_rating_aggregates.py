@@ -0,0 +1,67 @@
+# Generated by Django 5.2.4 on 2026-10-18 00:34
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Avg, Count, Q
+
+
+def fill_rating_aggregates(apps, schema_editor):
+    Product = apps.get_model('products', 'Product')
+    Review = apps.get_model('products', 'Review')
+    stats = (
+        Review.objects.order_by().values('product_id')
+        .annotate(count=Count('id'), avg=Avg('ratings'),
+                  **{f'stars_{star}': Count('id', filter=Q(ratings=star)) for star in range(1, 6)})
+    )
+    for row in stats:
+        Product.objects.filter(pk=row['product_id']).update(
+            rating_count=row['count'],
+            rating_avg=Decimal(str(round(row['avg'], 2))),
+            **{f'stars_{star}': row[f'stars_{star}'] for star in range(1, 6)},
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0003_product_search_document'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_avg',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=3),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='stars_1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='stars_2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='stars_3',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='stars_4',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='stars_5',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_rating_aggregates, migrations.RunPython.noop),
+    ]
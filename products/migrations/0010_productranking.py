@@ -0,0 +1,37 @@
+# Generated by Django 5.2.4 on 2026-10-18 00:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_rankings(apps, schema_editor):
+    # one row per product, the counts are filled by python manage.py refresh_rankings
+    Product = apps.get_model('products', 'Product')
+    ProductRanking = apps.get_model('products', 'ProductRanking')
+    db = schema_editor.connection.alias
+    ProductRanking.objects.using(db).bulk_create(
+        (ProductRanking(product_id=pk) for pk in Product.objects.using(db).values_list('pk', flat=True).iterator()),
+        batch_size=2000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0009_copurchase'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductRanking',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='ranking', serialize=False, to='products.product')),
+                ('units_sold', models.PositiveIntegerField(default=0)),
+                ('trending_score', models.FloatField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['units_sold', 'product'], name='ranking_units_sold_idx'), models.Index(fields=['trending_score', 'product'], name='ranking_trending_idx')],
+            },
+        ),
+        migrations.RunPython(create_rankings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 01:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0011_trendingepoch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productimage',
+            name='upload_key',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True, unique=True),
+        ),
+    ]
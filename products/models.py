@@ -1,12 +1,16 @@
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.core.validators import MinValueValidator, MaxValueValidator
 from products.validators import validate_file_size
 from cloudinary.models import CloudinaryField  # for image save in cloud
+from django.contrib.postgres.search import SearchVectorField
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True, null=True)
+    # number of products, kept in sync by products/signals.py, fix drift: python manage.py reconcile_category_counts
+    product_count = models.PositiveIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)  # Last-Modified of category responses, also bumped with product_count
 
     def __str__(self):
         return self.name
@@ -17,22 +21,120 @@ class Product(models.Model):
     description = models.TextField()
     price = models.DecimalField(max_digits=10, decimal_places=2)
     stock = models.PositiveIntegerField()
-    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="products")
+    # no single column index, product_category_id_idx (category, id) in Meta.indexes serves the fk lookups too
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name="products", db_index=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # tsvector of name + description, maintained by products/signals.py, GIN indexed on postgres (see products/search.py)
+    search_document = SearchVectorField(null=True, editable=False)
+    # review aggregates, kept in sync incrementally by products/services.py, rebuild: python manage.py rebuild_ratings
+    rating_avg = models.DecimalField(max_digits=3, decimal_places=2, default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    stars_1 = models.PositiveIntegerField(default=0)  # histogram, number of 1 star reviews ...
+    stars_2 = models.PositiveIntegerField(default=0)
+    stars_3 = models.PositiveIntegerField(default=0)
+    stars_4 = models.PositiveIntegerField(default=0)
+    stars_5 = models.PositiveIntegerField(default=0)
 
     class Meta:
         ordering = ['-id',]
+        # access paths of ProductViewSet: ?category_id= with a price__gt/price__lt range, ordered by
+        # price / updated_at / -id (the default), and the same orderings over the whole catalog.
+        # 'id' is last so keyset pagination (products/paginations.py) walks the index without a sort.
+        # EXPLAIN checks in products/tests.py QueryPlanTest
+        indexes = [
+            models.Index(fields=['category', 'price', 'id'], name='product_category_price_idx'),
+            models.Index(fields=['category', 'updated_at', 'id'], name='product_category_updated_idx'),
+            models.Index(fields=['category', 'id'], name='product_category_id_idx'),
+            models.Index(fields=['price', 'id'], name='product_price_idx'),
+            models.Index(fields=['updated_at', 'id'], name='product_updated_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the category as loaded, the post_save receiver moves the count when it changes
+        instance._loaded_category_id = instance.__dict__.get('category_id')
+        instance._loaded_name = instance.__dict__.get('name')  # autocomplete is rebuilt only for a new name
+        return instance
+
+    def save(self, *args, **kwargs):
+        # the Category.product_count update (post_save) commits or rolls back together with the product row
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    @property
+    def rating_histogram(self):
+        return {str(star): getattr(self, f'stars_{star}') for star in range(1, 6)}
+
 
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     #image = models.ImageField(upload_to="products/images/", validators=[validate_file_size]) # blank =true, null = True not used, as m2m ?
     image = CloudinaryField('image', folder='phimart_ecom', blank=True, null=True) # default='phimart_ecom/default_jb8jxq.png' , now validator written in ProductImageSerializer, 1 MB
     # file = models.FileField(upload_to="product/files", validators=FileExtensionValidator(['pdf']))
+    # derivative urls {thumbnail, thumbnail_webp, card, ...}, made once on upload by products/image_backends.py
+    variants = models.JSONField(default=dict, blank=True, editable=False)
+    # key of the upload ticket it was finalized with (direct uploads), unique: a ticket records one image
+    upload_key = models.CharField(max_length=32, unique=True, null=True, blank=True, editable=False)
+
+
+class ProductRanking(models.Model):
+    """
+    popularity of a product, refreshed from orders by orders/rankings.py (python manage.py refresh_rankings),
+    one row per product, ?ordering=bestselling / trending of ProductViewSet walk the indexes below.
+     - units_sold: quantity in orders that reached READY_TO_SHIP or later
+     - trending_score: the same quantities weighted by 2 ** ((order.created_at - epoch) / half life),
+       every score carries the same growing factor, so ordering by it is ordering by the sales decayed to now
+    """
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name='ranking')
+    units_sold = models.PositiveIntegerField(default=0)
+    trending_score = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['units_sold', 'product'], name='ranking_units_sold_idx'),
+            models.Index(fields=['trending_score', 'product'], name='ranking_trending_idx'),
+        ]
+
+
+class TrendingEpoch(models.Model):
+    """
+    one row, the epoch every ProductRanking.trending_score is weighted from (orders/rankings.py).
+    Moved forward by a --full refresh, or by rescaling the stored scores once it is far behind,
+    so 2 ** (elapsed half lives) never grows out of a float.
+    """
+    started_at = models.DateTimeField()
+
+
+class ProductPairCount(models.Model):
+    """
+    sparse co-purchase matrix, number of counted orders that had both products.
+    Both directions are stored (a, b) and (b, a), so a product's neighbours are one range of the unique index.
+    Built from orders by orders/recommendations.py, python manage.py build_copurchase
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    other = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+', db_index=False)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['product', 'other'], name='product_pair_unique')]
+
+
+class RelatedProduct(models.Model):
+    """top-K 'frequently bought together' of a product, rank 1 = bought together most often"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_products')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    score = models.PositiveIntegerField()  # ProductPairCount.count when it was built
+    rank = models.PositiveSmallIntegerField()
+
+    class Meta:
+        ordering = ['product_id', 'rank']
+        # /api/products/{id}/related/ reads one range of this index, already in rank order
+        constraints = [models.UniqueConstraint(fields=['product', 'rank'], name='related_product_rank_unique')]
 
 
 class Review(models.Model):
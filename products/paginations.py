@@ -1,5 +1,164 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import b64decode, b64encode
+from binascii import Error as BinasciiError
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 
 class DefaultPagination(PageNumberPagination):
     page_size = 10
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor (keyset) pagination, pages are fetched with WHERE (key, id) > (last_key, last_id) instead of OFFSET,
+    so page 10000 costs the same as page 1.
+    Works with whatever ordering the OrderingFilter applied (or the model's Meta.ordering),
+    'id' is always added as a tiebreaker in the same direction so rows with equal key are never skipped/repeated.
+     - ?cursor=<opaque>   cursor from the next/previous link
+     - ?count=false       skip the COUNT(*) of the filtered queryset (infinite scroll doesn't need it)
+    """
+    page_size = 10
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    tiebreaker = 'id'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.model = queryset.model
+        self.key, self.descending = self.get_ordering(queryset)
+        cursor = self.decode_cursor(request)
+
+        self.count = None
+        if self.include_count(request):
+            self.count = queryset.count()  # total of the filtered queryset, not of the remaining rows
+
+        reverse = bool(cursor and cursor['r'])
+        queryset = queryset.order_by(*self.order_by(reverse))
+        if cursor:
+            queryset = queryset.filter(self.keyset_filter(cursor, reverse))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+
+        if reverse:
+            results.reverse()
+            self.has_previous, self.has_next = has_more, True
+        else:
+            self.has_previous, self.has_next = cursor is not None, has_more
+        self.page = results
+        return results
+
+    def get_ordering(self, queryset):
+        ordering = queryset.query.order_by or queryset.model._meta.ordering or [f'-{self.tiebreaker}']
+        first = ordering[0]
+        if not isinstance(first, str):
+            raise NotFound(f'Cursor pagination does not support ordering by {first}')
+        descending = first.startswith('-')
+        key = first.lstrip('-')
+        if key == 'pk':
+            key = self.tiebreaker
+        return key, descending
+
+    def order_by(self, reverse=False):
+        descending = self.descending != reverse
+        prefix = '-' if descending else ''
+        fields = [f'{prefix}{self.key}']
+        if self.key != self.tiebreaker:
+            fields.append(f'{prefix}{self.tiebreaker}')
+        return fields
+
+    def keyset_filter(self, cursor, reverse=False):
+        descending = self.descending != reverse
+        op = 'lt' if descending else 'gt'
+        after_id = Q(**{f'{self.tiebreaker}__{op}': cursor['id']})
+        if self.key == self.tiebreaker:
+            return after_id
+        value = cursor['v']
+        return Q(**{f'{self.key}__{op}': value}) | (Q(**{self.key: value}) & after_id)
+
+    def include_count(self, request):
+        return request.query_params.get(self.count_query_param, '').lower() not in ('0', 'false', 'no')
+
+    # cursor encoding
+    def encode_cursor(self, obj, reverse):
+        value = getattr(obj, self.key)
+        payload = {
+            'o': self.ordering_label(),
+            'id': getattr(obj, self.tiebreaker),
+            'v': None if value is None else str(value),
+            'r': reverse,
+        }
+        encoded = b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode()
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(b64decode(encoded.encode()).decode())
+            if cursor['o'] != self.ordering_label():  # cursor of another ordering, the key value means nothing here
+                raise ValueError
+            cursor['id'] = int(cursor['id'])
+            cursor['r'] = bool(cursor['r'])
+            if self.key != self.tiebreaker:
+                cursor['v'] = self.parse_value(cursor['v'])
+        except (TypeError, KeyError, ValueError, BinasciiError, UnicodeDecodeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def parse_value(self, value):
+        try:
+            field = self.model._meta.get_field(self.key)
+        except FieldDoesNotExist:
+            return float(value)  # annotated key, eg. a rank
+        return field.to_python(value)
+
+    def ordering_label(self):
+        return f"{'-' if self.descending else ''}{self.key}"
+
+    def get_paginated_response(self, data):
+        payload = {}
+        if self.count is not None:
+            payload['count'] = self.count
+        payload['next'] = self.get_next_link()
+        payload['previous'] = self.get_previous_link()
+        payload['results'] = data
+        return Response(payload)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'count': {'type': 'integer', 'example': 123},
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class ProductKeysetPagination(KeysetPagination):
+    page_size = 10
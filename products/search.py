@@ -0,0 +1,146 @@
+# products, search.py:
+# full text search for products.
+# postgres: Product.search_document is a tsvector (name weight A, description weight B) with a GIN index,
+#           kept up to date by products/signals.py, queried with websearch_to_tsquery and ranked with ts_rank.
+# other databases (sqlite test runs): an in-process inverted index over name/description,
+#           rebuilt lazily when the catalog version (products/cache.py) changes, and exposed to sql
+#           as product_search_rank(id, text) so the rank can be filtered/ordered/paginated in the query.
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.db.models import F, FloatField, Func, Value
+from django.dispatch import receiver
+from rest_framework.filters import SearchFilter
+
+from products.cache import get_catalog_version
+
+SEARCH_CONFIG = 'english'
+NAME_WEIGHT = 1.0         # same weights postgres uses for A and B
+DESCRIPTION_WEIGHT = 0.4
+RELEVANCE_ORDERINGS = ('relevance', '-relevance')
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or '').lower())
+
+
+def uses_postgres(queryset):
+    return connections[queryset.db].vendor == 'postgresql'
+
+
+def search_vector():
+    return (
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector('description', weight='B', config=SEARCH_CONFIG)
+    )
+
+
+def update_search_document(queryset):
+    """Recompute search_document for the given products, one UPDATE statement, no-op off postgres."""
+    if uses_postgres(queryset):
+        queryset.update(search_document=search_vector())
+
+
+class InvertedIndex:
+    """term -> {product_id: weight}, AND semantics like websearch_to_tsquery('a b')"""
+
+    max_cached_queries = 128
+
+    def __init__(self, rows):
+        self.results = {}
+        self.postings = defaultdict(dict)
+        for pk, name, description in rows:
+            self.add(pk, name, NAME_WEIGHT)
+            self.add(pk, description, DESCRIPTION_WEIGHT)
+        self.postings.default_factory = None
+
+    def add(self, pk, text, weight):
+        for term in tokenize(text):
+            docs = self.postings[term]
+            docs[pk] = docs.get(pk, 0) + weight
+
+    def search(self, text):
+        terms = tokenize(text)
+        if not terms:
+            return {}
+        postings = sorted((self.postings.get(term, {}) for term in set(terms)), key=len)
+        matches = set(postings[0]).intersection(*postings[1:])
+        # log dampened term frequency, so a description repeating a word doesn't beat a name match
+        return {
+            pk: round(sum(math.log1p(docs[pk]) for docs in postings), 6)
+            for pk in matches
+        }
+
+    def cached_search(self, text):
+        # sql calls the rank function once per row, memoize per query text
+        if text not in self.results:
+            if len(self.results) >= self.max_cached_queries:
+                self.results.clear()
+            self.results[text] = self.search(text)
+        return self.results[text]
+
+
+_index_lock = threading.Lock()
+_index = {'version': None, 'index': None}
+
+
+def get_inverted_index():
+    from products.models import Product
+
+    version = get_catalog_version()
+    if _index['version'] != version:
+        with _index_lock:
+            if _index['version'] != version:
+                rows = Product.objects.values_list('id', 'name', 'description').iterator(chunk_size=2000)
+                _index['index'] = InvertedIndex(rows)
+                _index['version'] = version
+    return _index['index']
+
+
+def _sqlite_search_rank(pk, text):
+    index = _index['index']
+    if index is None:
+        return 0.0
+    return index.cached_search(text).get(pk, 0.0)
+
+
+@receiver(connection_created)
+def register_search_rank_function(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        connection.connection.create_function('product_search_rank', 2, _sqlite_search_rank)  # not deterministic, reads the in-process index
+
+
+class ProductSearchFilter(SearchFilter):
+    """
+    Drop in replacement for SearchFilter on ProductViewSet, same ?search= param.
+    Results are annotated with search_rank, and ordered by it (then -id) unless another ?ordering= is given.
+    ?ordering=relevance asks for the rank ordering explicitly.
+    """
+    rank_field = 'search_rank'
+
+    def filter_queryset(self, request, queryset, view):
+        text = ' '.join(self.get_search_terms(request))
+        if not text:
+            return queryset
+
+        if uses_postgres(queryset):
+            query = SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+            queryset = queryset.filter(search_document=query).annotate(
+                **{self.rank_field: SearchRank(F('search_document'), query)}
+            )
+        else:
+            get_inverted_index()  # (re)build before the query runs, the sql function only reads it
+            rank = Func(F('id'), Value(text), function='product_search_rank', output_field=FloatField())
+            queryset = queryset.annotate(**{self.rank_field: rank}).filter(**{f'{self.rank_field}__gt': 0})
+
+        ordering = request.query_params.get('ordering', '')
+        if not ordering or ordering in RELEVANCE_ORDERINGS:
+            queryset = queryset.order_by(f'-{self.rank_field}', '-id')
+        return queryset
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 from decimal import Decimal
-from products.models import Category, Product, Review, ProductImage
+from products.models import Category, Product, Review, ProductImage, RelatedProduct
 from django.contrib.auth import get_user_model
 
 
@@ -9,13 +9,19 @@ class CategorySerializer(serializers.ModelSerializer):
         model = Category
         fields = ['id', 'name', 'description', 'product_count']
 
-    product_count = serializers.IntegerField(read_only=True, help_text="Return the number product in this category") # help_text for swagger show
+    product_count = serializers.IntegerField(read_only=True, help_text="Return the number product in this category") # help_text for swagger show, stored column (Category.product_count)
 
 class ProductImageSerializer(serializers.ModelSerializer):
     image= serializers.ImageField()
+    variants = serializers.DictField(child=serializers.CharField(), read_only=True, help_text="Resized copies: thumbnail, card, zoom, and *_webp of each")
     class Meta:
         model = ProductImage
-        fields = ['id', 'image']
+        fields = ['id', 'image', 'variants']
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if instance.variants.get('original'):  # local image backend, the image column holds a storage name
+            data['image'] = instance.variants['original']
+        return data
     def validate_image(self, value):
         # Limit file size to 1MB
         if value.size > 1 * 1024 * 1024:
@@ -26,6 +32,21 @@ class ProductImageSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Unsupported file type.")
         return value    
 
+class ProductImageUploadTicketSerializer(serializers.Serializer):
+    ticket = serializers.CharField()
+    upload_url = serializers.CharField(help_text="POST the image here as multipart 'file', together with fields")
+    fields = serializers.DictField(help_text="Form fields to send with the file")
+    expires_in = serializers.IntegerField(help_text="Seconds until the ticket expires")
+
+
+class ProductImageFinalizeSerializer(serializers.Serializer):
+    ticket = serializers.CharField()
+    # from cloudinary's upload response, not needed by the local backend
+    version = serializers.CharField(required=False)
+    format = serializers.CharField(required=False)
+    signature = serializers.CharField(required=False)
+
+
 """
 class ProductSerializer(serializers.Serializer):  # module 20.4
     id = serializers.IntegerField()
@@ -42,20 +63,72 @@ class ProductSerializer(serializers.Serializer):  # module 20.4
         return round(product.price * Decimal(1.1), 2)
 """
 
+def parse_field_list(value):
+    """'id, name,,price' -> ['id', 'name', 'price']"""
+    return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+
+class SparseFieldsMixin:
+    """
+    Response trimming driven by the serializer context (set by the viewset from the query string):
+     - context['fields']: only these fields (?fields=id,name,price), None = default fields
+     - context['expand']: fields in Meta.expandable_fields replaced by their nested serializer (?expand=category)
+    Meta.optional_fields are left out unless asked for in ?fields=.
+    Meta.field_columns maps a field to the model columns it reads, the viewset uses it for .only().
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        requested = self.context.get('fields')
+        for name in getattr(self.Meta, 'optional_fields', []):
+            if not requested or name not in requested:
+                fields.pop(name, None)
+        if requested:
+            fields = {name: field for name, field in fields.items() if name in requested}
+        for name, serializer_class in getattr(self.Meta, 'expandable_fields', {}).items():
+            if name in self.context.get('expand', ()) and name in fields:
+                fields[name] = serializer_class(source=fields[name].source, read_only=True)
+        return fields
+
+    @classmethod
+    def columns_for(cls, field_names):
+        column_map = getattr(cls.Meta, 'field_columns', {})
+        columns = set()
+        for name in field_names:
+            columns.update(column_map.get(name, [name]))
+        return columns
+
+
 """"""
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     images = ProductImageSerializer(many=True, read_only=True)
 
     class Meta:
         model = Product
-        fields = ['id', 'name', 'description', 'price','stock', 'category', 'price_with_tax', 'images']  # other, '__all__'
+        fields = ['id', 'name', 'description', 'price','stock', 'category', 'price_with_tax', 'images',
+                  'rating_avg', 'rating_count', 'rating_histogram', 'first_image']  # other, '__all__'
+        read_only_fields = ['rating_avg', 'rating_count']  # maintained from reviews, products/services.py
+        optional_fields = ['first_image']  # only with ?fields=...,first_image
+        expandable_fields = {'category': CategorySerializer}  # ?expand=category
+        field_columns = {  # model columns behind each field, fields missing here read a column of the same name
+            'images': [],
+            'first_image': [],
+            'price_with_tax': ['price'],
+            'rating_histogram': [f'stars_{star}' for star in range(1, 6)],
+        }
+        prefetch_fields = {'images', 'first_image'}  # fields that need prefetch_related('images')
 
     price_with_tax = serializers.SerializerMethodField(method_name='calculate_tax')  
+    rating_histogram = serializers.DictField(child=serializers.IntegerField(), read_only=True, help_text="Number of reviews per star, 1-5")
     #category = serializers.HyperlinkedRelatedField(queryset=Category.objects.all(), view_name='products:view-specific-category')
 	# ^ problem with creation new elem in post method. 
     category = serializers.PrimaryKeyRelatedField(queryset=Category.objects.all())
+    first_image = serializers.SerializerMethodField(help_text="First image of the product, for listing grids (?fields=...,first_image)")
     def calculate_tax(self, product):
         return round(product.price * Decimal(1.1), 2)
+    def get_first_image(self, product):
+        images = product.images.all()  # prefetched
+        return ProductImageSerializer(images[0], context=self.context).data if images else None
 	# serializer validation
     def validate_price(self, price):
         if price < 0:
@@ -64,29 +137,85 @@ class ProductSerializer(serializers.ModelSerializer):
 
 
 
+class ProductBulkUpdateItemSerializer(serializers.Serializer):
+    """one row of POST /api/products/bulk-update/, only shape and ranges, ids are checked with one query for all rows"""
+    id = serializers.IntegerField(min_value=1, max_value=2 ** 63 - 1)  # bigint primary key
+    stock = serializers.IntegerField(min_value=0, required=False)
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0'), required=False)
+
+    def validate(self, attrs):
+        if 'stock' not in attrs and 'price' not in attrs:
+            raise serializers.ValidationError("Give stock, price or both")
+        return attrs
+
+
+class ProductBulkUpdateResultSerializer(serializers.Serializer):
+    updated = serializers.IntegerField()
+    errors = serializers.ListField(child=serializers.DictField(), help_text="[{index, id, errors}] for rejected rows")
+
+
+class CategoryFacetSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    count = serializers.IntegerField()
+
+
+class PriceFacetSerializer(serializers.Serializer):
+    min = serializers.DecimalField(max_digits=10, decimal_places=2)
+    max = serializers.DecimalField(max_digits=10, decimal_places=2, allow_null=True, help_text="null for the last, open ended bucket")
+    count = serializers.IntegerField()
+
+
+class ProductFacetsSerializer(serializers.Serializer):
+    total = serializers.IntegerField()
+    category = CategoryFacetSerializer(many=True)
+    price = PriceFacetSerializer(many=True)
+
+
+class RelatedProductSerializer(serializers.ModelSerializer):
+    """a RelatedProduct row, flattened to the related product"""
+    id = serializers.IntegerField(source='related.id')
+    name = serializers.CharField(source='related.name')
+    price = serializers.DecimalField(source='related.price', max_digits=10, decimal_places=2)
+    score = serializers.IntegerField(help_text="Number of orders that had both products")
+
+    class Meta:
+        model = RelatedProduct
+        fields = ['id', 'name', 'price', 'score', 'rank']
+
+
+class AutocompleteSuggestionSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+
+
+class AutocompleteSerializer(serializers.Serializer):
+    products = AutocompleteSuggestionSerializer(many=True, help_text="Most popular first")
+    categories = AutocompleteSuggestionSerializer(many=True)
+
+
 class SimpleUserSerializer(serializers.ModelSerializer):
     name = serializers.SerializerMethodField(method_name='get_current_user_name')
     
     class Meta:
         model = get_user_model()
         fields = ['id', 'name']
+        ref_name = 'ReviewUser'  # swagger, orders.serializers has its own SimpleUserSerializer
 
     def get_current_user_name(self, obj):
         return obj.get_full_name()
 
 
 class ReviewSerializer(serializers.ModelSerializer):
-    # user = SimpleUserSerializer()
-    user = serializers.SerializerMethodField(method_name='get_user')
+    # nested serializer instead of a SerializerMethodField building a new SimpleUserSerializer per row,
+    # ReviewViewSet select_related('user') so a page of reviews doesn't query users one by one
+    user = SimpleUserSerializer(read_only=True)
 
     class Meta:
         model = Review
         fields = ['id', 'user', 'product', 'ratings', 'comment']
         read_only_fields = ['user', 'product']  # DRF's Browsable API automatically hides read-only fields
 
-    def get_user(self, obj):
-        return SimpleUserSerializer(obj.user).data
-
     def create(self, validated_data):
         # product_id = self.context['product_id']        
         # return Review.objects.create(product_id=product_id, **validated_data)
@@ -95,3 +224,9 @@ class ReviewSerializer(serializers.ModelSerializer):
         product_id = self.context['product_id']
         # Explicitly assign user and product
         return Review.objects.create(user=user, product_id=product_id, **validated_data)
+
+
+class ReviewSummarySerializer(serializers.Serializer):
+    count = serializers.IntegerField()
+    average = serializers.DecimalField(max_digits=3, decimal_places=2)
+    histogram = serializers.DictField(child=serializers.IntegerField(), help_text="Number of reviews per star, 1-5")
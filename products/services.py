@@ -0,0 +1,271 @@
+from decimal import Decimal, InvalidOperation
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.db.models import Avg, Case, Count, DecimalField, F, FloatField, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Cast, Coalesce, Greatest, Now
+from products.models import Category, Product, Review
+from products.cache import invalidate_catalog
+from products.serializers import ProductBulkUpdateItemSerializer
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from rest_framework.settings import api_settings
+
+STARS = range(1, 6)
+RATING_FIELDS = ['rating_avg', 'rating_count'] + [f'stars_{star}' for star in STARS]
+
+
+class ProductRatingService:
+    """Keeps Product.rating_avg / rating_count / stars_1..5 in sync with its reviews without recounting."""
+
+    @staticmethod
+    def update_ratings(product_id, added=None, removed=None):
+        """
+        added: rating of a new review (or the new value of an edited one)
+        removed: rating of a deleted review (or the old value of an edited one)
+        A single UPDATE, all F() values refer to the row before the update so concurrent reviews can't lose counts.
+        """
+        if added == removed:
+            return
+        count_delta = (added is not None) - (removed is not None)
+        star_sum = sum(F(f'stars_{star}') * star for star in STARS) + (added or 0) - (removed or 0)
+        new_count = F('rating_count') + count_delta
+
+        updates = {
+            'rating_count': new_count,
+            'rating_avg': Case(
+                When(rating_count__lte=-count_delta, then=Value(0)),
+                default=Cast(Cast(star_sum, FloatField()) / Cast(new_count, FloatField()),
+                             DecimalField(max_digits=3, decimal_places=2)),
+                output_field=DecimalField(max_digits=3, decimal_places=2),
+            ),
+            'updated_at': Now(),
+        }
+        if added is not None:
+            updates[f'stars_{added}'] = F(f'stars_{added}') + 1
+        if removed is not None:
+            updates[f'stars_{removed}'] = F(f'stars_{removed}') - 1
+
+        Product.objects.filter(pk=product_id).update(**updates)
+        invalidate_catalog(product_id=product_id)
+
+    @staticmethod
+    def rebuild_ratings(batch_size=1000):
+        """Recompute the aggregates of every product from the review table, returns the number of rated products."""
+        stats = (
+            Review.objects.order_by().values('product_id')
+            .annotate(count=Count('id'), avg=Avg('ratings'),
+                      **{f'stars_{star}': Count('id', filter=Q(ratings=star)) for star in STARS})
+        )
+        now = timezone.now()  # updated_at moves like in update_ratings, Last-Modified/ETag validators see the change
+        with transaction.atomic():
+            Product.objects.exclude(rating_count=0).update(
+                rating_avg=0, rating_count=0, updated_at=now, **{f'stars_{star}': 0 for star in STARS}
+            )
+            batch = []
+            rated = 0
+            for row in stats.iterator(chunk_size=batch_size):
+                batch.append(Product(
+                    pk=row['product_id'],
+                    rating_avg=Decimal(str(round(row['avg'], 2))),
+                    rating_count=row['count'],
+                    updated_at=now,
+                    **{f'stars_{star}': row[f'stars_{star}'] for star in STARS},
+                ))
+                if len(batch) >= batch_size:
+                    Product.objects.bulk_update(batch, RATING_FIELDS + ['updated_at'])
+                    rated += len(batch)
+                    batch = []
+            if batch:
+                Product.objects.bulk_update(batch, RATING_FIELDS + ['updated_at'])
+                rated += len(batch)
+            invalidate_catalog()
+        return rated
+
+
+class ProductBulkUpdateService:
+    """Stock/price updates for many products at once, validated together and written with bulk_update."""
+    max_rows = 10000
+    batch_size = 1000
+
+    @staticmethod
+    def validate_row(serializer, row):
+        """
+        one row against the fields and validate() of one ProductBulkUpdateItemSerializer, returns (data, errors).
+        The same rules and messages as serializer.is_valid(), without building a serializer
+        (and deep copying its fields) for each of up to max_rows rows.
+        """
+        if not isinstance(row, dict):
+            return None, {api_settings.NON_FIELD_ERRORS_KEY: [f'Invalid data. Expected a dictionary, but got {type(row).__name__}.']}
+        data, errors = {}, {}
+        for name, field in serializer.fields.items():
+            if name not in row:
+                if field.required:
+                    errors[name] = [field.error_messages['required']]
+                continue
+            try:
+                data[name] = field.run_validation(row[name])
+            except serializers.ValidationError as error:
+                errors[name] = error.detail
+        if not errors:
+            try:
+                data = serializer.validate(data)
+            except serializers.ValidationError as error:
+                errors = serializers.as_serializer_error(error)
+        return data, errors
+
+    @staticmethod
+    def validate(rows):
+        """returns (valid rows, errors), errors are [{'index', 'id', 'errors'}] in row order"""
+        errors = {}
+        valid = {}
+        serializer = ProductBulkUpdateItemSerializer()  # built once for every row
+        for index, row in enumerate(rows):
+            data, row_errors = ProductBulkUpdateService.validate_row(serializer, row)
+            if row_errors:
+                errors[index] = row_errors
+            elif data['id'] in valid:
+                errors[index] = {'id': ['Duplicate id in this request']}
+            else:
+                valid[data['id']] = (index, data)
+
+        existing = set(Product.objects.filter(pk__in=valid).values_list('id', flat=True))  # one query for every id
+        for product_id in set(valid) - existing:
+            index, _ = valid.pop(product_id)
+            errors[index] = {'id': [f'Product {product_id} does not exist']}
+
+        error_list = [
+            {'index': index, 'id': rows[index].get('id') if isinstance(rows[index], dict) else None, 'errors': errors[index]}
+            for index in sorted(errors)
+        ]
+        return [data for _, data in valid.values()], error_list
+
+    @staticmethod
+    def apply(rows):
+        """
+        rows: validated {id, stock?, price?}, all applied in one transaction.
+        One UPDATE ... FROM (VALUES ...) per batch, a missing stock/price is NULL in the VALUES list
+        and keeps the current column value (COALESCE). bulk_update() would build a CASE WHEN per row
+        and field in python, which is most of the time for thousands of rows.
+        """
+        if not rows:
+            return 0
+        now = timezone.now()
+        with transaction.atomic():
+            if connection.vendor in ('postgresql', 'sqlite'):
+                batch_size = min(ProductBulkUpdateService.batch_size, connection.ops.bulk_batch_size(['id', 'stock', 'price'], rows))
+                for start in range(0, len(rows), batch_size):
+                    ProductBulkUpdateService._update_from_values(rows[start:start + batch_size], now)
+            else:  # no UPDATE ... FROM, bulk_update per set of changed fields
+                groups = {}
+                for row in rows:
+                    groups.setdefault(tuple(field for field in ('stock', 'price') if field in row), []).append(Product(updated_at=now, **row))
+                for fields, products in groups.items():
+                    Product.objects.bulk_update(products, [*fields, 'updated_at'], batch_size=ProductBulkUpdateService.batch_size)
+            invalidate_catalog()  # once for the whole request
+        return len(rows)
+
+    @staticmethod
+    def _update_from_values(rows, now):
+        qn = connection.ops.quote_name
+        table = qn(Product._meta.db_table)
+        price_field = Product._meta.get_field('price')
+        row_sql = '(CAST(%s AS bigint), CAST(%s AS integer), CAST(%s AS numeric(10, 2)))'
+        params = []
+        for row in rows:
+            price = row.get('price')
+            if price is not None:
+                price = connection.ops.adapt_decimalfield_value(price, price_field.max_digits, price_field.decimal_places)
+            params += [row['id'], row.get('stock'), price]
+        sql = (
+            f"WITH v (id, stock, price) AS (VALUES {', '.join([row_sql] * len(rows))}) "
+            f"UPDATE {table} SET {qn('stock')} = COALESCE(v.stock, {table}.{qn('stock')}), "
+            f"{qn('price')} = COALESCE(v.price, {table}.{qn('price')}), {qn('updated_at')} = %s "
+            f"FROM v WHERE {table}.{qn('id')} = v.id"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + [connection.ops.adapt_datetimefield_value(now)])
+
+
+class ProductFacetService:
+    """Category and price bucket counts of a (filtered) product queryset, one GROUP BY query for both."""
+    max_edges = 20
+
+    @staticmethod
+    def parse_price_edges(value=None):
+        """?price_edges=0,50,100 -> [Decimal('0'), Decimal('50'), Decimal('100')], settings default when not given"""
+        if not value:
+            return [Decimal(str(edge)) for edge in settings.PRODUCT_PRICE_FACET_EDGES]
+        try:
+            edges = [Decimal(edge.strip()) for edge in value.split(',') if edge.strip()]
+        except InvalidOperation:
+            raise ValidationError({'price_edges': 'Comma separated numbers, eg. 0,50,100'})
+        if not 2 <= len(edges) <= ProductFacetService.max_edges or any(a >= b for a, b in zip(edges, edges[1:])):
+            raise ValidationError({'price_edges': f'2 to {ProductFacetService.max_edges} increasing numbers'})
+        return edges
+
+    @staticmethod
+    def price_bucket(edges):
+        # bucket i is [edges[i], edges[i + 1]), the first one also takes anything cheaper, the last one has no upper bound
+        return Case(
+            *[When(price__lt=upper, then=Value(i)) for i, upper in enumerate(edges[1:])],
+            default=Value(len(edges) - 1),
+            output_field=IntegerField(),
+        )
+
+    @staticmethod
+    def facet_counts(queryset, edges):
+        rows = (
+            queryset.order_by()
+            .values('category_id', 'category__name', bucket=ProductFacetService.price_bucket(edges))
+            .annotate(count=Count('id'))
+        )
+        categories = {}
+        buckets = [0] * len(edges)
+        for row in rows:
+            category = categories.setdefault(row['category_id'], {'id': row['category_id'], 'name': row['category__name'], 'count': 0})
+            category['count'] += row['count']
+            buckets[row['bucket']] += row['count']
+        return {
+            'total': sum(buckets),
+            'category': sorted(categories.values(), key=lambda category: (-category['count'], category['id'])),
+            'price': [
+                {'min': edge, 'max': edges[i + 1] if i + 1 < len(edges) else None, 'count': buckets[i]}
+                for i, edge in enumerate(edges)
+            ],
+        }
+
+
+class CategoryService:
+    """Keeps Category.product_count equal to the number of products in it."""
+
+    @staticmethod
+    def adjust_product_count(category_id, delta):
+        if category_id is None or not delta:
+            return
+        Category.objects.filter(pk=category_id).update(
+            product_count=Greatest(F('product_count') + delta, 0), updated_at=Now()
+        )
+
+    @staticmethod
+    def actual_product_count():
+        return Coalesce(Subquery(
+            Product.objects.filter(category=OuterRef('pk')).order_by()
+            .values('category').annotate(total=Count('id')).values('total')
+        ), 0)
+
+    @staticmethod
+    def reconcile_product_counts(dry_run=False):
+        """Fix categories whose stored product_count drifted (bulk_create, raw sql, ...), returns [(category, stored, actual)]"""
+        with transaction.atomic():
+            drifted = list(
+                Category.objects.select_for_update()
+                .annotate(actual=CategoryService.actual_product_count())
+                .exclude(product_count=F('actual'))
+                .values_list('pk', 'name', 'product_count', 'actual')
+            )
+            if drifted and not dry_run:
+                Category.objects.filter(pk__in=[row[0] for row in drifted]).update(
+                    product_count=CategoryService.actual_product_count(), updated_at=Now()
+                )
+        return [(f'{name} ({pk})', stored, actual) for pk, name, stored, actual in drifted]
@@ -0,0 +1,75 @@
+# products, signals.py:
+from django.db.models.signals import post_save, post_delete
+from django.db.models.functions import Now
+from django.dispatch import receiver
+from products.models import Product, ProductImage, ProductRanking, Category
+from products.cache import invalidate_autocomplete, invalidate_catalog
+from products.search import update_search_document
+from products.services import CategoryService
+
+SEARCH_DOCUMENT_FIELDS = {'name', 'description'}
+
+
+@receiver([post_save, post_delete], sender=Product)
+def product_changed(sender, instance, **kwargs):
+    invalidate_catalog(product_id=instance.pk)
+
+
+@receiver(post_save, sender=Product)
+def product_name_changed(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and 'name' not in update_fields:
+        return
+    if created or getattr(instance, '_loaded_name', None) != instance.name:
+        invalidate_autocomplete()
+    instance._loaded_name = instance.name
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    invalidate_autocomplete()
+
+
+@receiver(post_save, sender=Product)
+def refresh_search_document(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not SEARCH_DOCUMENT_FIELDS.intersection(update_fields):
+        return
+    update_search_document(Product.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=Product)
+def update_category_count_on_save(sender, instance, created, **kwargs):
+    if created:
+        CategoryService.adjust_product_count(instance.category_id, +1)
+    else:
+        old_category_id = getattr(instance, '_loaded_category_id', None)
+        if old_category_id is not None and old_category_id != instance.category_id:  # re-categorised
+            CategoryService.adjust_product_count(old_category_id, -1)
+            CategoryService.adjust_product_count(instance.category_id, +1)
+    instance._loaded_category_id = instance.category_id
+
+
+@receiver(post_save, sender=Product)
+def create_ranking(sender, instance, created, **kwargs):
+    # ?ordering=bestselling / trending inner join the ranking, a new product starts at zero
+    if created:
+        ProductRanking.objects.create(product=instance)
+
+
+@receiver(post_delete, sender=Product)
+def update_category_count_on_delete(sender, instance, **kwargs):
+    # runs inside the delete's transaction, also for queryset.delete() and category cascades
+    CategoryService.adjust_product_count(instance.category_id, -1)
+
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def product_image_changed(sender, instance, **kwargs):
+    # images are part of the product response, so they move its Last-Modified/ETag too
+    Product.objects.filter(pk=instance.product_id).update(updated_at=Now())
+    invalidate_catalog(product_id=instance.product_id)
+
+
+@receiver([post_save, post_delete], sender=Category)
+def category_changed(sender, instance, **kwargs):
+    # category only shows up as an id on product pages, list filters by category still change
+    invalidate_catalog()
+    invalidate_autocomplete()
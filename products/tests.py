@@ -1,3 +1,895 @@
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from decimal import Decimal
+from unittest import mock
+import cloudinary
+from cloudinary import CloudinaryResource
+from cloudinary.utils import api_sign_request
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from PIL import Image as PILImage
+from products import autocomplete
+from products.autocomplete import Autocomplete
+from products.image_backends import CloudinaryImageBackend, LocalImageBackend, UploadError, variant_names
+from products.models import Category, Product, ProductImage, ProductRanking, Review
+from products.paginations import ProductKeysetPagination
+from products.serializers import ProductBulkUpdateItemSerializer
+from products.services import CategoryService, ProductBulkUpdateService
+from products.views import ProductViewSet
+from users.models import User
 
-# Create your tests here.
+
+class CatalogCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Garden')
+        cls.product = Product.objects.create(name='Hose', description='Green', price=10, stock=3, category=cls.category)
+        cls.admin = User.objects.create(email='admin@example.com', is_staff=True)
+        cls.user = User.objects.create(email='user@example.com')
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.detail_url = f'/api/products/{self.product.pk}/'
+
+    def cache_header(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response['X-Cache']
+
+    def warm(self):
+        for url in ['/api/products/', self.detail_url]:
+            self.assertEqual(self.cache_header(url), 'MISS')
+            self.assertEqual(self.cache_header(url), 'HIT')
+
+    def test_product_write_is_a_miss_after_commit(self):
+        self.warm()
+        with self.captureOnCommitCallbacks() as callbacks:
+            Product.objects.filter(pk=self.product.pk).update(stock=0)  # no signal, stays cached
+            product = Product.objects.get(pk=self.product.pk)
+            product.price = 12
+            product.save()
+            self.assertEqual(self.cache_header(self.detail_url), 'HIT')  # not committed yet, the old version serves
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.cache_header('/api/products/'), 'MISS')
+        response = self.client.get(self.detail_url)
+        self.assertEqual((response['X-Cache'], response.data['price']), ('MISS', Decimal('12.00')))
+
+    def test_category_write_is_a_miss_for_lists(self):
+        self.warm()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category.name = 'Outdoor'
+            self.category.save()
+        self.assertEqual(self.cache_header('/api/products/'), 'MISS')
+        self.assertEqual(self.cache_header('/api/products/', category_id=self.category.pk), 'MISS')
+
+    def test_review_write_is_a_miss_for_its_product(self):
+        self.warm()
+        reviewer = APIClient()
+        reviewer.force_authenticate(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = reviewer.post(f'{self.detail_url}reviews/', {'ratings': 4, 'comment': 'ok'})
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get(self.detail_url)
+        self.assertEqual((response['X-Cache'], response.data['rating_count']), ('MISS', 1))
+        self.assertEqual(self.cache_header('/api/products/'), 'MISS')  # list rows show the rating too
+
+    def test_stats_count_hits_and_misses_for_staff_only(self):
+        self.warm()
+        self.cache_header('/api/products/', search='hose')
+        self.assertEqual(self.client.get('/api/products/cache-stats/').status_code, 403)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/api/products/cache-stats/').status_code, 403)
+        self.client.force_authenticate(self.admin)
+        response = self.client.get('/api/products/cache-stats/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            {key: response.data[key] for key in ('hits', 'misses', 'hit_ratio')}, {'hits': 2, 'misses': 3, 'hit_ratio': 0.4}
+        )
+
+
+class ReviewListQueryTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Electronics')
+        cls.product = Product.objects.create(name='Phone', description='A phone', price=100, stock=5, category=category)
+        for i, ratings in enumerate([5, 4, 4, 2, 1, 5, 3]):
+            user = User.objects.create(email=f'user{i}@example.com', first_name=f'User{i}')
+            Review.objects.create(product=cls.product, user=user, ratings=ratings, comment='ok')
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_review_list_query_count_does_not_grow_with_reviews(self):
+        # 1 COUNT(*) for pagination + 1 SELECT reviews JOIN users
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/api/products/{self.product.pk}/reviews/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 7)
+        self.assertEqual(set(response.data['results'][0]['user']), {'id', 'name'})
+
+    def test_review_summary_is_a_single_aggregate_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/products/{self.product.pk}/reviews/summary/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 7)
+        self.assertEqual(response.data['average'], Decimal('3.43'))
+        self.assertEqual(response.data['histogram'], {'1': 1, '2': 1, '3': 1, '4': 2, '5': 2})
+
+
+class ProductStreamTest(TestCase):
+    url = '/api/products2/product-list/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Books')
+
+    def add_products(self, count):
+        Product.objects.bulk_create(
+            Product(name=f'Book {i}', description='d' * 200, price=i + 1, stock=1, category=self.category)
+            for i in range(count)
+        )
+
+    def stream_peak(self, stream_format):
+        # peak traced memory while the whole streamed body is consumed
+        tracemalloc.start()
+        try:
+            response = self.client.get(self.url, {'stream': stream_format, 'chunk_size': 100})
+            size = sum(len(chunk) for chunk in response.streaming_content)  # don't keep the body around
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return size, peak
+
+    def test_json_and_ndjson_output(self):
+        self.add_products(5)
+        response = self.client.get(self.url, {'stream': 'json'})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual([item['name'] for item in data], [f'Book {i}' for i in range(5)])
+
+        response = self.client.get(self.url, {'stream': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['name'] for line in lines], [f'Book {i}' for i in range(5)])
+
+        self.assertEqual(self.client.get(self.url, {'stream': 'xml'}).status_code, 400)
+
+    def test_memory_stays_flat_with_catalog_size(self):
+        self.add_products(300)
+        small_size, small = self.stream_peak('ndjson')
+        self.add_products(2700)
+        large_size, large = self.stream_peak('ndjson')
+        self.assertGreater(large_size, small_size * 9)
+        # 10x the rows, the peak is bounded by one chunk, not by the catalog
+        self.assertLess(large, small * 2)
+
+
+class ConditionalGetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Toys')
+        cls.product = Product.objects.create(name='Ball', description='Red ball', price=5, stock=3, category=cls.category)
+
+    def setUp(self):
+        cache.clear()  # catalog versions only move on commit, don't reuse entries of other tests
+        self.client = APIClient()
+
+    def test_list_answers_304_while_unchanged(self):
+        response = self.client.get('/api/categories/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+
+        with self.assertNumQueries(1):  # only the MAX(updated_at)/COUNT(*) aggregate
+            response = self.client.get('/api/categories/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Category.objects.create(name='Games')
+        response = self.client.get('/api/categories/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_product_validators_survive_the_response_cache(self):
+        url = f'/api/products/{self.product.pk}/'
+        first = self.client.get(url)
+        self.assertEqual(first['X-Cache'], 'MISS')
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['X-Cache'], 'HIT')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.images.create()  # touches the product's updated_at
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+
+    def test_list_etag_depends_on_query(self):
+        first = self.client.get('/api/products/', {'price__gt': 1})
+        response = self.client.get('/api/products/', {'price__gt': 10}, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 0)
+
+
+class SparseFieldsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Toys', description='Fun')
+        cls.product = Product.objects.create(name='Ball', description='Red ball', price=5, stock=3, category=cls.category)
+
+    def setUp(self):
+        cache.clear()
+
+    def view_queryset(self, params, action='list'):
+        view = ProductViewSet(action=action, format_kwarg=None, kwargs={})
+        view.request = Request(APIRequestFactory().get('/api/products/', params))
+        return view.get_queryset()
+
+    def test_payload_and_columns_are_trimmed(self):
+        with self.assertNumQueries(3):  # the ETag aggregate, COUNT, SELECT: no images prefetch
+            response = self.client.get('/api/products/', {'fields': 'id,name,price_with_tax'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [{'id': self.product.pk, 'name': 'Ball', 'price_with_tax': Decimal('5.50')}])
+
+        queryset = self.view_queryset({'fields': 'id,name,price_with_tax', 'ordering': '-rating_avg'})
+        self.assertEqual(queryset._prefetch_related_lookups, ())
+        columns, defer = queryset.query.deferred_loading
+        self.assertFalse(defer)
+        self.assertEqual(set(columns), {'id', 'name', 'price', 'updated_at', 'rating_avg'})
+
+        queryset = self.view_queryset({'fields': 'id,first_image'})
+        self.assertEqual(queryset._prefetch_related_lookups, ('images',))
+        self.assertEqual(self.view_queryset({})._prefetch_related_lookups, ('images',))
+
+    def test_every_ordering_field_is_selected(self):
+        Product.objects.bulk_create(Product(name=f'Kite {n}', description='Kite', price=n, stock=1, category=self.category) for n in range(10))
+        params = {'fields': 'id,name', 'ordering': 'price, -rating_count', 'pagination': 'cursor', 'count': 'false'}
+        columns, _ = self.view_queryset(params).query.deferred_loading
+        self.assertEqual(set(columns), {'id', 'name', 'updated_at', 'price', 'rating_count'})
+        with self.assertNumQueries(2):  # the ETag aggregate, SELECT: the cursor keys are already loaded
+            response = self.client.get('/api/products/', params)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.data['next'])
+
+    def test_expand_nests_the_category(self):
+        response = self.client.get(f'/api/products/{self.product.pk}/', {'fields': 'id', 'expand': 'category'})
+        self.assertEqual(set(response.data), {'id', 'category'})
+        self.assertEqual(response.data['category']['name'], 'Toys')
+        self.assertIn('category__name', self.view_queryset({'fields': 'id', 'expand': 'category'}).query.deferred_loading[0])
+
+    def test_unknown_names_are_rejected(self):
+        for params in [{'fields': 'bogus'}, {'fields': 'name,bogus'}]:
+            response = self.client.get('/api/products/', params)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data['fields'], ["Unknown field 'bogus'"])
+        self.assertEqual(self.client.get(f'/api/products/{self.product.pk}/', {'fields': 'bogus'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/products/', {'expand': 'images'}).status_code, 400)
+
+
+class ImportCatalogTest(TestCase):
+    fixture_path = os.path.join(settings.BASE_DIR, 'fixtures', 'products_data_cleaned.json')
+
+    def run_import(self, path, *args):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_catalog', path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def write(self, name, content):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, name)
+        with open(path, 'w', encoding='utf-8', newline='') as file:
+            file.write(content)
+        return path
+
+    def test_fixture_import_is_an_idempotent_upsert(self):
+        with mock.patch.object(connection.ops, 'sequence_reset_sql', wraps=connection.ops.sequence_reset_sql) as reset:
+            output, _ = self.run_import(self.fixture_path, '--batch-size', '7')
+        self.assertIn('Imported 40 products', output)
+        reset.assert_called_once()
+        self.assertEqual(reset.call_args.args[1], [Category, Product])
+        Product.objects.filter(pk=1).update(name='changed', stock=0)
+
+        output, _ = self.run_import(self.fixture_path)
+        self.assertIn('Imported 40 products', output)
+        self.assertEqual((Product.objects.count(), Category.objects.count()), (40, 4))
+        self.assertEqual(Product.objects.values_list('name', 'stock').get(pk=1), ('Smartphone', 157))
+        for category in Category.objects.all():  # counts reconciled after the bulk writes
+            self.assertEqual(category.product_count, category.products.count())
+        self.assertEqual(ProductRanking.objects.count(), 40)
+        self.assertGreater(Product.objects.create(name='next', description='', price=1, stock=1, category_id=1).pk, 40)
+
+    def test_bad_rows_are_counted_and_skipped(self):
+        Category.objects.create(name='Books')
+        ndjson = '\n'.join([
+            '{"name": "A", "description": "d", "price": "1.50", "stock": 1, "category": "Books"}',
+            '[1, 2]',
+            '{"model": "products.product", "fields": {"name": "B", "description": "d", "price": "2", "stock": 1, "category": "Books"}}',
+            '{"name": "C", "description": "d", "price": "-x", "stock": 1, "category": "Books"}',
+            '"text"',
+        ])
+        output, errors = self.run_import(self.write('feed.ndjson', ndjson))
+        self.assertIn('Imported 2 products', output)
+        self.assertIn('skipped 3', output)
+        self.assertIn('row 2: expected an object', errors)
+        self.assertEqual(set(Product.objects.values_list('name', flat=True)), {'A', 'B'})
+
+        csv_rows = 'id,name,description,price,stock,category\n,D,d,3.00,2,Books\n,E,d,3.00,lots,Books\n,F,d,3.00,1,\n'
+        output, errors = self.run_import(self.write('feed.csv', csv_rows))
+        self.assertIn('Imported 1 products', output)
+        self.assertIn('skipped 2', output)
+        self.assertEqual(Category.objects.get(name='Books').product_count, 3)
+
+
+class ProductRatingTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Electronics')
+        cls.product = Product.objects.create(name='Phone', description='A phone', price=100, stock=5, category=category)
+        cls.users = [User.objects.create(email=f'rater{i}@example.com', first_name=f'Rater{i}') for i in range(3)]
+
+    def setUp(self):
+        self.url = f'/api/products/{self.product.pk}/reviews/'
+
+    def review(self, user, method, url, data=None):
+        client = APIClient()
+        client.force_authenticate(user)
+        return getattr(client, method)(url, data)
+
+    def ratings(self):
+        product = Product.objects.get(pk=self.product.pk)
+        return product.rating_avg, product.rating_count, product.rating_histogram
+
+    def test_reviews_update_the_aggregates_incrementally(self):
+        ids = [self.review(user, 'post', self.url, {'ratings': rating, 'comment': 'ok'}).data['id']
+               for user, rating in zip(self.users, [5, 4, 2])]
+        self.assertEqual(self.ratings(), (Decimal('3.67'), 3, {'1': 0, '2': 1, '3': 0, '4': 1, '5': 1}))
+
+        self.assertEqual(self.review(self.users[2], 'patch', f'{self.url}{ids[2]}/', {'ratings': 5}).status_code, 200)
+        self.assertEqual(self.ratings(), (Decimal('4.67'), 3, {'1': 0, '2': 0, '3': 0, '4': 1, '5': 2}))
+
+        for user, pk in zip(self.users, ids):
+            self.assertEqual(self.review(user, 'delete', f'{self.url}{pk}/').status_code, 204)
+        self.assertEqual(self.ratings(), (Decimal('0'), 0, {str(star): 0 for star in range(1, 6)}))
+
+    def test_rebuild_repairs_drift_and_moves_updated_at(self):
+        for user, rating in zip(self.users, [5, 3, 3]):
+            Review.objects.create(product=self.product, user=user, ratings=rating, comment='ok')
+        Product.objects.filter(pk=self.product.pk).update(rating_avg=1, rating_count=9, stars_1=9, stars_3=0, stars_5=0)
+        before = Product.objects.get(pk=self.product.pk).updated_at
+
+        call_command('rebuild_ratings', stdout=io.StringIO())
+        self.assertEqual(self.ratings(), (Decimal('3.67'), 3, {'1': 0, '2': 0, '3': 2, '4': 0, '5': 1}))
+        self.assertGreater(Product.objects.get(pk=self.product.pk).updated_at, before)  # ETag/Last-Modified change
+
+
+class ProductSearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Home')
+        cls.by_name = [
+            Product.objects.create(name=f'Desk lamp {i}', description='Bright', price=30 - i, stock=1, category=category)
+            for i in range(3)
+        ]
+        cls.by_description = [
+            Product.objects.create(name=f'Desk {i}', description='Comes with a lamp', price=10 + i, stock=1, category=category)
+            for i in range(3)
+        ]
+        Product.objects.create(name='Chair', description='Wooden', price=5, stock=1, category=category)
+
+    def setUp(self):
+        cache.clear()  # new catalog version, the index is rebuilt from this test's rows
+
+    def ids(self, response):
+        return [product['id'] for product in response.data['results']]
+
+    def test_name_matches_rank_above_description_matches(self):
+        response = self.client.get('/api/products/', {'search': 'lamp'})
+        expected = [product.pk for product in reversed(self.by_name)] + [product.pk for product in reversed(self.by_description)]
+        self.assertEqual(self.ids(response), expected)  # rank, then -id
+        self.assertEqual(self.ids(self.client.get('/api/products/', {'search': 'lamp', 'ordering': 'relevance'})), expected)
+        self.assertEqual(self.ids(self.client.get('/api/products/', {'search': 'desk lamp'})), expected)  # every term must match
+
+        by_price = self.ids(self.client.get('/api/products/', {'search': 'lamp', 'ordering': 'price'}))
+        self.assertEqual(by_price[0], self.by_description[0].pk)
+        self.assertEqual(self.client.get('/api/products/', {'search': 'sofa'}).data['count'], 0)
+
+    def test_keyset_pagination_over_the_rank(self):
+        expected = self.ids(self.client.get('/api/products/', {'search': 'lamp'}))
+        seen, url, params = [], '/api/products/', {'search': 'lamp', 'pagination': 'cursor'}
+        with mock.patch.object(ProductKeysetPagination, 'page_size', 4):  # a page boundary inside the name matches' rank
+            while url:
+                response = self.client.get(url, params)
+                seen += self.ids(response)
+                url, params = response.data['next'], None
+            self.assertEqual(seen, expected)
+            previous = self.client.get(response.data['previous'])
+            self.assertEqual(self.ids(previous), expected[:4])
+
+    def test_index_follows_catalog_changes(self):
+        self.assertEqual(self.client.get('/api/products/', {'search': 'zebra'}).data['count'], 0)
+        with self.captureOnCommitCallbacks(execute=True):  # post_save bumps the catalog version on commit
+            zebra = Product.objects.create(name='Zebra lamp', description='Striped', price=9, stock=1, category=self.by_name[0].category)
+        response = self.client.get('/api/products/', {'search': 'zebra'})
+        self.assertEqual(self.ids(response), [zebra.pk])
+
+
+class CategoryProductCountTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.books, cls.games = Category.objects.create(name='Books'), Category.objects.create(name='Games')
+
+    def counts(self):
+        return list(Category.objects.order_by('pk').values_list('product_count', flat=True))
+
+    def add(self, category, name):
+        return Product.objects.create(name=name, description=name, price=1, stock=1, category=category)
+
+    def test_create_move_and_delete(self):
+        products = [self.add(self.books, f'Book {i}') for i in range(3)]
+        self.assertEqual(self.counts(), [3, 0])
+
+        moved = Product.objects.get(pk=products[0].pk)  # loaded: _loaded_category_id comes from from_db
+        moved.category = self.games
+        moved.save()
+        self.assertEqual(self.counts(), [2, 1])
+        moved.name = 'renamed'
+        moved.save()  # same instance, no second move
+        self.assertEqual(self.counts(), [2, 1])
+
+        products[1].category = self.games  # created instance, the signal remembered its category
+        products[1].save()
+        self.assertEqual(self.counts(), [1, 2])
+
+        products[2].delete()
+        Product.objects.filter(category=self.games).delete()
+        self.assertEqual(self.counts(), [0, 0])
+
+    def test_reconcile_and_dry_run(self):
+        self.add(self.books, 'Book')
+        Product.objects.bulk_create([Product(name=f'Game {i}', description='g', price=1, stock=1, category=self.games) for i in range(2)])
+        self.assertEqual(self.counts(), [1, 0])  # bulk_create sends no signals
+
+        out = io.StringIO()
+        call_command('reconcile_category_counts', '--dry-run', stdout=out)
+        self.assertIn(f'Games ({self.games.pk}): stored 0, actual 2', out.getvalue())
+        self.assertIn('Found 1 drifted categories', out.getvalue())
+        self.assertEqual(self.counts(), [1, 0])
+
+        call_command('reconcile_category_counts', stdout=io.StringIO())
+        self.assertEqual(self.counts(), [1, 2])
+        self.assertEqual(CategoryService.reconcile_product_counts(), [])
+
+
+class ProductExportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Books')
+        cls.products = [
+            Product.objects.create(name=name, description='multi\nline, "quoted"', price=5, stock=1, category=category)
+            for name in ['Plain', 'Comma, name']
+        ]
+        cls.admin = User.objects.create(email='admin@example.com', is_staff=True)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def test_csv_and_ndjson(self):
+        with self.assertNumQueries(1):  # values_list() iterator joined to the category, no instances
+            body = b''.join(self.client.get('/api/products/export/').streaming_content).decode()
+        rows = list(csv.reader(io.StringIO(body)))
+        self.assertEqual(rows[0][:3], ['id', 'name', 'description'])
+        self.assertEqual([row[1:3] for row in rows[1:]], [[product.name, 'multi\nline, "quoted"'] for product in self.products])
+        self.assertTrue(rows[1][-1].endswith('Z'))
+
+        response = self.client.get('/api/products/export/', {'output': 'ndjson'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        items = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([(item['name'], item['category']) for item in items], [(product.name, 'Books') for product in self.products])
+        self.assertEqual(items[0]['updated_at'], rows[1][-1])  # one datetime format for both outputs
+
+    def test_admin_only(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create(email='user@example.com'))
+        self.assertEqual(client.get('/api/products/export/').status_code, 403)
+        self.assertEqual(self.client.get('/api/products/export/', {'since': 'soon'}).status_code, 400)
+
+
+class ProductBulkUpdateTest(TestCase):
+    url = '/api/products/bulk-update/'
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Tools')
+        cls.hammer = Product.objects.create(name='Hammer', description='Steel', price=10, stock=1, category=category)
+        cls.saw = Product.objects.create(name='Saw', description='Sharp', price=20, stock=2, category=category)
+        cls.admin = User.objects.create(email='admin@example.com', is_staff=True)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def test_rows_are_applied_in_one_statement(self):
+        rows = [{'id': self.hammer.pk, 'stock': 50}, {'id': self.saw.pk, 'stock': 0, 'price': '18.50'}]
+        with self.assertNumQueries(4):  # id check, savepoint, UPDATE ... FROM (VALUES ...), release
+            response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['updated'], 2)
+        self.hammer.refresh_from_db()
+        self.saw.refresh_from_db()
+        self.assertEqual((self.hammer.stock, self.hammer.price), (50, Decimal('10')))
+        self.assertEqual((self.saw.stock, self.saw.price), (0, Decimal('18.50')))
+
+    def test_any_invalid_row_rejects_the_batch(self):
+        rows = [{'id': self.hammer.pk, 'stock': 5}, {'id': self.saw.pk, 'stock': -1}, {'id': 999999, 'price': '1'}]
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2])
+        self.hammer.refresh_from_db()
+        self.assertEqual(self.hammer.stock, 1)
+
+    def test_row_errors_match_the_item_serializer(self):
+        rows = [
+            {'id': self.hammer.pk, 'stock': 'many'}, {'stock': 1}, {'id': 0, 'price': '1.234'}, {'id': self.saw.pk},
+            {'id': 2 ** 63, 'stock': 1}, {'id': None, 'stock': None}, [self.saw.pk, 1], {'id': str(self.saw.pk), 'price': 5},
+        ]
+        valid, errors = ProductBulkUpdateService.validate(rows)
+        expected = {}
+        for index, row in enumerate(rows):
+            serializer = ProductBulkUpdateItemSerializer(data=row)
+            if not serializer.is_valid():
+                expected[index] = serializer.errors
+        self.assertEqual({error['index']: error['errors'] for error in errors}, expected)
+        self.assertEqual(valid, [{'id': self.saw.pk, 'price': Decimal('5.00')}])
+
+    def test_admin_only(self):
+        self.client.force_authenticate(None)
+        self.assertIn(self.client.post(self.url, [], format='json').status_code, (401, 403))
+
+
+class ProductFacetsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        books = Category.objects.create(name='Books')
+        games = Category.objects.create(name='Games')
+        for name, price, category in [('Novel', 12, books), ('Atlas', 60, books), ('Chess', 30, games),
+                                      ('Puzzle', 8, games), ('Console', 400, games)]:
+            Product.objects.create(name=name, description=f'{name} item', price=price, stock=1, category=category)
+        cls.books, cls.games = books, games
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def test_counts_come_from_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/products/facets/', {'price_edges': '0,25,100'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total'], 5)
+        self.assertEqual(
+            [(facet['name'], facet['count']) for facet in response.data['category']], [('Games', 3), ('Books', 2)]
+        )
+        self.assertEqual([facet['count'] for facet in response.data['price']], [2, 2, 1])
+        self.assertIsNone(response.data['price'][-1]['max'])
+
+        with self.assertNumQueries(0):  # cached per filter signature
+            self.client.get('/api/products/facets/', {'price_edges': '0,25,100', 'utm_source': 'x'})
+
+    def test_facets_follow_the_list_filters(self):
+        response = self.client.get('/api/products/facets/', {'price__lt': 50, 'category_id': self.games.pk})
+        self.assertEqual(response.data['total'], 2)
+        self.assertEqual(response.data['category'], [{'id': self.games.pk, 'name': 'Games', 'count': 2}])
+
+    def test_invalid_edges(self):
+        self.assertEqual(self.client.get('/api/products/facets/', {'price_edges': '50,10'}).status_code, 400)
+
+
+class QueryPlanTest(TestCase):
+    """
+    EXPLAIN of the catalog list queries, as ProductViewSet builds them, must use the indexes in Product.Meta.
+    sqlite: the plan names the index and has no temp b-tree for ORDER BY.
+    postgres: with enable_seqscan off the plan must have an index scan and no Sort node,
+    a seq scan or sort showing up anyway means no index fits the query.
+    """
+    @classmethod
+    def setUpTestData(cls):
+        categories = Category.objects.bulk_create(Category(name=f'Category {i}') for i in range(20))
+        Product.objects.bulk_create(
+            Product(name=f'Item {i}', description='item', price=(i * 37) % 1000, stock=i % 50, category=categories[i % 20])
+            for i in range(4000)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.category_id = categories[3].pk
+
+    def list_queryset(self, params):
+        request = Request(APIRequestFactory().get('/api/products/', params))
+        view = ProductViewSet(request=request, action='list', format_kwarg=None, kwargs={})
+        queryset = view.filter_queryset(view.get_queryset())
+        if view.paginator.__class__ is ProductKeysetPagination:
+            paginator = view.paginator
+            paginator.key, paginator.descending = paginator.get_ordering(queryset)
+            queryset = queryset.order_by(*paginator.order_by())
+        return queryset[:10]
+
+    def assertUsesIndex(self, params, index):
+        queryset = self.list_queryset(params)
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+            self.assertRegex(plan, r'Index (Only )?Scan', plan)
+            self.assertNotIn('Sort', plan, plan)
+        else:
+            plan = queryset.explain()
+            self.assertIn(f'USING INDEX {index}', plan, plan)
+            self.assertNotIn('TEMP B-TREE', plan, plan)
+
+    def test_category_price_range_ordered_by_price(self):
+        self.assertUsesIndex(
+            {'category_id': self.category_id, 'price__gt': 100, 'price__lt': 500, 'ordering': 'price'},
+            'product_category_price_idx',
+        )
+
+    def test_category_ordered_by_updated_at(self):
+        self.assertUsesIndex({'category_id': self.category_id, 'ordering': '-updated_at'}, 'product_category_updated_idx')
+
+    def test_category_default_ordering(self):
+        self.assertUsesIndex({'category_id': self.category_id}, 'product_category_id_idx')
+
+    def test_catalog_ordered_by_price(self):
+        self.assertUsesIndex({'ordering': '-price'}, 'product_price_idx')
+
+    def test_catalog_price_range_ordered_by_price(self):
+        self.assertUsesIndex({'price__gt': 100, 'price__lt': 200, 'ordering': 'price'}, 'product_price_idx')
+
+    def test_catalog_ordered_by_updated_at(self):
+        self.assertUsesIndex({'ordering': 'updated_at'}, 'product_updated_idx')
+
+    def test_keyset_page_ordered_by_price(self):
+        self.assertUsesIndex(
+            {'category_id': self.category_id, 'pagination': 'cursor', 'ordering': 'price'}, 'product_category_price_idx'
+        )
+
+
+class ProductImageVariantTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Lamps')
+        cls.product = Product.objects.create(name='Lamp', description='Desk lamp', price=15, stock=4, category=category)
+        cls.admin = User.objects.create(email='admin@example.com', is_staff=True)
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def upload(self):
+        buffer = io.BytesIO()
+        PILImage.new('RGB', (1200, 800), 'orange').save(buffer, 'JPEG')
+        file = SimpleUploadedFile('lamp.jpg', buffer.getvalue(), content_type='image/jpeg')
+        return self.client.post(f'/api/products/{self.product.pk}/images/', {'image': file}, format='multipart')
+
+    def test_local_backend_stores_derivatives_on_upload(self):
+        with self.settings(PRODUCT_IMAGE_BACKEND='products.image_backends.LocalImageBackend', MEDIA_ROOT=self.media_root):
+            response = self.upload()
+        self.assertEqual(response.status_code, 201, response.data)
+        variants = response.data['variants']
+        self.assertEqual(set(variants), {'original', *variant_names()})
+
+        image = ProductImage.objects.get()
+        self.assertEqual(image.variants, variants)  # stored on the row, nothing is built per request
+        sizes = {}
+        for name in ('thumbnail', 'card_webp', 'zoom'):
+            path = os.path.join(self.media_root, variants[name].split(settings.MEDIA_URL, 1)[1])
+            with PILImage.open(path) as file:
+                sizes[name] = (file.format, file.size)
+        self.assertEqual(sizes, {
+            'thumbnail': ('JPEG', (150, 150)),
+            'card_webp': ('WEBP', (480, 480)),
+            'zoom': ('JPEG', (1200, 800)),  # 'limit' never scales up
+        })
+
+    def test_cloudinary_backend_builds_transformation_urls_offline(self):
+        resource = CloudinaryResource('phimart_ecom/lamp', format='jpg', version='1', type='upload', resource_type='image')
+        variants = CloudinaryImageBackend().build_variants(resource)
+        self.assertIn('w_150', variants['thumbnail'])
+        self.assertIn('c_fill', variants['thumbnail'])
+        self.assertTrue(variants['zoom_webp'].endswith('phimart_ecom/lamp.webp'))
+        self.assertTrue(variants['card'].endswith('phimart_ecom/lamp.jpg'))
+
+
+class DirectImageUploadTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Mugs')
+        cls.product = Product.objects.create(name='Mug', description='Tea mug', price=6, stock=9, category=category)
+        cls.other = Product.objects.create(name='Cup', description='Coffee cup', price=4, stock=9, category=category)
+        cls.admin = User.objects.create(email='admin@example.com', is_staff=True)
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        local = self.settings(PRODUCT_IMAGE_BACKEND='products.image_backends.LocalImageBackend', MEDIA_ROOT=media_root)
+        local.enable()
+        self.addCleanup(local.disable)
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+        self.images_url = f'/api/products/{self.product.pk}/images/'
+
+    def image_file(self, name='mug.png'):
+        buffer = io.BytesIO()
+        PILImage.new('RGB', (600, 400), 'teal').save(buffer, 'PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+    def get_ticket(self):
+        response = self.client.post(f'{self.images_url}upload-ticket/')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_ticket_upload_finalize(self):
+        ticket = self.get_ticket()
+        storage = APIClient()  # the upload goes to storage, no api credentials
+        response = storage.post(ticket['upload_url'], {**ticket['fields'], 'file': self.image_file()}, format='multipart')
+        self.assertEqual(response.status_code, 204)
+
+        with self.assertNumQueries(5):  # ticket reuse check, savepoint, INSERT, product updated_at (signal), release; the file never passes through here
+            response = self.client.post(f'{self.images_url}finalize/', {'ticket': ticket['ticket']}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(set(response.data['variants']), {'original', *variant_names()})
+        self.assertEqual(self.product.images.count(), 1)
+
+        response = self.client.post(f'{self.images_url}finalize/', {'ticket': ticket['ticket']}, format='json')
+        self.assertEqual(response.status_code, 400)  # a ticket records one image
+
+    def test_concurrent_finalize_records_one_image(self):
+        ticket = self.get_ticket()
+        APIClient().post(ticket['upload_url'], {**ticket['fields'], 'file': self.image_file()}, format='multipart')
+        finalize_upload = LocalImageBackend.finalize_upload
+
+        def finalized_meanwhile(backend, key, data):  # the other request passes the reuse check and inserts first
+            result = finalize_upload(backend, key, data)
+            ProductImage.objects.create(product=self.product, image=result[0], variants=result[1], upload_key=key)
+            return result
+
+        with mock.patch.object(LocalImageBackend, 'finalize_upload', finalized_meanwhile):
+            response = self.client.post(f'{self.images_url}finalize/', {'ticket': ticket['ticket']}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('already used', str(response.data['ticket']))
+        self.assertEqual(self.product.images.count(), 1)
+
+    def test_ticket_is_bound_to_product_and_expires(self):
+        ticket = self.get_ticket()
+        other_url = f'/api/products/{self.other.pk}/images/local-upload/'
+        response = APIClient().post(other_url, {**ticket['fields'], 'file': self.image_file()}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+
+        with self.settings(PRODUCT_IMAGE_UPLOAD_TICKET_MAX_AGE=-1):
+            response = APIClient().post(ticket['upload_url'], {**ticket['fields'], 'file': self.image_file()}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('expired', str(response.data['file']))
+
+    def test_storage_rejects_bad_files(self):
+        ticket = self.get_ticket()
+        response = APIClient().post(ticket['upload_url'], {**ticket['fields'], 'file': self.image_file('mug.bmp')}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(f'{self.images_url}finalize/', {'ticket': ticket['ticket']}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_cloudinary_upload_signatures(self):
+        backend = CloudinaryImageBackend()
+        upload = backend.upload_ticket('abc', 'ticket', None, self.product.pk)
+        fields = upload['fields']
+        self.assertEqual(fields['public_id'], 'phimart_ecom/abc')
+        params = {key: fields[key] for key in ('public_id', 'timestamp', 'allowed_formats')}
+        self.assertEqual(fields['signature'], api_sign_request(params, cloudinary.config().api_secret))
+
+        response_signature = api_sign_request({'public_id': 'phimart_ecom/abc', 'version': '17'}, cloudinary.config().api_secret, signature_version=1)
+        data = {'version': '17', 'format': 'png', 'signature': response_signature}
+        stored = {'bytes': 2048, 'format': 'png', 'version': 17}
+        with mock.patch('cloudinary.api.resource', return_value=stored) as resource:
+            image, variants = backend.finalize_upload('abc', data)
+            resource.assert_called_once_with('phimart_ecom/abc', resource_type='image', type='upload')
+            self.assertEqual(image.public_id, 'phimart_ecom/abc')
+            with self.assertRaises(UploadError):  # signature of another upload
+                backend.finalize_upload('xyz', data)
+
+    def test_cloudinary_upload_over_the_size_limit_is_deleted(self):
+        response_signature = api_sign_request({'public_id': 'phimart_ecom/abc', 'version': '17'}, cloudinary.config().api_secret, signature_version=1)
+        data = {'version': '17', 'format': 'png', 'signature': response_signature}
+        for stored, message in [({'bytes': 5 * 1024 * 1024, 'format': 'png', 'version': 17}, '1MB'),
+                                ({'bytes': 2048, 'format': 'tiff', 'version': 17}, 'Unsupported')]:
+            with mock.patch('cloudinary.api.resource', return_value=stored), mock.patch('cloudinary.uploader.destroy') as destroy:
+                with self.assertRaisesMessage(UploadError, message):
+                    CloudinaryImageBackend().finalize_upload('abc', data)  # the client's 'format': 'png' isn't trusted
+            destroy.assert_called_once_with('phimart_ecom/abc', resource_type='image', invalidate=True)
+
+
+class AutocompleteTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.phones = Category.objects.create(name='Phones')
+        cls.photo = Category.objects.create(name='Photography')
+        names = ['Smart Phone X', 'Phone Case', 'Photo Frame', 'Headphones Pro', 'Smartwatch']
+        cls.products = {
+            name: Product.objects.create(name=name, description='', price=10, stock=1, category=cls.phones)
+            for name in names
+        }
+        for name, units in [('Phone Case', 50), ('Smart Phone X', 20), ('Photo Frame', 5)]:
+            ProductRanking.objects.filter(product=cls.products[name]).update(units_sold=units)
+
+    def setUp(self):
+        cache.clear()
+        autocomplete._index.update(version=None, index=None, rebuilding=False)  # built from this test's rows
+        self.client = APIClient()
+
+    def suggest(self, q, **params):
+        response = self.client.get('/api/products/autocomplete/', {'q': q, **params})
+        self.assertEqual(response.status_code, 200)
+        return [row['name'] for row in response.data['products']], [row['name'] for row in response.data['categories']]
+
+    def test_prefix_of_any_word_ranked_by_units_sold(self):
+        self.assertEqual(self.suggest('pho'), (['Phone Case', 'Smart Phone X', 'Photo Frame'], ['Phones', 'Photography']))
+        self.assertEqual(self.suggest('SMART'), (['Smart Phone X', 'Smartwatch'], []))
+        self.assertEqual(self.suggest('smart ph'), (['Smart Phone X'], []))
+        self.assertEqual(self.suggest('p', limit=1), (['Phone Case'], ['Phones', 'Photography']))
+        self.assertEqual(self.suggest('  '), ([], []))
+        self.assertEqual(self.client.get('/api/products/autocomplete/', {'q': 'p', 'limit': 'x'}).status_code, 400)
+
+    def test_ids_beyond_32_bits(self):
+        index = Autocomplete([(2 ** 40, 'Wide Id')], [(2 ** 33, 'Wide Category')])
+        self.assertEqual(index.suggest('wide'), {
+            'products': [{'id': 2 ** 40, 'name': 'Wide Id'}], 'categories': [{'id': 2 ** 33, 'name': 'Wide Category'}],
+        })
+
+    def test_lookup_runs_no_query_until_a_name_changes(self):
+        self.suggest('pho')
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=self.products['Phone Case'].pk).update(stock=0)
+            product = Product.objects.get(pk=self.products['Phone Case'].pk)
+            product.price = 11
+            product.save()  # catalog version bumped, the index isn't
+        with self.assertNumQueries(0):
+            self.suggest('phone')
+
+        with mock.patch.object(autocomplete, '_start_rebuild') as start_rebuild:
+            with self.captureOnCommitCallbacks(execute=True):
+                Product.objects.create(name='Phonograph', description='', price=10, stock=1, category=self.phones)
+            with self.assertNumQueries(0):  # the keystroke gets the previous index, a thread rebuilds it
+                self.assertNotIn('Phonograph', self.suggest('phono')[0])
+                self.suggest('phonog')
+        start_rebuild.assert_called_once()  # one rebuild for the version, not one per request
+        autocomplete._rebuild(*start_rebuild.call_args.args)
+        self.assertIn('Phonograph', self.suggest('phono')[0])
+
+    def test_background_rebuild(self):
+        self.suggest('pho')
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.get(pk=self.products['Smartwatch'].pk)
+            product.name = 'Phone Watch'
+            product.save()
+        rebuilds = []
+        with mock.patch.object(autocomplete, '_rebuild', side_effect=rebuilds.append):
+            self.suggest('pho')
+            for _ in range(50):  # started by the request, runs in its own thread
+                if rebuilds:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(rebuilds, [autocomplete.get_autocomplete_version()])
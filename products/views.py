@@ -1,20 +1,31 @@
 # products, views.py: 
-from products.models import Product, Category, Review, ProductImage
-from products.serializers import ProductSerializer, CategorySerializer, ReviewSerializer, ProductImageSerializer
-from django.db.models import Count
+from products.models import Product, Category, Review, ProductImage, RelatedProduct
+from products.serializers import ProductSerializer, CategorySerializer, ReviewSerializer, ProductImageSerializer, ReviewSummarySerializer, ProductBulkUpdateItemSerializer, ProductBulkUpdateResultSerializer, ProductFacetsSerializer, ProductImageUploadTicketSerializer, ProductImageFinalizeSerializer, RelatedProductSerializer, AutocompleteSerializer, parse_field_list
+from django.db.models import Count, Avg, Q
 from rest_framework.viewsets import ModelViewSet
 from django_filters.rest_framework import DjangoFilterBackend # --- 'django_filters'
-from products.filters import ProductFilter
+from products.filters import ProductFilter, ProductOrderingFilter
 from rest_framework.filters import SearchFilter, OrderingFilter # filters
-from products.paginations import DefaultPagination
+from products.search import ProductSearchFilter
+from products.autocomplete import MAX_LIMIT as AUTOCOMPLETE_MAX_LIMIT, get_autocomplete
+from products.image_backends import LocalImageBackend, UploadError, get_image_backend, make_upload_ticket, read_upload_ticket, upload_ticket_max_age
+from products.services import ProductBulkUpdateService, ProductFacetService, ProductRatingService
+from api.streaming import EXPORT_PARAMETERS, STREAM_FORMATS, export_response, parse_export_params, streaming_json_response
+from api.conditional import ConditionalGetMixin
+from api.db_router import ReplicaReadMixin
+from django.db import IntegrityError, transaction
+from products.paginations import DefaultPagination, ProductKeysetPagination
+from products.cache import CatalogCacheMixin, cache_stats as catalog_cache_stats, get_catalog_version
 from api.permissions import IsAdminOrReadOnly # custom permission
 from products.permissions import IsReviewAuthorOrReadonly
-from drf_yasg.utils import swagger_auto_schema
+from drf_yasg.utils import no_body, swagger_auto_schema
 #
 from rest_framework.response import Response
 from rest_framework import status
-from django.http import HttpResponse
-from rest_framework.decorators import api_view
+from django.http import Http404, HttpResponse
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import MultiPartParser
+from rest_framework.decorators import api_view, action
 from django.shortcuts import get_object_or_404
 from rest_framework.reverse import reverse
 from rest_framework.views import APIView
@@ -24,11 +35,23 @@ from rest_framework.permissions import DjangoModelPermissions, DjangoModelPermis
 from drf_yasg import openapi
 
 
+STREAM_CHUNK_SIZE = 500
+EXPORT_CHUNK_SIZE = 2000
+PRODUCT_EXPORT_COLUMNS = [  # (header, values_list field)
+    ('id', 'id'), ('name', 'name'), ('description', 'description'), ('price', 'price'), ('stock', 'stock'),
+    ('category_id', 'category_id'), ('category', 'category__name'), ('rating_avg', 'rating_avg'),
+    ('rating_count', 'rating_count'), ('created_at', 'created_at'), ('updated_at', 'updated_at'),
+]
+
+
 @api_view(['GET','POST'])
 def view_products(request):  # fbv, module 20.1 # http://127.0.0.1:8000/api/products2/product-list/  # http://127.0.0.1:8000/api/products2/product-list/ with no auth allowed
     #return HttpResponse("Okay")
     #return Response({'message':"Hello from Anup"})
     if request.method == 'GET':
+        stream_format = request.query_params.get('stream')  # ?stream=json or ?stream=ndjson
+        if stream_format:
+            return stream_products(request, stream_format)
         products = Product.objects.select_related('category').all()
         serializer = ProductSerializer(products, many=True, context={'request': request})  # --- context for HyperlinkedRelatedField in serializers
         return Response(serializer.data)
@@ -39,6 +62,32 @@ def view_products(request):  # fbv, module 20.1 # http://127.0.0.1:8000/api/prod
         serializer.save()
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+def stream_products(request, stream_format):
+    """
+    Low memory mode of view_products: rows are read with .iterator(chunk_size) (images prefetched per chunk)
+    and written out one by one, so memory stays flat however big the catalog is.
+    http://127.0.0.1:8000/api/products2/product-list/?stream=ndjson&chunk_size=1000
+    """
+    if stream_format not in STREAM_FORMATS:
+        return Response({'stream': f"Must be one of {', '.join(STREAM_FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        chunk_size = max(1, min(int(request.query_params.get('chunk_size', STREAM_CHUNK_SIZE)), 5000))
+    except ValueError:
+        return Response({'chunk_size': 'Must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+    products = Product.objects.defer('search_document').prefetch_related('images').order_by('id')
+    serializer = ProductSerializer(context={'request': request})  # one serializer reused for every row
+
+    def rows():
+        for product in products.iterator(chunk_size=chunk_size):
+            yield serializer.to_representation(product)
+            # the prefetched images queryset points back at its product, drop it so the chunk
+            # is freed right away instead of waiting for the cyclic garbage collector
+            product._prefetched_objects_cache = {}
+
+    return streaming_json_response(rows(), stream_format)
+
+
 """
 # APIView
 # https://www.django-rest-framework.org/api-guide/views/
@@ -92,7 +141,7 @@ def view_specific_product(request, id):  # module 20.2  # http://127.0.0.1:8000/
 
 @api_view()  # only allow GET requests by default
 def view_categories(request):
-    categories = Category.objects.annotate(product_count=Count('products')).all()        
+    categories = Category.objects.all()  # product_count is a stored column now, no GROUP BY over products
     serializer = CategorySerializer(categories, many=True)
     return Response(serializer.data)
 
@@ -105,22 +154,34 @@ def view_specific_category(request, pk):
     return Response(serializer.data)
 
 
-class ProductViewSet(ModelViewSet):
+class ProductViewSet(ReplicaReadMixin, CatalogCacheMixin, ConditionalGetMixin, ModelViewSet):
     """
     API endpoint for managing products in the e-commerce store
      - Allows authenticated admin to create, update, and delete products
      - Allows users to browse and filter product
      - Support searching by name, description, and category
-     - Support ordering by price and updated_at
+     - Support ordering by price, updated_at, rating_avg and rating_count, and by popularity (bestselling, trending)
+     - list and retrieve responses are cached, see products/cache.py
+     - list and retrieve send ETag/Last-Modified and answer 304 Not Modified, see api/conditional.py
+     - related/ reads from the replica database when one is configured, see api/db_router.py
+     - ?pagination=cursor (or any ?cursor=) switches to keyset pagination for infinite scroll
+     - ?fields=id,name,price,first_image trims the response and the SELECT, ?expand=category nests the category
+     - {id}/related/ lists products frequently bought together, built by python manage.py build_copurchase
+     - autocomplete/?q= suggests product and category names from memory, products/autocomplete.py
     """
     
     #queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    filter_backends = [DjangoFilterBackend, ProductSearchFilter, ProductOrderingFilter]  # ProductSearchFilter: full text search, products/search.py
     filterset_class = ProductFilter  # uses 'django_filters'
     pagination_class = DefaultPagination
+    cursor_pagination_class = ProductKeysetPagination
+    cache_extra_params = ['pagination', 'fields', 'expand']
+    # list, retrieve, facets and autocomplete stay on the primary: what they read is cached under a version (products/cache.py),
+    # a miss on a lagging replica right after a bump would cache the old rows under the new version
+    replica_actions = ['related']
     search_fields = ['name', 'description'] # 
-    ordering_fields = ['price', 'updated_at']
+    ordering_fields = ['price', 'updated_at', 'rating_avg', 'rating_count']
     permission_classes = [IsAdminOrReadOnly]  # or custom permission
     # permission_classes = [IsAuthenticatedOrReadOnly]  
     # permission_classes = [DjangoModelPermissionsOrAnonReadOnly]  # for edit, can give group permission(can crud a specific model) to a user.
@@ -135,16 +196,27 @@ class ProductViewSet(ModelViewSet):
             'ordering', 
             openapi.IN_QUERY,
             description="Order by specified field:\n"
+                        "- 'relevance' = best search match first (default when ?search= is given)\n"
                         "- 'price' = lowest to highest price\n"
                         "- '-price' = highest to lowest price\n"
                         "- 'updated_at' = oldest first\n"
-                        "- '-updated_at' = newest first",
+                        "- '-updated_at' = newest first\n"
+                        "- '-rating_avg' = best rated first\n"
+                        "- '-rating_count' = most reviewed first\n"
+                        "- 'bestselling' = most units sold first\n"
+                        "- 'trending' = most sold recently first (time decayed)",
             type=openapi.TYPE_STRING,
-            enum=['price', '-price', 'updated_at', '-updated_at']
+            enum=['relevance', 'price', '-price', 'updated_at', '-updated_at', 'rating_avg', '-rating_avg', 'rating_count', '-rating_count',
+                  'bestselling', '-bestselling', 'trending', '-trending']
         	),
     	    openapi.Parameter('price__gt', openapi.IN_QUERY, description="Filter products with price greater than this value", type=openapi.TYPE_NUMBER),
     	    openapi.Parameter('price__lt', openapi.IN_QUERY, description="Filter products with price less than this value", type=openapi.TYPE_NUMBER),
     	    openapi.Parameter('category_id', openapi.IN_QUERY, description="Filter by category ID", type=openapi.TYPE_INTEGER),
+    	    openapi.Parameter('pagination', openapi.IN_QUERY, description="'cursor' for keyset pagination (next/previous links, no page numbers)", type=openapi.TYPE_STRING, enum=['page', 'cursor']),
+    	    openapi.Parameter('cursor', openapi.IN_QUERY, description="Cursor from a next/previous link (keyset pagination)", type=openapi.TYPE_STRING),
+    	    openapi.Parameter('count', openapi.IN_QUERY, description="'false' to skip the total count (keyset pagination)", type=openapi.TYPE_BOOLEAN),
+    	    openapi.Parameter('fields', openapi.IN_QUERY, description="Comma separated fields to return, eg. id,name,price,first_image", type=openapi.TYPE_STRING),
+    	    openapi.Parameter('expand', openapi.IN_QUERY, description="Comma separated relations to nest, eg. category", type=openapi.TYPE_STRING),
     	]
     )
     def list(self, request, *args, **kwargs):
@@ -170,12 +242,168 @@ class ProductViewSet(ModelViewSet):
     #         queryset = Product.objects.all()   
     #     return queryset
     def get_queryset(self):
-        return Product.objects.prefetch_related('images').all()
+        queryset = Product.objects.defer('search_document')  # tsvector is only read by the database
+        fields, expand = self.get_sparse_fields()
+        if 'category' in expand:
+            queryset = queryset.select_related('category')
+        if fields is None:
+            return queryset.prefetch_related('images')
+
+        if ProductSerializer.Meta.prefetch_fields & fields:
+            queryset = queryset.prefetch_related('images')
+        # select only the columns behind the requested fields, plus the ordering key for keyset pagination
+        columns = ProductSerializer.columns_for(fields) | {'id', 'updated_at'}  # updated_at: Last-Modified
+        for name in self.request.query_params.get('ordering', '').split(','):
+            name = name.strip().lstrip('-')
+            if name in self.ordering_fields:
+                columns.add(name)
+        if 'category' in expand:
+            columns.update(f'category__{name}' for name in CategorySerializer.Meta.fields)
+            columns.add('category__updated_at')
+        return queryset.only(*columns)
+
+    def get_last_modified_fields(self):
+        _, expand = self.get_sparse_fields()
+        if 'category' in expand:  # nested category data changes the response too
+            return ['updated_at', 'category__updated_at']
+        return ['updated_at']
+
+    def get_etag_parts(self, request):
+        parts = super().get_etag_parts(request)
+        field, _ = ProductOrderingFilter().get_ranking_ordering(request)
+        if field is not None:  # a rankings refresh reorders the list without touching products.updated_at
+            parts.append(get_catalog_version())
+        return parts
+
+    def get_sparse_fields(self):
+        """(requested fields or None, expanded relations), only for reads"""
+        request = getattr(self, 'request', None)
+        if request is None or self.action not in ('list', 'retrieve'):
+            return None, set()
+        fields = set(parse_field_list(request.query_params.get('fields'))) or None
+        expand = set(parse_field_list(request.query_params.get('expand')))
+        # unknown names would reach .only() as columns
+        unknown_fields = sorted((fields or set()) - set(ProductSerializer.Meta.fields))
+        if unknown_fields:
+            raise ValidationError({'fields': [f"Unknown field '{name}'" for name in unknown_fields]})
+        unknown_expand = sorted(expand - set(ProductSerializer.Meta.expandable_fields))
+        if unknown_expand:
+            raise ValidationError({'expand': [f"Unknown relation '{name}'" for name in unknown_expand]})
+        if fields is not None:
+            fields |= expand
+        return fields, expand
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'], context['expand'] = self.get_sparse_fields()
+        return context
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            request = getattr(self, 'request', None)
+            params = request.query_params if request is not None else {}
+            if params.get('pagination') == 'cursor' or params.get(self.cursor_pagination_class.cursor_query_param):
+                self._paginator = self.cursor_pagination_class()
+        return super().paginator
+
+    @swagger_auto_schema(
+        operation_summary='Update stock and/or price of many products at once (admin)',
+        operation_description="Body: [{\"id\": 1, \"stock\": 10, \"price\": \"9.99\"}, ...], all rows are applied or none",
+        request_body=ProductBulkUpdateItemSerializer(many=True),
+        responses={200: ProductBulkUpdateResultSerializer, 400: ProductBulkUpdateResultSerializer},
+    )
+    @action(detail=False, methods=['post'], url_path='bulk-update', permission_classes=[IsAdminUser])
+    def bulk_update(self, request):  # http://127.0.0.1:8000/api/products/bulk-update/
+        rows = request.data
+        if not isinstance(rows, list):
+            return Response({'detail': 'Expected a list of {id, stock, price} rows'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > ProductBulkUpdateService.max_rows:
+            return Response({'detail': f'At most {ProductBulkUpdateService.max_rows} rows per request'}, status=status.HTTP_400_BAD_REQUEST)
+        valid, errors = ProductBulkUpdateService.validate(rows)
+        if errors:  # nothing is written unless every row is valid
+            return Response(ProductBulkUpdateResultSerializer({'updated': 0, 'errors': errors}).data, status=status.HTTP_400_BAD_REQUEST)
+        updated = ProductBulkUpdateService.apply(valid)
+        return Response(ProductBulkUpdateResultSerializer({'updated': updated, 'errors': []}).data)
+
+    @swagger_auto_schema(
+        operation_summary='Category and price bucket counts for the current search/filters',
+        manual_parameters=[
+            openapi.Parameter('search', openapi.IN_QUERY, type=openapi.TYPE_STRING),
+            openapi.Parameter('price__gt', openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+            openapi.Parameter('price__lt', openapi.IN_QUERY, type=openapi.TYPE_NUMBER),
+            openapi.Parameter('category_id', openapi.IN_QUERY, type=openapi.TYPE_INTEGER),
+            openapi.Parameter('price_edges', openapi.IN_QUERY, description="Bucket edges, eg. 0,50,100,500 (default settings.PRODUCT_PRICE_FACET_EDGES)", type=openapi.TYPE_STRING),
+        ],
+        responses={200: ProductFacetsSerializer},
+    )
+    @action(detail=False, methods=['get'])
+    def facets(self, request):  # http://127.0.0.1:8000/api/products/facets/?search=phone&price__lt=500
+        """Sidebar counts, same filters as the list, cached per filter set like the list pages"""
+        return self.cached_response(self.compute_facets, request)
+
+    def compute_facets(self, request):
+        edges = ProductFacetService.parse_price_edges(request.query_params.get('price_edges'))
+        queryset = self.filter_queryset(Product.objects.all())  # same filters/search as the list
+        return Response(ProductFacetsSerializer(ProductFacetService.facet_counts(queryset, edges)).data)
+
+    def get_cache_params(self):
+        if self.action == 'facets':
+            return set(self.filterset_class.base_filters) | {ProductSearchFilter.search_param, 'price_edges'}
+        return super().get_cache_params()
+
+    @swagger_auto_schema(
+        operation_summary='Product and category name suggestions, for search as you type',
+        manual_parameters=[
+            openapi.Parameter('q', openapi.IN_QUERY, description="What was typed so far, matches the start of any word of a name", type=openapi.TYPE_STRING),
+            openapi.Parameter('limit', openapi.IN_QUERY, description=f"Products to return, 1-{AUTOCOMPLETE_MAX_LIMIT} (default 8)", type=openapi.TYPE_INTEGER),
+        ],
+        responses={200: AutocompleteSerializer},
+    )
+    @action(detail=False, methods=['get'])
+    def autocomplete(self, request):  # http://127.0.0.1:8000/api/products/autocomplete/?q=smart ph
+        """Served from an in-process prefix index (products/autocomplete.py), no query per keystroke"""
+        try:
+            limit = min(max(int(request.query_params.get('limit', 8)), 1), AUTOCOMPLETE_MAX_LIMIT)
+        except ValueError:
+            raise ValidationError({'limit': 'Must be an integer'})
+        return Response(get_autocomplete().suggest(request.query_params.get('q', ''), limit))
+
+    @swagger_auto_schema(operation_summary='Export products as CSV or NDJSON (admin)', manual_parameters=EXPORT_PARAMETERS)
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def export(self, request):  # http://127.0.0.1:8000/api/products/export/?output=ndjson&since=2025-01-01&date_field=updated_at
+        """Whole catalog streamed from a values_list() iterator, no model instances, no serializer"""
+        output, date_range = parse_export_params(request)
+        rows = (
+            Product.objects.filter(**date_range).order_by('id')
+            .values_list(*[field for _, field in PRODUCT_EXPORT_COLUMNS])
+            .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        )
+        return export_response(output, [header for header, _ in PRODUCT_EXPORT_COLUMNS], rows, 'products')
+
+    @swagger_auto_schema(operation_summary='Frequently bought together', responses={200: RelatedProductSerializer(many=True)})
+    @action(detail=True, methods=['get'])
+    def related(self, request, pk=None):  # http://127.0.0.1:8000/api/products/1/related/
+        """Precomputed top-K co-purchases (orders/recommendations.py), one query on the (product, rank) index"""
+        try:
+            product_id = int(pk)
+        except ValueError:
+            raise Http404
+        entries = (
+            RelatedProduct.objects.filter(product_id=product_id).select_related('related')
+            .only('score', 'rank', 'related__id', 'related__name', 'related__price')
+        )
+        return Response(RelatedProductSerializer(entries, many=True).data)
+
+    @action(detail=False, methods=['get'], url_path='cache-stats', permission_classes=[IsAdminUser])
+    def cache_stats(self, request):  # http://127.0.0.1:8000/api/products/cache-stats/
+        """Hit/miss counters of the catalog response cache"""
+        return Response(catalog_cache_stats())
 
 
 # http://127.0.0.1:8000/api/products/?price__gt=200&price__lt=300  --> worked
 
-class ProductImageViewSet(ModelViewSet):
+class ProductImageViewSet(ReplicaReadMixin, ModelViewSet):
     serializer_class = ProductImageSerializer
     permission_classes = [IsAdminOrReadOnly]
 
@@ -183,16 +411,69 @@ class ProductImageViewSet(ModelViewSet):
         return ProductImage.objects.filter(product_id=self.kwargs.get('product_pk'))
 
     def perform_create(self, serializer):
-        serializer.save(product_id=self.kwargs.get('product_pk'))
-
+        serializer.save(product_id=self.kwargs.get('product_pk'), **self.store_image(serializer))
 
-class CategoryViewSet(ModelViewSet):
+    def perform_update(self, serializer):
+        serializer.save(**self.store_image(serializer))
+
+    @swagger_auto_schema(operation_summary='Ticket for uploading an image straight to storage (admin)', request_body=no_body, responses={200: ProductImageUploadTicketSerializer})
+    @action(detail=False, methods=['post'], url_path='upload-ticket')
+    def upload_ticket(self, request, product_pk=None):  # http://127.0.0.1:8000/api/products/1/images/upload-ticket/
+        get_object_or_404(Product, pk=product_pk)
+        key, ticket = make_upload_ticket(product_pk)
+        upload = get_image_backend().upload_ticket(key, ticket, request, product_pk)
+        data = {'ticket': ticket, 'expires_in': upload_ticket_max_age(), **upload}
+        return Response(ProductImageUploadTicketSerializer(data).data)
+
+    @swagger_auto_schema(operation_summary='Record an image uploaded with a ticket (admin)', request_body=ProductImageFinalizeSerializer, responses={201: ProductImageSerializer})
+    @action(detail=False, methods=['post'])
+    def finalize(self, request, product_pk=None):  # http://127.0.0.1:8000/api/products/1/images/finalize/
+        serializer = ProductImageFinalizeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            key = read_upload_ticket(serializer.validated_data['ticket'], product_pk)
+            if ProductImage.objects.filter(upload_key=key).exists():  # unique index, before the storage checks
+                raise UploadError('This ticket was already used')
+            image, variants = get_image_backend().finalize_upload(key, serializer.validated_data)
+        except UploadError as exc:
+            raise ValidationError({'ticket': str(exc)})
+        try:
+            with transaction.atomic():
+                product_image = ProductImage.objects.create(product_id=product_pk, image=image, variants=variants, upload_key=key)
+        except IntegrityError:  # the same ticket finalized concurrently, the other request recorded it
+            raise ValidationError({'ticket': 'This ticket was already used'})
+        return Response(self.get_serializer(product_image).data, status=status.HTTP_201_CREATED)
+
+    @swagger_auto_schema(auto_schema=None)
+    @action(detail=False, methods=['post'], url_path='local-upload', permission_classes=[AllowAny], authentication_classes=[], parser_classes=[MultiPartParser])
+    def local_upload(self, request, product_pk=None):
+        """stand-in for the storage service with LocalImageBackend, the signed ticket is the credential"""
+        backend = get_image_backend()
+        if not isinstance(backend, LocalImageBackend):
+            raise Http404
+        try:
+            key = read_upload_ticket(request.data.get('ticket'), product_pk)
+            backend.save_upload(key, request.data.get('file'))
+        except UploadError as exc:
+            raise ValidationError({'file': str(exc)})
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    def store_image(self, serializer):
+        # upload through the image backend, derivative urls are made here once, see products/image_backends.py
+        upload = serializer.validated_data.pop('image', None)
+        if upload is None:
+            return {}
+        image, variants = get_image_backend().store(upload)
+        return {'image': image, 'variants': variants}
+
+
+class CategoryViewSet(ReplicaReadMixin, ConditionalGetMixin, ModelViewSet):
     permission_classes = [IsAdminOrReadOnly]
-    queryset = Category.objects.annotate(product_count=Count('products')).all()
+    queryset = Category.objects.order_by('id')  # product_count is stored on Category, see products/services.py CategoryService
     serializer_class = CategorySerializer
 
 
-class ReviewViewSet(ModelViewSet):
+class ReviewViewSet(ReplicaReadMixin, ModelViewSet):
     serializer_class = ReviewSerializer
     #permission_classes = [IsAuthenticated]  # ---
     permission_classes = [IsReviewAuthorOrReadonly]
@@ -202,7 +483,7 @@ class ReviewViewSet(ModelViewSet):
         # during schema generation, swagger_fake_view == True and there are no kwargs
         if getattr(self, 'swagger_fake_view', False):
             return Review.objects.none()
-        return Review.objects.filter(product_id=self.kwargs['product_pk'])
+        return Review.objects.select_related('user').filter(product_id=self.kwargs['product_pk']).order_by('-id')
         # or, return Review.objects.filter(product_id=self.kwargs.get('product_pk')) # has problem
 
     def get_serializer_context(self):
@@ -233,6 +514,38 @@ class ReviewViewSet(ModelViewSet):
     #         user=self.request.user,  # Set current user
     #         product_id=self.kwargs['product_pk']  # Set product from URL
     #     ) 
+
+    # keep Product.rating_avg/rating_count/stars_* in sync, see products/services.py
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            review = serializer.save()
+            ProductRatingService.update_ratings(review.product_id, added=review.ratings)
+
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            old_rating = serializer.instance.ratings
+            review = serializer.save()
+            ProductRatingService.update_ratings(review.product_id, added=review.ratings, removed=old_rating)
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            instance.delete()
+            ProductRatingService.update_ratings(instance.product_id, removed=instance.ratings)
+
+    @swagger_auto_schema(operation_summary='Review count, average and star histogram of a product', responses={200: ReviewSummarySerializer})
+    @action(detail=False, methods=['get'])
+    def summary(self, request, product_pk=None):  # http://127.0.0.1:8000/api/products/1/reviews/summary/
+        stats = Review.objects.filter(product_id=product_pk).aggregate(  # one query
+            count=Count('id'),
+            average=Avg('ratings'),
+            **{f'stars_{star}': Count('id', filter=Q(ratings=star)) for star in range(1, 6)},
+        )
+        data = {
+            'count': stats['count'],
+            'average': round(stats['average'] or 0, 2),
+            'histogram': {str(star): stats[f'stars_{star}'] for star in range(1, 6)},
+        }
+        return Response(ReviewSummarySerializer(data).data)
     
 
 